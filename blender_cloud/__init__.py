@@ -111,7 +111,13 @@ def _monkey_patch_requests():
 
 
 def unregister():
-    from . import blender, texture_browser, async_loop, settings_sync, image_sharing, attract
+    import asyncio
+    from . import (blender, texture_browser, async_loop, settings_sync, image_sharing, attract,
+                   pillar)
+
+    loop = asyncio.get_event_loop()
+    if not loop.is_closed():
+        loop.run_until_complete(pillar.shutdown())
 
     image_sharing.unregister()
     attract.unregister()
@@ -26,6 +26,8 @@ import gc
 
 import bpy
 
+from . import tracing
+
 log = logging.getLogger(__name__)
 
 # Keeps track of whether a loop-kicking operator is already running.
@@ -236,7 +238,9 @@ class AsyncModalOperatorMixin:
 
         # Download the previews asynchronously.
         self.signalling_future = future or asyncio.Future()
-        self.async_task = asyncio.ensure_future(async_task)
+        self.async_task = asyncio.ensure_future(tracing.traced(
+            async_task, getattr(async_task, '__qualname__', repr(async_task)), 'operator',
+            operator=getattr(self, 'bl_idname', type(self).__name__)))
         self.log.debug('Created new task %r', self.async_task)
 
         # Start the async manager so everything happens.
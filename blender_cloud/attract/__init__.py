@@ -39,6 +39,7 @@
 import contextlib
 import functools
 import logging
+import pathlib
 
 if "bpy" in locals():
     import importlib
@@ -46,9 +47,10 @@ if "bpy" in locals():
     draw = importlib.reload(draw)
     pillar = importlib.reload(pillar)
     async_loop = importlib.reload(async_loop)
+    upload = importlib.reload(upload)
 else:
     from . import draw
-    from .. import pillar, async_loop
+    from .. import pillar, async_loop, upload
 
 import bpy
 import pillarsdk
@@ -819,12 +821,12 @@ class ATTRACT_OT_make_shot_thumbnail(AttractOperatorMixin,
                 }
             })
 
-    async def upload_via_tempdir(self, datablock, filename_on_cloud) -> pillarsdk.Node:
+    async def upload_via_tempdir(self, datablock, filename_on_cloud) -> str:
         """Saves the datablock to file, and uploads it to the cloud.
 
         Saving is done to a temporary directory, which is removed afterwards.
 
-        Returns the node.
+        Returns the file ID, or None when the upload failed.
         """
         import tempfile
         import os.path
@@ -835,10 +837,10 @@ class ATTRACT_OT_make_shot_thumbnail(AttractOperatorMixin,
             datablock.save_render(filepath)
             return await self.upload_file(filepath)
 
-    async def upload_file(self, filename: str, fileobj=None):
-        """Uploads a file to the cloud, attached to the image sharing node.
+    async def upload_file(self, filename: str):
+        """Uploads a file to the Attract project.
 
-        Returns the node.
+        Returns the file ID, or None when the upload failed.
         """
         from .. import blender
 
@@ -846,19 +848,18 @@ class ATTRACT_OT_make_shot_thumbnail(AttractOperatorMixin,
         project = self.find_project(prefs.attract_project.project)
 
         self.log.info('Uploading file %s', filename)
-        resp = await pillar.pillar_call(
-            pillarsdk.File.upload_to_project,
-            project['_id'],
-            'image/jpeg',
-            filename,
-            fileobj=fileobj)
-
-        self.log.debug('Returned data: %s', resp)
         try:
-            file_id = resp['file_id']
-        except KeyError:
-            self.log.error('Upload did not succeed, response: %s', resp)
-            self.report({'ERROR'}, 'Unable to upload thumbnail to Attract: %s' % resp)
+            file_id = await pillar.upload_file(
+                project['_id'],
+                pathlib.Path(filename),
+                mimetype='image/jpeg',
+                progress=upload.progress_reporter(
+                    lambda message: self.report({'INFO'}, message),
+                    'Uploading thumbnail'),
+                future=self.signalling_future)
+        except (pillar.PillarError, sdk_exceptions.ClientError) as ex:
+            self.log.error('Upload did not succeed: %s', ex)
+            self.report({'ERROR'}, 'Unable to upload thumbnail to Attract: %s' % ex)
             return None
 
         self.log.info('Created file %s', file_id)
@@ -0,0 +1,209 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Bandwidth shaping for file transfers.
+
+Transfers draw from one of two token buckets: one for interactive transfers
+(INTERACTIVE and VISIBLE priority, which someone is waiting for) and one
+for background transfers (PREFETCH and BACKGROUND priority). Both downloads
+and uploads count towards the budget of their bucket. A rate of 0 means
+unlimited; the rates can be changed while transfers are running.
+
+Throughput is measured separately for downloads and uploads, for showing
+in the user interface.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+from .concurrency import Priority
+
+log = logging.getLogger(__name__)
+
+# Bursts of at least this many bytes are allowed, so that a single block
+# of a transfer never has to wait longer than its own size requires.
+MIN_BURST = 256 * 1024
+
+
+class TokenBucket:
+    """Limits throughput to `rate` bytes per second.
+
+    Tokens accumulate at `rate` per second up to `burst`. Taking more tokens
+    than available puts the bucket in debt, which the caller has to wait
+    out; concurrent callers thus queue up behind each other.
+
+    :param rate: bytes per second, or 0 for unlimited.
+    :param burst: maximum number of bytes that can be sent without waiting;
+        defaults to one second worth of data.
+    :param clock: function returning monotonic time in seconds; for testing.
+    """
+
+    def __init__(self, name: str, rate=0.0, *, burst: float = None, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self._burst_setting = burst
+        self._rate = 0.0
+        self._burst = 0.0
+        self._tokens = 0.0
+        self._last_refill = clock()
+        self.set_rate(rate)
+
+    def __repr__(self):
+        return '<%s %r rate=%.0f>' % (type(self).__name__, self.name, self._rate)
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float):
+        """Changes the rate; waiting transfers use it from their next block on."""
+
+        rate = max(0.0, float(rate))
+        if rate == self._rate:
+            return
+
+        log.debug('%s: limiting to %.0f bytes/sec', self.name, rate)
+        self._rate = rate
+        self._burst = max(self._burst_setting or rate, MIN_BURST)
+        # Debt incurred at the old rate is forgiven; it no longer means anything.
+        self._tokens = self._burst
+        self._last_refill = self.clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def reserve(self, amount: int) -> float:
+        """Takes tokens for sending `amount` bytes.
+
+        :returns: the number of seconds to wait before sending them.
+        """
+
+        if not self._rate:
+            return 0.0
+
+        self._refill()
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self._rate
+
+    async def consume(self, amount: int):
+        """Waits until `amount` bytes may be sent."""
+
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ThroughputMeter:
+    """Measures the number of bytes per second over a sliding window.
+
+    :param window: length of the window in seconds.
+    :param clock: function returning monotonic time in seconds; for testing.
+    """
+
+    def __init__(self, name: str, *, window=3.0, clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.clock = clock
+        self.total = 0
+        self._samples = collections.deque()  # (timestamp, amount) tuples.
+
+    def __repr__(self):
+        return '<%s %r %.0f bytes/sec>' % (type(self).__name__, self.name, self.rate)
+
+    def record(self, amount: int):
+        now = self.clock()
+        self.total += amount
+        self._samples.append((now, amount))
+        self._expire(now)
+
+    def _expire(self, now: float):
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second over the last `window` seconds."""
+
+        self._expire(self.clock())
+        return sum(amount for _, amount in self._samples) / self.window
+
+
+interactive_bucket = TokenBucket('interactive')
+background_bucket = TokenBucket('background')
+download_meter = ThroughputMeter('download')
+upload_meter = ThroughputMeter('upload')
+
+
+def set_limits(interactive_rate: float, background_rate: float):
+    """Sets the rates of the interactive and background buckets, in bytes per second."""
+
+    interactive_bucket.set_rate(interactive_rate)
+    background_bucket.set_rate(background_rate)
+
+
+def bucket_for(priority: Priority) -> TokenBucket:
+    if priority <= Priority.VISIBLE:
+        return interactive_bucket
+    return background_bucket
+
+
+async def downloaded(amount: int, priority: Priority):
+    """Records a downloaded block, and waits until the next one may be downloaded."""
+
+    download_meter.record(amount)
+    await bucket_for(priority).consume(amount)
+
+
+def upload_throttle(priority: Priority) -> callable:
+    """Returns a function for upload.FileBody's throttle parameter."""
+
+    bucket = bucket_for(priority)
+
+    def throttle(amount: int) -> float:
+        upload_meter.record(amount)
+        return bucket.reserve(amount)
+
+    return throttle
+
+
+def _format_rate(rate: float) -> str:
+    if rate >= 1024 * 1024:
+        return '%.1f MiB/s' % (rate / (1024 * 1024))
+    return '%.0f KiB/s' % (rate / 1024)
+
+
+def status_text() -> str:
+    """Returns the current throughput for the user, or '' when nothing is transferred."""
+
+    down = download_meter.rate
+    up = upload_meter.rate
+    if not down and not up:
+        return ''
+
+    parts = []
+    if down:
+        parts.append('Download %s' % _format_rate(down))
+    if up:
+        parts.append('Upload %s' % _format_rate(up))
+    return ', '.join(parts)
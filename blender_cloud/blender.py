@@ -26,10 +26,12 @@ import os.path
 
 import bpy
 from bpy.types import AddonPreferences, Operator, WindowManager, Scene, PropertyGroup
-from bpy.props import StringProperty, EnumProperty, PointerProperty, BoolProperty
+from bpy.props import StringProperty, EnumProperty, PointerProperty, BoolProperty, \
+    FloatProperty
 import rna_prop_ui
 
-from . import pillar, async_loop
+from . import (pillar, async_loop, bandwidth, blob_store, cache, metrics, session, tracing,
+               utils)
 
 PILLAR_WEB_SERVER_URL = 'https://cloud.blender.org/'
 # PILLAR_WEB_SERVER_URL = 'http://pillar-web:5001/'
@@ -191,6 +193,50 @@ class BlenderCloudPreferences(AddonPreferences):
         subtype='DIR_PATH',
         default='//textures')
 
+    texture_store_dir = StringProperty(
+        name='Texture store directory',
+        description='Directory that downloaded textures are stored in once, and linked from '
+                    'into texture directories; best put on the same drive as those. '
+                    'Textures are hardlinked when possible, so editing a texture file in '
+                    'place changes it in every directory it was downloaded to. '
+                    'Leave empty to use the cache directory',
+        subtype='DIR_PATH',
+        default='')
+
+    cache_lifetime_hours = FloatProperty(
+        name='Cache lifetime',
+        description='Number of hours that downloaded thumbnails and textures are used '
+                    'without checking the Blender Cloud for a newer version',
+        min=0.0,
+        soft_max=24 * 7,
+        default=24.0,
+        update=lambda self, context: apply_cache_lifetime(self))
+
+    interactive_bandwidth_limit = FloatProperty(
+        name='Interactive transfers',
+        description='Maximum speed in MiB/s of downloads and uploads you are waiting for, '
+                    'like the texture you clicked on and visible thumbnails; 0 is unlimited',
+        min=0.0,
+        soft_max=100.0,
+        default=0.0,
+        update=lambda self, context: apply_bandwidth_limits(self))
+
+    background_bandwidth_limit = FloatProperty(
+        name='Background transfers',
+        description='Maximum speed in MiB/s of downloads and uploads nobody is waiting for, '
+                    'like revalidating cached thumbnails; 0 is unlimited',
+        min=0.0,
+        soft_max=100.0,
+        default=0.0,
+        update=lambda self, context: apply_bandwidth_limits(self))
+
+    record_traces = BoolProperty(
+        name='Record traces',
+        description='Record how long operators, Blender Cloud calls and transfers take, '
+                    'for saving as trace file that can be opened in chrome://tracing',
+        default=False,
+        update=lambda self, context: apply_tracing(self))
+
     open_browser_after_share = BoolProperty(
         name='Open browser after sharing file',
         description='When enabled, Blender will open a webbrowser',
@@ -258,6 +304,35 @@ class BlenderCloudPreferences(AddonPreferences):
         sub.label(text='Local directory for downloaded textures', icon_value=icon('CLOUD'))
         sub.prop(self, "local_texture_dir", text='Default')
         sub.prop(context.scene, "local_texture_dir", text='Current scene')
+        row = sub.row(align=True)
+        row.prop(self, "texture_store_dir", text='Texture store')
+        row.operator('pillar.texture_store_gc', text='', icon='TRASH')
+        sub.prop(self, 'cache_lifetime_hours')
+
+        # Bandwidth stuff
+        bandwidth_box = layout.box()
+        sub = bandwidth_box.column()
+        sub.label(text='Bandwidth limits in MiB/s (0 is unlimited)', icon='SETTINGS')
+        row = sub.row()
+        row.prop(self, 'interactive_bandwidth_limit')
+        row.prop(self, 'background_bandwidth_limit')
+        sub.label(text=bandwidth.status_text() or 'No transfers in progress')
+
+        # Metrics stuff
+        metrics_box = layout.box()
+        row = metrics_box.row()
+        row.label(text='Statistics of Blender Cloud calls and transfers', icon='TIME')
+        row.operator('pillar.metrics_dump', text='', icon='FILE_TEXT')
+        row.operator('pillar.metrics_reset', text='', icon='X')
+        sub = metrics_box.column(align=True)
+        summary_lines = metrics.registry.summary_lines()
+        for line in summary_lines:
+            sub.label(text=line)
+        if not summary_lines:
+            sub.label(text='Nothing measured yet')
+        row = metrics_box.row()
+        row.prop(self, 'record_traces')
+        row.operator('pillar.trace_dump', icon='FILE_TEXT')
 
         # Blender Sync stuff
         bss = context.window_manager.blender_sync_status
@@ -382,6 +457,8 @@ class PillarCredentialsUpdate(pillar.PillarOperatorMixin,
             self.report({'ERROR'}, 'No active profile found')
             return {'CANCELLED'}
 
+        # Really ask Pillar, rather than trusting an earlier check.
+        session.manager.invalidate()
         try:
             loop = asyncio.get_event_loop()
             loop.run_until_complete(self.check_credentials(context, set()))
@@ -413,6 +490,89 @@ class PILLAR_OT_subscribe(Operator):
         return {'FINISHED'}
 
 
+class PILLAR_OT_texture_store_gc(Operator):
+    """Removes textures from the texture store that are no longer used"""
+    bl_idname = 'pillar.texture_store_gc'
+    bl_label = 'Clean Up Texture Store'
+    bl_description = ('Removes downloaded textures from the texture store that are no '
+                      'longer linked into any texture directory')
+
+    log = logging.getLogger('bpy.ops.%s' % bl_idname)
+
+    def execute(self, context):
+        store = texture_store()
+        removed, freed = store.collect_garbage()
+
+        self.log.info('Removed %i files (%s) from %s', removed, utils.sizeof_fmt(freed), store)
+        self.report({'INFO'}, 'Removed %i unused textures, freeing %s'
+                    % (removed, utils.sizeof_fmt(freed)))
+        return {'FINISHED'}
+
+
+class PILLAR_OT_metrics_dump(Operator):
+    """Writes the statistics of Blender Cloud calls and transfers to a JSON file"""
+    bl_idname = 'pillar.metrics_dump'
+    bl_label = 'Save Statistics'
+    bl_description = ('Writes the number of calls, errors, latencies and bytes transferred '
+                      'per Blender Cloud operation to a JSON file')
+
+    log = logging.getLogger('bpy.ops.%s' % bl_idname)
+
+    def execute(self, context):
+        import time
+
+        filename = time.strftime('metrics-%Y%m%d-%H%M%S.json')
+        path = os.path.join(cache.cache_directory('metrics'), filename)
+        try:
+            metrics.registry.dump(path)
+        except OSError as ex:
+            self.log.exception('Unable to write %s', path)
+            self.report({'ERROR'}, 'Unable to write statistics: %s' % ex)
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, 'Statistics written to %s' % path)
+        return {'FINISHED'}
+
+
+class PILLAR_OT_metrics_reset(Operator):
+    """Forgets the statistics of Blender Cloud calls and transfers"""
+    bl_idname = 'pillar.metrics_reset'
+    bl_label = 'Reset Statistics'
+
+    def execute(self, context):
+        metrics.registry.reset()
+        return {'FINISHED'}
+
+
+class PILLAR_OT_trace_dump(Operator):
+    """Writes the recorded traces to a JSON file"""
+    bl_idname = 'pillar.trace_dump'
+    bl_label = 'Save Trace'
+    bl_description = ('Writes the recorded traces to a JSON file, which can be opened in '
+                      'chrome://tracing or https://ui.perfetto.dev/')
+
+    log = logging.getLogger('bpy.ops.%s' % bl_idname)
+
+    @classmethod
+    def poll(cls, context):
+        return bool(tracing.tracer.spans())
+
+    def execute(self, context):
+        import time
+
+        filename = time.strftime('trace-%Y%m%d-%H%M%S.json')
+        path = os.path.join(cache.cache_directory('traces'), filename)
+        try:
+            tracing.tracer.dump(path)
+        except OSError as ex:
+            self.log.exception('Unable to write %s', path)
+            self.report({'ERROR'}, 'Unable to write trace: %s' % ex)
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, 'Trace written to %s' % path)
+        return {'FINISHED'}
+
+
 class PILLAR_OT_projects(async_loop.AsyncModalOperatorMixin,
                          pillar.PillarOperatorMixin,
                          Operator):
@@ -489,6 +649,30 @@ def preferences() -> BlenderCloudPreferences:
     return bpy.context.user_preferences.addons[ADDON_NAME].preferences
 
 
+def apply_cache_lifetime(prefs: BlenderCloudPreferences):
+    pillar.freshness_ttl = prefs.cache_lifetime_hours * 3600.0
+
+
+def apply_bandwidth_limits(prefs: BlenderCloudPreferences):
+    bandwidth.set_limits(prefs.interactive_bandwidth_limit * 1024 * 1024,
+                         prefs.background_bandwidth_limit * 1024 * 1024)
+
+
+def apply_tracing(prefs: BlenderCloudPreferences):
+    tracing.tracer.enabled = prefs.record_traces
+
+
+def texture_store() -> blob_store.BlobStore:
+    """Returns the store that downloaded textures are kept in."""
+
+    store_dir = preferences().texture_store_dir
+    if store_dir:
+        store_dir = bpy.path.abspath(store_dir)
+    else:
+        store_dir = cache.cache_directory('texture_store')
+    return blob_store.BlobStore(store_dir)
+
+
 def load_custom_icons():
     global icons
 
@@ -528,10 +712,17 @@ def register():
     bpy.utils.register_class(PillarCredentialsUpdate)
     bpy.utils.register_class(SyncStatusProperties)
     bpy.utils.register_class(PILLAR_OT_subscribe)
+    bpy.utils.register_class(PILLAR_OT_texture_store_gc)
+    bpy.utils.register_class(PILLAR_OT_metrics_dump)
+    bpy.utils.register_class(PILLAR_OT_metrics_reset)
+    bpy.utils.register_class(PILLAR_OT_trace_dump)
     bpy.utils.register_class(PILLAR_OT_projects)
     bpy.utils.register_class(PILLAR_PT_image_custom_properties)
 
     addon_prefs = preferences()
+    apply_cache_lifetime(addon_prefs)
+    apply_bandwidth_limits(addon_prefs)
+    apply_tracing(addon_prefs)
 
     WindowManager.last_blender_cloud_location = StringProperty(
         name="Last Blender Cloud browser location",
@@ -562,6 +753,10 @@ def unregister():
     bpy.utils.unregister_class(BlenderCloudPreferences)
     bpy.utils.unregister_class(SyncStatusProperties)
     bpy.utils.unregister_class(PILLAR_OT_subscribe)
+    bpy.utils.unregister_class(PILLAR_OT_texture_store_gc)
+    bpy.utils.unregister_class(PILLAR_OT_metrics_dump)
+    bpy.utils.unregister_class(PILLAR_OT_metrics_reset)
+    bpy.utils.unregister_class(PILLAR_OT_trace_dump)
     bpy.utils.unregister_class(PILLAR_OT_projects)
     bpy.utils.unregister_class(PILLAR_PT_image_custom_properties)
 
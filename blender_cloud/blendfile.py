@@ -41,8 +41,17 @@ def open_blend(filename, access="rb"):
     """Opens a blend file for reading or writing pending on the access
     supports 2 kind of blend files. Uncompressed and compressed.
     Known issue: does not support packaged blend files
+
+    'filename' can also be a seekable file object opened for reading, such
+    as a remote_file.HTTPRangeReader. In that case 'access' is ignored, and
+    compressed files are decompressed to a temporary file.
     """
-    handle = open(filename, access)
+    is_file_object = hasattr(filename, 'read')
+    if is_file_object:
+        handle = filename
+        filename = getattr(handle, 'name', None)
+    else:
+        handle = open(filename, access)
     magic_test = b"BLENDER"
     magic = handle.read(len(magic_test))
     if magic == magic_test:
@@ -54,18 +63,26 @@ def open_blend(filename, access="rb"):
         return bfile
     elif magic[:2] == b'\x1f\x8b':
         log.debug("gzip blendfile detected")
-        handle.close()
         log.debug("decompressing started")
-        fs = gzip.open(filename, "rb")
+        if is_file_object:
+            handle.seek(0, os.SEEK_SET)
+            fs = gzip.GzipFile(fileobj=handle, mode="rb")
+        else:
+            handle.close()
+            fs = gzip.open(filename, "rb")
         data = fs.read(FILE_BUFFER_SIZE)
         magic = data[:len(magic_test)]
         if magic == magic_test:
+            fs_source = handle
             handle = tempfile.TemporaryFile()
             while data:
                 handle.write(data)
                 data = fs.read(FILE_BUFFER_SIZE)
             log.debug("decompressing finished")
             fs.close()
+            if is_file_object:
+                # GzipFile doesn't close file objects it didn't open itself.
+                fs_source.close()
             log.debug("resetting decompressed file")
             handle.seek(os.SEEK_SET, 0)
             bfile = BlendFile(handle)
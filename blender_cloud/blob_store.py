@@ -0,0 +1,217 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Content-addressed store for downloaded files.
+
+Every Cloud file is downloaded into the store once, and linked from there
+into the texture directories that use it. The store has this layout:
+
+    objects/<first two chars of uuid>/<uuid>-<md5><ext>   the file itself ("blob")
+    objects/.../<uuid>-<md5><ext>.headers                 download_to_file() header store
+    refs/<uuid>-<md5><ext>.json                           paths the blob was linked to
+
+Destinations are hardlinked to the blob when possible. Otherwise a reflink
+(copy-on-write clone) is tried, then a symlink, and finally a plain copy.
+Hardlinks share the file data, so a texture that is modified in place is
+modified in every directory that links to it.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+# ioctl request code of FICLONE on Linux, see ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+
+class BlobStore:
+    """Content-addressed store in a directory, keyed by file UUID and MD5.
+
+    link() may be called from several threads at once.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._refs_lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.root)
+
+    def blob_path(self, file_uuid: str, md5: str = None, ext: str = '') -> str:
+        """Returns the path of the blob for this file.
+
+        :param md5: the MD5 from the File document; documents without one
+            are only keyed by their UUID.
+        :param ext: file extension, including the period.
+        """
+
+        name = '%s-%s%s' % (file_uuid, md5.lower(), ext) if md5 else file_uuid + ext
+        return os.path.join(self.root, 'objects', file_uuid[:2], name)
+
+    def _refs_path(self, blob_path: str) -> str:
+        return os.path.join(self.root, 'refs', os.path.basename(blob_path) + '.json')
+
+    def _load_refs(self, blob_path: str) -> list:
+        try:
+            with open(self._refs_path(blob_path), 'r') as infile:
+                return json.load(infile)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as ex:
+            log.warning('Unable to load references of %s, ignoring: %s', blob_path, ex)
+            return []
+
+    def _save_refs(self, blob_path: str, refs: list):
+        refs_path = self._refs_path(blob_path)
+        os.makedirs(os.path.dirname(refs_path), exist_ok=True)
+        with open(refs_path, 'w') as outfile:
+            json.dump(sorted(refs), outfile, indent=1)
+
+    def link(self, blob_path: str, destination: str) -> str:
+        """Makes the file at destination have the contents of the blob.
+
+        An existing file at destination is replaced.
+
+        :returns: how the file was placed: 'existing', 'hardlink', 'reflink',
+            'symlink', or 'copy'.
+        """
+
+        destination = os.path.abspath(destination)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        if os.path.lexists(destination):
+            # A file we didn't place there ourselves is replaced, even when it
+            # has the same contents, so that it no longer takes up space.
+            placed_before = destination in self._load_refs(blob_path)
+            if _same_file(destination, blob_path) or (
+                    placed_before and refers_to(destination, blob_path)):
+                self._add_ref(blob_path, destination)
+                return 'existing'
+            os.unlink(destination)
+
+        for method, link_func in (('hardlink', os.link),
+                                  ('reflink', _reflink),
+                                  ('symlink', os.symlink)):
+            try:
+                link_func(blob_path, destination)
+            except (OSError, NotImplementedError) as ex:
+                log.debug('Unable to %s %s to %s: %s', method, blob_path, destination, ex)
+                continue
+            break
+        else:
+            method = 'copy'
+            shutil.copyfile(blob_path, destination)
+
+        log.debug('Placed %s at %s using %s', blob_path, destination, method)
+        self._add_ref(blob_path, destination)
+        return method
+
+    def _add_ref(self, blob_path: str, destination: str):
+        with self._refs_lock:
+            refs = self._load_refs(blob_path)
+            if destination not in refs:
+                refs.append(destination)
+                self._save_refs(blob_path, refs)
+
+    def blobs(self):
+        """Generator, yields the paths of all blobs in the store."""
+
+        objects_dir = os.path.join(self.root, 'objects')
+        for dirpath, _, filenames in os.walk(objects_dir):
+            for filename in filenames:
+                if filename.endswith(('.headers', '.part', '.part.json')):
+                    continue
+                yield os.path.join(dirpath, filename)
+
+    def collect_garbage(self, *, dry_run=False) -> tuple:
+        """Removes blobs that are no longer referenced by any destination.
+
+        A destination still references its blob when it is a hardlink or
+        symlink to it, or when it is a copy (or reflink) of the same size.
+
+        :returns: (number of blobs removed, number of bytes freed).
+        """
+
+        removed = freed = 0
+        for blob_path in list(self.blobs()):
+            refs = self._load_refs(blob_path)
+            alive = [dest for dest in refs if refers_to(dest, blob_path)]
+            if alive:
+                if alive != refs and not dry_run:
+                    self._save_refs(blob_path, alive)
+                continue
+
+            size = os.path.getsize(blob_path)
+            log.info('%s unreferenced blob %s (%i bytes)',
+                     'Would remove' if dry_run else 'Removing', blob_path, size)
+            removed += 1
+            freed += size
+            if dry_run:
+                continue
+
+            for path in (blob_path, blob_path + '.headers', self._refs_path(blob_path)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+        return removed, freed
+
+
+def refers_to(destination: str, blob_path: str) -> bool:
+    """Returns whether the file at destination was placed there from the blob."""
+
+    if _same_file(destination, blob_path):
+        return True
+    try:
+        return os.path.getsize(destination) == os.path.getsize(blob_path)
+    except OSError:
+        return False
+
+
+def _same_file(destination: str, blob_path: str) -> bool:
+    """Returns whether destination is a hardlink or symlink to the blob."""
+
+    try:
+        if os.path.islink(destination):
+            return os.path.realpath(destination) == os.path.realpath(blob_path)
+        return os.path.samefile(destination, blob_path)
+    except OSError:
+        return False
+
+
+def _reflink(source: str, destination: str):
+    """Clones the source file, sharing its data until either is modified."""
+
+    if not sys.platform.startswith('linux'):
+        raise NotImplementedError('reflinks are only supported on Linux')
+
+    import fcntl
+
+    with open(source, 'rb') as infile, open(destination, 'wb') as outfile:
+        try:
+            fcntl.ioctl(outfile.fileno(), _FICLONE, infile.fileno())
+        except OSError:
+            outfile.close()
+            os.unlink(destination)
+            raise
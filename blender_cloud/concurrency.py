@@ -0,0 +1,474 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Adaptive concurrency limiting for calls to Pillar.
+
+The AdaptiveLimiter behaves like an asyncio.Semaphore whose size is adjusted
+based on the observed latency and errors. The size grows additively while
+latency stays close to the baseline, and shrinks multiplicatively when
+latency spikes or when the server signals that it is overloaded.
+
+Waiting operations are served in order of their Priority, so that the texture
+the user just clicked doesn't have to wait for off-screen thumbnails.
+"""
+
+import asyncio
+import enum
+import heapq
+import itertools
+import logging
+import time
+
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+
+class Priority(enum.IntEnum):
+    """Priority classes for Pillar calls and downloads; lower values go first."""
+
+    INTERACTIVE = 0  # the user explicitly requested this and is waiting for it.
+    VISIBLE = 1  # shown on screen, like thumbnails in the texture browser.
+    PREFETCH = 2  # may be shown soon.
+    BACKGROUND = 3  # nobody is waiting for this.
+
+
+def _any_exception_is_overload(exception: BaseException) -> bool:
+    return True
+
+
+class AdaptiveLimiter:
+    """Limits the number of concurrent operations, adapting the limit to latency.
+
+    Use as `async with limiter.slot(priority): ...`. Exceptions raised
+    inside the block are passed to `is_overload`; when it returns True the
+    limit is decreased. Cancellation never affects the limit.
+
+    Waiters are woken in order of priority, FIFO within the same priority.
+    Operations with a priority lower than VISIBLE cannot take the last
+    `reserved_slots` slots, so that there is always room for an interactive
+    operation without having to wait for background work to finish.
+
+    :param name: used in log messages.
+    :param initial_limit: the limit to start with.
+    :param min_limit: the limit never drops below this.
+    :param max_limit: the limit never grows above this.
+    :param tolerance: when the smoothed latency grows larger than
+        `tolerance` times the baseline latency, the limit is decreased.
+        Comparing the smoothed latency, rather than single samples, keeps
+        naturally varying latencies from being mistaken for congestion.
+    :param backoff: factor the limit is multiplied with on a spike or overload.
+    :param reserved_slots: number of slots that PREFETCH and BACKGROUND
+        operations cannot use; ignored when the limit is not larger than this.
+    :param is_overload: function that receives an exception raised inside a
+        slot, and returns whether it signals overload of the server.
+    :param clock: function returning monotonic time in seconds; for testing.
+    """
+
+    def __init__(self, name: str, *,
+                 initial_limit=3, min_limit=1, max_limit=16,
+                 tolerance=2.0, backoff=0.7, reserved_slots=1,
+                 is_overload=_any_exception_is_overload,
+                 clock=time.monotonic):
+        assert 1 <= min_limit <= initial_limit <= max_limit
+        assert 0.0 < backoff < 1.0
+
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.reserved_slots = reserved_slots
+        self.is_overload = is_overload
+        self.clock = clock
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiters = []  # heap of (priority, sequence number, future) tuples.
+        self._sequence = itertools.count()
+
+        # Baseline latency: tracks the minimum, slowly drifting upward so
+        # that a permanent change in network conditions is picked up.
+        self._baseline_latency = None
+        self._smoothed_latency = None
+        self._last_decrease = float('-inf')
+
+    @property
+    def limit(self) -> int:
+        """The current maximum number of concurrent operations."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        """The number of operations currently holding a slot."""
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of operations waiting for a slot."""
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    def queue_depth_for(self, priority: Priority) -> int:
+        """The number of operations of the given priority waiting for a slot."""
+        return sum(1 for prio, _, fut in self._waiters if prio == priority and not fut.done())
+
+    def __repr__(self):
+        return '<%s %r limit=%i in_flight=%i queued=%i>' % (
+            type(self).__name__, self.name, self.limit, self._in_flight, self.queue_depth)
+
+    def slot(self, priority=Priority.VISIBLE) -> '_Slot':
+        """Returns an async context manager that holds a slot while active."""
+        return _Slot(self, priority)
+
+    def _has_room_for(self, priority: Priority) -> bool:
+        limit = self.limit
+        if priority > Priority.VISIBLE and limit > self.reserved_slots:
+            limit -= self.reserved_slots
+        return self._in_flight < limit
+
+    def _has_waiters_before(self, priority: Priority) -> bool:
+        return any(prio <= priority and not fut.done() for prio, _, fut in self._waiters)
+
+    async def acquire(self, priority=Priority.VISIBLE) -> float:
+        """Waits for a free slot.
+
+        :returns: the start time, to be passed to release().
+        """
+
+        if self._has_room_for(priority) and not self._has_waiters_before(priority):
+            self._in_flight += 1
+            return self.clock()
+
+        # The future is created here rather than in the constructor, so that
+        # it's bound to the loop that is running at the time of the call.
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), fut))
+        try:
+            with tracing.span('wait for %s slot' % self.name, 'limiter',
+                              priority=Priority(priority).name):
+                await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We were handed a slot, but got cancelled before using it.
+                self._in_flight -= 1
+                self._wake_waiters()
+            else:
+                self._remove_cancelled_waiters()
+            raise
+
+        return self.clock()
+
+    def _remove_cancelled_waiters(self):
+        self._waiters = [entry for entry in self._waiters if not entry[2].done()]
+        heapq.heapify(self._waiters)
+
+    def release(self, start_time: float, *, overloaded=False, record_latency=True,
+                response_time: float = None):
+        """Releases a slot and updates the limit.
+
+        :param start_time: the value returned by acquire().
+        :param overloaded: whether the operation signalled server overload.
+        :param record_latency: whether the latency of this operation should
+            be used to update the limit; set to False for cancelled operations.
+        :param response_time: clock() value at which the server responded.
+            When given, the latency is measured up to then, rather than up
+            to now, so that the time spent transferring a large response
+            isn't mistaken for a latency spike.
+        """
+
+        self._in_flight -= 1
+        now = self.clock()
+
+        if overloaded:
+            self._decrease(now, 'overload')
+        elif record_latency:
+            end_time = now if response_time is None else response_time
+            self._sample_latency(now, end_time - start_time)
+
+        self._wake_waiters()
+
+    def _sample_latency(self, now: float, latency: float):
+        if self._baseline_latency is None or latency < self._baseline_latency:
+            self._baseline_latency = latency
+        else:
+            self._baseline_latency += (latency - self._baseline_latency) * 0.01
+
+        if self._smoothed_latency is None:
+            self._smoothed_latency = latency
+        else:
+            self._smoothed_latency += (latency - self._smoothed_latency) * 0.2
+
+        if self._smoothed_latency > self._baseline_latency * self.tolerance:
+            self._decrease(now, 'smoothed latency %.3f s > %.1f * %.3f s baseline' % (
+                self._smoothed_latency, self.tolerance, self._baseline_latency))
+            return
+
+        # Only grow when we actually use the current limit; otherwise the
+        # limit would grow without bound while the application is idle.
+        if self._in_flight + 1 < self.limit:
+            return
+        old_limit = self.limit
+        self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+        if self.limit != old_limit:
+            log.debug('%s: increasing limit to %i', self.name, self.limit)
+
+    def _decrease(self, now: float, reason: str):
+        # Decrease at most once per smoothed latency, so that a burst of
+        # failures of concurrent operations counts as a single event.
+        window = self._smoothed_latency or 0.0
+        if now - self._last_decrease < window:
+            return
+        self._last_decrease = now
+
+        old_limit = self.limit
+        self._limit = max(float(self.min_limit), self._limit * self.backoff)
+        log.debug('%s: decreasing limit %i -> %i due to %s',
+                  self.name, old_limit, self.limit, reason)
+
+    def _wake_waiters(self):
+        while self._waiters:
+            priority, _, fut = self._waiters[0]
+            if fut.done():
+                heapq.heappop(self._waiters)
+                continue
+            # Strict priority: when the most urgent waiter can't run yet,
+            # less urgent ones have to wait too.
+            if not self._has_room_for(priority):
+                break
+            heapq.heappop(self._waiters)
+            self._in_flight += 1
+            fut.set_result(None)
+
+
+class _Slot:
+    """Async context manager returned by AdaptiveLimiter.slot()."""
+
+    def __init__(self, limiter: AdaptiveLimiter, priority: Priority):
+        self.limiter = limiter
+        self.priority = priority
+        self.start_time = None
+        self.response_time = None
+        self.record_latency = True
+
+    def skip_latency(self):
+        """Keeps the latency of this operation from updating the limit.
+
+        Use this for operations that didn't reach the server, for example
+        because they were served from a cache.
+        """
+
+        self.record_latency = False
+
+    def response_started(self):
+        """Marks the arrival of the response headers.
+
+        The latency that the limiter adapts to is then measured up to this
+        moment; only the first call counts.
+        """
+
+        if self.response_time is None:
+            self.response_time = self.limiter.clock()
+
+    async def __aenter__(self):
+        self.start_time = await self.limiter.acquire(self.priority)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.limiter.release(self.start_time, record_latency=self.record_latency,
+                                 response_time=self.response_time)
+        elif issubclass(exc_type, asyncio.CancelledError):
+            self.limiter.release(self.start_time, record_latency=False)
+        else:
+            self.limiter.release(self.start_time,
+                                 overloaded=self.limiter.is_overload(exc_val))
+        return False
+
+
+class SingleFlight:
+    """Coalesces concurrent identical operations into one.
+
+    While an operation with a certain key is running, other calls with the
+    same key wait for it and receive the same result (or exception),
+    instead of starting the operation again.
+
+    Callers that are cancelled while waiting don't cancel the shared
+    operation, as other callers may still be waiting for it.
+
+    :param copy_result: function returning a copy of the result, for the
+        callers that joined; use it when callers may modify the result.
+        By default all callers receive the same object.
+    """
+
+    def __init__(self, name: str, *, copy_result: callable = None):
+        self.name = name
+        self.copy_result = copy_result
+        self._in_flight = {}  # mapping from key to asyncio.Task.
+
+        self.calls = 0  # number of calls to run().
+        self.deduplicated = 0  # number of those calls that joined an operation in flight.
+
+    def __repr__(self):
+        return '<%s %r calls=%i deduplicated=%i in_flight=%i>' % (
+            type(self).__name__, self.name, self.calls, self.deduplicated, len(self._in_flight))
+
+    @property
+    def in_flight(self) -> int:
+        """The number of distinct operations currently running."""
+        return len(self._in_flight)
+
+    async def run(self, key, coro_func):
+        """Awaits coro_func(), or joins the already running operation with the same key.
+
+        :param key: hashable key; calls with equal keys are coalesced.
+        :param coro_func: function without arguments returning an awaitable.
+        """
+
+        self.calls += 1
+        try:
+            task = self._in_flight[key]
+        except KeyError:
+            task = asyncio.ensure_future(coro_func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done_task: self._forget(key, done_task))
+            return await asyncio.shield(task)
+
+        self.deduplicated += 1
+        log.debug('%s: joining operation already in flight for %r', self.name, key)
+        result = await asyncio.shield(task)
+        if self.copy_result is not None:
+            return self.copy_result(result)
+        return result
+
+    def _forget(self, key, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+        # Mark the exception as retrieved, to prevent asyncio from logging it
+        # when all callers were cancelled. Callers still get it via shield().
+        if not task.cancelled():
+            task.exception()
+
+
+class Batcher:
+    """Collects individual lookups for a short time, and performs them as one batch.
+
+    Lookups are grouped; only lookups in the same group are batched
+    together. The batch function is called as `await batch_func(group, keys)`
+    and should return a mapping from key to result. Keys that are missing
+    from that mapping result in None.
+
+    :param window: time in seconds to wait for more lookups before
+        performing the batch.
+    :param max_batch_size: a batch is performed immediately when it
+        reaches this many keys.
+    """
+
+    def __init__(self, name: str, batch_func, *, window=0.02, max_batch_size=50):
+        self.name = name
+        self.batch_func = batch_func
+        self.window = window
+        self.max_batch_size = max_batch_size
+
+        self._pending = {}  # mapping from group to {key: [future, ...]}
+        self._timers = {}  # mapping from group to asyncio.Handle
+        self._tasks = set()  # running batches, so that they aren't garbage collected.
+
+        self.lookups = 0  # number of calls to load().
+        self.batches = 0  # number of calls to batch_func.
+
+    def __repr__(self):
+        return '<%s %r lookups=%i batches=%i>' % (
+            type(self).__name__, self.name, self.lookups, self.batches)
+
+    async def load(self, key, group=None):
+        """Returns the result for this key, performing the lookup in a batch."""
+
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self.lookups += 1
+
+        pending = self._pending.setdefault(group, {})
+        pending.setdefault(key, []).append(fut)
+
+        if len(pending) >= self.max_batch_size:
+            self._flush(group)
+        elif group not in self._timers:
+            self._timers[group] = loop.call_later(self.window, self._flush, group)
+
+        return await fut
+
+    def _flush(self, group):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+
+        pending = self._pending.pop(group, None)
+        if not pending:
+            return
+        task = asyncio.ensure_future(self._run_batch(group, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Cancels all pending lookups and running batches, and waits for the batches."""
+
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+        for pending in self._pending.values():
+            for futures in pending.values():
+                for fut in futures:
+                    fut.cancel()
+        self._pending.clear()
+
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def _run_batch(self, group, pending: dict):
+        # Don't bother looking up keys that nobody is waiting for any more.
+        keys = [key for key, futures in pending.items()
+                if any(not fut.done() for fut in futures)]
+        if not keys:
+            return
+
+        self.batches += 1
+        log.debug('%s: performing batch of %i keys', self.name, len(keys))
+        try:
+            results = await self.batch_func(group, keys)
+        except asyncio.CancelledError:
+            for futures in pending.values():
+                for fut in futures:
+                    fut.cancel()
+            raise
+        except Exception as ex:
+            for futures in pending.values():
+                for fut in futures:
+                    if not fut.done():
+                        fut.set_exception(ex)
+            return
+
+        for key, futures in pending.items():
+            result = results.get(key)
+            for fut in futures:
+                if not fut.done():
+                    fut.set_result(result)
@@ -0,0 +1,287 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Deadlines and timeout budgets of network operations.
+
+A Budget limits the number of seconds spent in each phase of a request:
+setting up the connection, waiting for the first byte of the response,
+waiting between two reads of the response (idle), and the operation as a
+whole (total). Run an operation `with deadline.within(budget):` to give
+it a Deadline. Operations nested inside it, also in tasks started from it,
+get their own Deadline that never expires after the outer one; so the
+thumbnail downloads of a folder listing can't outlive the listing.
+
+The HTTP transports and Pillar calls ask timeout(phase, default) for the
+timeout of every wait, which is the phase's budget capped by the time left
+in total. When the total budget is used up, DeadlineExceeded is raised
+and no more retries are attempted.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import socket
+import threading
+import time
+
+import requests.exceptions
+
+from .tracing import _TaskLocal
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+Budget = collections.namedtuple('Budget', 'connect first_byte idle total')
+Budget.__doc__ = """Maximum number of seconds per phase of an operation; None is unlimited."""
+
+# A single Pillar call, including its retries.
+PILLAR_CALL = Budget(connect=10.0, first_byte=30.0, idle=30.0, total=90.0)
+# A single file download or upload; large files may take long in total.
+DOWNLOAD = Budget(connect=15.0, first_byte=30.0, idle=60.0, total=None)
+UPLOAD = Budget(connect=15.0, first_byte=120.0, idle=60.0, total=None)
+# Listing a folder of textures and downloading all their thumbnails.
+TEXTURE_FOLDER = Budget(connect=None, first_byte=None, idle=None, total=300.0)
+
+# Timeout as (connect, read) for Requests, when no deadline is active.
+DEFAULT_REQUESTS_TIMEOUT = (PILLAR_CALL.connect, PILLAR_CALL.idle)
+
+PHASES = ('connect', 'first_byte', 'idle')
+
+_thread_state = threading.local()
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Raised when the total budget of an operation has been used up."""
+
+
+class Deadline:
+    """The budget of one running operation, limited by the deadline it is nested in.
+
+    :param parent: deadline of the enclosing operation, or None.
+    :param clock: function returning monotonic time in seconds; for testing.
+    """
+
+    def __init__(self, budget: Budget, *, parent: 'Deadline' = None, clock=time.monotonic):
+        if parent is not None:
+            clock = parent.clock
+        self.budget = budget
+        self.clock = clock
+
+        self.expires_at = None if budget.total is None else clock() + budget.total
+        if parent is not None and parent.expires_at is not None:
+            if self.expires_at is None or parent.expires_at < self.expires_at:
+                self.expires_at = parent.expires_at
+
+        # Like the total, phases are limited by the enclosing operation too.
+        self.phases = {}
+        for phase in PHASES:
+            value = getattr(budget, phase)
+            if parent is not None:
+                value = _min(value, parent.phases[phase])
+            self.phases[phase] = value
+
+    def __repr__(self):
+        return '<%s remaining=%s %s>' % (type(self).__name__, self.remaining(), self.phases)
+
+    def remaining(self) -> float:
+        """Returns the number of seconds left in total, or None if unlimited."""
+
+        if self.expires_at is None:
+            return None
+        return self.expires_at - self.clock()
+
+    @property
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def timeout(self, phase: str = None) -> float:
+        """Returns the timeout for the phase, capped by the remaining total budget.
+
+        :param phase: one of PHASES, or None for just the remaining total.
+        :returns: the timeout in seconds, or None if unlimited.
+        :raises DeadlineExceeded: when the total budget has been used up.
+        """
+
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded('Deadline exceeded by %.1f seconds' % -remaining)
+
+        phase_timeout = self.phases[phase] if phase else None
+        return _min(phase_timeout, remaining)
+
+    def requests_timeout(self) -> tuple:
+        """Returns the (connect, read) timeout to pass to Requests."""
+
+        read_timeout = _max(self.phases['first_byte'], self.phases['idle'])
+        remaining = self.timeout()
+        return (_min(self.phases['connect'], remaining) or DEFAULT_REQUESTS_TIMEOUT[0],
+                _min(read_timeout, remaining) or DEFAULT_REQUESTS_TIMEOUT[1])
+
+
+def _min(a, b):
+    """Returns the smallest of two timeouts, where None is unlimited."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _max(a, b):
+    if a is None or b is None:
+        return a if b is None else b
+    return max(a, b)
+
+
+if contextvars is not None:
+    _current_deadline = contextvars.ContextVar('blender_cloud_deadline', default=None)
+else:
+    # Without contextvars new tasks don't inherit the deadline, so only the
+    # budgets of their own operations apply.
+    _current_deadline = _TaskLocal('blender_cloud_deadline')
+
+
+def current() -> Deadline:
+    """Returns the deadline of the running operation, or None."""
+    return _current_deadline.get()
+
+
+@contextlib.contextmanager
+def within(budget: Budget, *, clock=time.monotonic):
+    """Context manager, runs the block with a deadline nested in the current one."""
+
+    deadline = Deadline(budget, parent=current(), clock=clock)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+@contextlib.contextmanager
+def detached():
+    """Context manager, runs the block without a deadline, even inside an operation.
+
+    For work shared by several operations, which shouldn't be cut short
+    by the deadline of the one that happened to start it.
+    """
+
+    token = _current_deadline.set(None)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+def budgeted(budget: Budget):
+    """Decorator that runs every call of a coroutine function within the budget."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with within(budget):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timeout(phase: str = None, default: float = None) -> float:
+    """Returns the timeout for the phase of the current operation.
+
+    :param default: the timeout to use when the deadline doesn't limit the
+        phase; a shorter deadline takes precedence.
+    :raises DeadlineExceeded: when the total budget has been used up.
+    """
+
+    deadline = current()
+    if deadline is None:
+        return default
+    return _min(default, deadline.timeout(phase))
+
+
+async def wait_for(awaitable, phase: str = None, default: float = None):
+    """Awaits with the timeout of the phase, see timeout().
+
+    :raises DeadlineExceeded: when the total budget ran out while waiting.
+    :raises asyncio.TimeoutError: when the phase took too long.
+    """
+
+    deadline = current()
+    try:
+        seconds = timeout(phase, default)
+    except DeadlineExceeded:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()  # prevent a 'never awaited' warning.
+        raise
+
+    try:
+        return await asyncio.wait_for(awaitable, seconds)
+    except asyncio.TimeoutError:
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded('Deadline exceeded while waiting for %s'
+                                   % (phase or 'completion'))
+        raise
+
+
+def remaining() -> float:
+    """Returns the seconds left for the current operation, or None if unlimited."""
+
+    deadline = current()
+    if deadline is None:
+        return None
+    return deadline.remaining()
+
+
+def requests_timeout() -> tuple:
+    """Returns the (connect, read) timeout for Requests calls made by this thread.
+
+    Executor threads don't see the deadline of the task that started them;
+    use call_with_requests_timeout() to hand it over.
+    """
+    return getattr(_thread_state, 'requests_timeout', DEFAULT_REQUESTS_TIMEOUT)
+
+
+def call_with_requests_timeout(func: callable):
+    """Returns a function that calls func() with the current deadline's Requests timeout.
+
+    Call this in the task; the returned function can run in another thread.
+    """
+
+    deadline = current()
+    request_timeout = deadline.requests_timeout() if deadline else DEFAULT_REQUESTS_TIMEOUT
+
+    def call():
+        _thread_state.requests_timeout = request_timeout
+        try:
+            return func()
+        finally:
+            del _thread_state.requests_timeout
+
+    return call
+
+
+def is_timeout(exception: BaseException) -> bool:
+    """Returns True when the exception was caused by a timeout."""
+    return isinstance(exception, (asyncio.TimeoutError, socket.timeout,
+                                  requests.exceptions.Timeout))
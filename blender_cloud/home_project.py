@@ -20,12 +20,14 @@ import logging
 
 import pillarsdk
 from pillarsdk import exceptions as sdk_exceptions
+from . import tracing
 from .pillar import pillar_call
 
 log = logging.getLogger(__name__)
 HOME_PROJECT_ENDPOINT = '/bcloud/home-project'
 
 
+@tracing.coroutine_span('pillar')
 async def get_home_project(params=None) -> pillarsdk.Project:
     """Returns the home project."""
 
@@ -0,0 +1,576 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""HTTP transports for downloading and uploading files.
+
+AsyncioTransport is a small HTTP/1.1 client on top of asyncio streams, with
+a keep-alive connection pool. Requests run on the event loop itself instead
+of in executor threads, so cancelling the task cancels the transfer
+immediately. RequestsTransport offers the same interface on top of a
+requests.Session, and is used when a proxy is configured.
+
+Both produce responses with a `status_code`, `headers`, `raise_for_status()`,
+`read_chunk()`, `read()` and `close()`.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import ssl
+import time
+import urllib.parse
+import urllib.request
+
+import requests
+import requests.certs
+import requests.structures
+
+from . import deadline
+
+log = logging.getLogger(__name__)
+
+USER_AGENT = 'blender-cloud-addon'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+MAX_HEADER_COUNT = 100
+SEND_BLOCK_SIZE = 256 * 1024
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+# Bodies of redirects up to this size are read, so that the connection can be reused.
+MAX_DISCARDED_BODY = 64 * 1024
+
+
+class TransportError(IOError):
+    """Raised when the connection fails or the server sends an invalid response."""
+
+
+class ConnectError(TransportError):
+    """Raised when no connection could be set up with the server."""
+
+
+class HTTPError(IOError):
+    """Raised by raise_for_status() for 3xx (except 304), 4xx and 5xx responses."""
+
+    def __init__(self, response: 'Response'):
+        super().__init__('%i %s for url: %s' % (response.status_code, response.reason,
+                                                response.url))
+        self.response = response
+
+
+class Response:
+    """Response of an AsyncioTransport request.
+
+    The body is streamed from the connection; call close() (or use as
+    context manager) when done, to return the connection to the pool.
+    """
+
+    def __init__(self, transport: 'AsyncioTransport', connection: '_Connection',
+                 method: str, url: str, http_version: str,
+                 status_code: int, reason: str, headers: requests.structures.CaseInsensitiveDict):
+        self.transport = transport
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+
+        self._connection = connection
+        self._keep_alive = (http_version == 'HTTP/1.1'
+                            and headers.get('Connection', '').lower() != 'close')
+        self._chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        self._chunk_left = 0
+        self._remaining = None  # None means "read until EOF".
+        self._done = False
+
+        if (method == 'HEAD' or status_code in {204, 304} or 100 <= status_code < 200):
+            self._finish()
+        elif not self._chunked and 'Content-Length' in headers:
+            self._remaining = int(headers['Content-Length'])
+            if not self._remaining:
+                self._finish()
+        elif not self._chunked:
+            self._keep_alive = False
+
+    def __repr__(self):
+        return '<%s [%i] %s>' % (type(self).__name__, self.status_code, self.url)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def raise_for_status(self):
+        if _is_error_status(self.status_code):
+            raise HTTPError(self)
+
+    async def read_chunk(self, max_size=64 * 1024) -> bytes:
+        """Returns the next part of the body, or b'' when the body has been read completely."""
+
+        if self._done:
+            return b''
+
+        try:
+            if self._chunked:
+                data = await self._read_chunked(max_size)
+            elif self._remaining is not None:
+                data = await self._read(min(max_size, self._remaining))
+                if not data:
+                    raise TransportError('Connection closed with %i bytes left to read'
+                                         % self._remaining)
+                self._remaining -= len(data)
+                if not self._remaining:
+                    self._finish()
+            else:
+                data = await self._read(max_size)
+                if not data:
+                    self._finish()
+        except BaseException:
+            self.close()
+            raise
+        return data
+
+    async def read(self) -> bytes:
+        """Reads the entire body."""
+
+        parts = []
+        while True:
+            data = await self.read_chunk()
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+    async def json(self):
+        body = await self.read()
+        return json.loads(body.decode('utf8'))
+
+    def close(self):
+        """Releases the connection; closes it when the body wasn't read completely."""
+
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        if self._done and self._keep_alive:
+            self.transport._release(connection)
+        else:
+            connection.close()
+
+    async def _read(self, size: int) -> bytes:
+        return await deadline.wait_for(self._connection.reader.read(size),
+                                       'idle', self.transport.read_timeout)
+
+    async def _readline(self) -> bytes:
+        return await deadline.wait_for(self._connection.reader.readline(),
+                                       'idle', self.transport.read_timeout)
+
+    async def _read_chunked(self, max_size: int) -> bytes:
+        if not self._chunk_left:
+            size_line = await self._readline()
+            try:
+                self._chunk_left = int(size_line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise TransportError('Invalid chunk size %r' % size_line)
+
+            if not self._chunk_left:
+                # Skip trailers up to and including the final empty line.
+                while (await self._readline()) not in {b'\r\n', b'\n', b''}:
+                    pass
+                self._finish()
+                return b''
+
+        data = await self._read(min(max_size, self._chunk_left))
+        if not data:
+            raise TransportError('Connection closed in the middle of a chunk')
+        self._chunk_left -= len(data)
+        if not self._chunk_left:
+            await self._readline()  # CRLF after the chunk data.
+        return data
+
+    def _finish(self):
+        self._done = True
+        self.close()
+
+
+class _Connection:
+    def __init__(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.request_count = 0
+
+    def close(self):
+        self.writer.close()
+
+    def is_usable(self, idle_timeout: float) -> bool:
+        if self.reader.at_eof() or self.reader.exception() is not None:
+            return False
+        return time.monotonic() - self.last_used < idle_timeout
+
+
+class AsyncioTransport:
+    """HTTP/1.1 client on top of asyncio streams, with keep-alive connection pooling.
+
+    :param max_idle_per_host: the maximum number of idle connections kept per host.
+    :param idle_timeout: idle connections older than this (in seconds) are not reused.
+    :param connect_timeout: timeout in seconds for setting up a connection.
+    :param read_timeout: timeout in seconds for every read from the connection.
+    """
+
+    def __init__(self, *, max_idle_per_host=6, idle_timeout=30.0,
+                 connect_timeout=15.0, read_timeout=60.0,
+                 ssl_context: ssl.SSLContext = None):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._ssl_context = ssl_context
+
+        self._idle = collections.defaultdict(list)  # mapping from key to list of connections.
+        self.connections_opened = 0
+
+    def __repr__(self):
+        return '<%s idle=%i opened=%i>' % (type(self).__name__,
+                                           sum(len(conns) for conns in self._idle.values()),
+                                           self.connections_opened)
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        if self._ssl_context is None:
+            # Use the same CA bundle as Requests, as Blender's Python may not
+            # have access to the system certificates.
+            self._ssl_context = ssl.create_default_context(cafile=requests.certs.where())
+        return self._ssl_context
+
+    async def request(self, method: str, url: str, *,
+                      headers: dict = None, body=None) -> Response:
+        """Performs a HTTP request, returning once the response headers are in.
+
+        Redirects are followed, at most MAX_REDIRECTS times. Like Requests
+        does, a 303 (or a 301/302 of a POST) is followed with a GET without
+        body, and the Authorization header isn't sent to other hosts.
+
+        :param body: None, bytes, or an (asynchronous) iterable producing
+            bytes. For an iterable body without a Content-Length header,
+            chunked transfer encoding is used.
+        :raises TransportError: when there are too many redirects, or the
+            body can't be sent again to the redirect's location.
+        """
+
+        headers = requests.structures.CaseInsensitiveDict(headers or {})
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await self._request(method, url, headers=headers, body=body)
+            location = response.headers.get('Location')
+            if response.status_code not in REDIRECT_STATUSES or not location:
+                return response
+            await self._discard(response)
+
+            redirect_url = urllib.parse.urljoin(url, location)
+            log.debug('Following %i redirect from %s to %s',
+                      response.status_code, url, redirect_url)
+
+            if response.status_code == 303 or (response.status_code in {301, 302}
+                                               and method == 'POST'):
+                if method != 'HEAD':
+                    method = 'GET'
+                body = None
+                for header in ('Content-Length', 'Content-Type', 'Transfer-Encoding'):
+                    headers.pop(header, None)
+            elif body is not None and not isinstance(body, (bytes, bytearray)):
+                raise TransportError('Unable to send the request body again to %s'
+                                     % redirect_url)
+
+            if urllib.parse.urlsplit(redirect_url).netloc != urllib.parse.urlsplit(url).netloc:
+                headers.pop('Authorization', None)
+            url = redirect_url
+
+        raise TransportError('Too many redirects, the last one to %s' % url)
+
+    async def _discard(self, response: Response):
+        """Reads a short body so that the connection can be reused, or closes it."""
+
+        try:
+            length = int(response.headers.get('Content-Length', ''))
+        except ValueError:
+            length = None
+        if length is not None and length <= MAX_DISCARDED_BODY:
+            await response.read()
+        response.close()
+
+    async def _request(self, method: str, url: str, *,
+                       headers: dict, body) -> Response:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in DEFAULT_PORTS:
+            raise ValueError('Unsupported URL scheme in %r' % url)
+        key = (parsed.scheme, parsed.hostname, parsed.port or DEFAULT_PORTS[parsed.scheme])
+
+        request_headers = requests.structures.CaseInsensitiveDict({
+            'Host': parsed.netloc.rsplit('@', 1)[-1],
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'identity',
+            'Connection': 'keep-alive',
+        })
+        request_headers.update(headers)
+        if isinstance(body, (bytes, bytearray)):
+            request_headers['Content-Length'] = str(len(body))
+        elif body is not None and 'Content-Length' not in request_headers:
+            request_headers['Transfer-Encoding'] = 'chunked'
+        elif body is None and method in {'POST', 'PUT', 'PATCH'}:
+            request_headers['Content-Length'] = '0'
+
+        target = parsed.path or '/'
+        if parsed.query:
+            target += '?' + parsed.query
+
+        head_lines = ['%s %s HTTP/1.1' % (method, target)]
+        head_lines.extend('%s: %s' % item for item in request_headers.items())
+        head = ('\r\n'.join(head_lines) + '\r\n\r\n').encode('latin1')
+
+        # A pooled connection may have been closed by the server in the meantime.
+        # When that happens before we receive anything, retry on a new connection,
+        # but only when we can send the body again.
+        can_replay = body is None or isinstance(body, (bytes, bytearray))
+        while True:
+            connection, reused = await self._acquire(key, parsed.hostname)
+            try:
+                await self._send(connection, head, body, chunked='Transfer-Encoding'
+                                 in request_headers)
+                status_line = await deadline.wait_for(connection.reader.readline(),
+                                                      'first_byte', self.read_timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                if reused and can_replay:
+                    log.debug('Pooled connection to %s was closed, retrying', key[1])
+                    continue
+                raise TransportError('Connection to %s failed' % key[1])
+            except BaseException:
+                connection.close()
+                raise
+
+            if not status_line and reused and can_replay:
+                connection.close()
+                log.debug('Pooled connection to %s was closed, retrying', key[1])
+                continue
+            break
+
+        try:
+            http_version, status_code, reason = self._parse_status_line(status_line)
+            response_headers = await self._read_headers(connection)
+        except BaseException:
+            connection.close()
+            raise
+
+        connection.request_count += 1
+        return Response(self, connection, method, url, http_version,
+                        status_code, reason, response_headers)
+
+    def close(self):
+        """Closes all idle connections."""
+
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle.clear()
+
+    async def _acquire(self, key: tuple, hostname: str):
+        idle = self._idle[key]
+        while idle:
+            connection = idle.pop()
+            if connection.is_usable(self.idle_timeout):
+                return connection, True
+            connection.close()
+
+        scheme, host, port = key
+        ssl_context = self.ssl_context if scheme == 'https' else None
+        try:
+            reader, writer = await deadline.wait_for(
+                asyncio.open_connection(host, port, ssl=ssl_context,
+                                        server_hostname=hostname if ssl_context else None),
+                'connect', self.connect_timeout)
+        except OSError as ex:
+            raise ConnectError('Unable to connect to %s:%i: %s' % (host, port, ex)) from ex
+
+        self.connections_opened += 1
+        return _Connection(key, reader, writer), False
+
+    def _release(self, connection: _Connection):
+        connection.last_used = time.monotonic()
+        idle = self._idle[connection.key]
+        if len(idle) >= self.max_idle_per_host:
+            connection.close()
+            return
+        idle.append(connection)
+
+    async def _send(self, connection: _Connection, head: bytes, body, *, chunked: bool):
+        writer = connection.writer
+        writer.write(head)
+
+        async def send_block(block: bytes):
+            if not block:
+                return
+            if chunked:
+                writer.write(b'%x\r\n' % len(block))
+            writer.write(block)
+            if chunked:
+                writer.write(b'\r\n')
+            # Draining per block gives flow control and a cancellation point.
+            await deadline.wait_for(writer.drain(), 'idle', self.read_timeout)
+
+        if body is None:
+            pass
+        elif isinstance(body, (bytes, bytearray)):
+            # Sent in blocks, so that the idle timeout applies per block, not to the entire body.
+            for offset in range(0, len(body), SEND_BLOCK_SIZE):
+                await send_block(body[offset:offset + SEND_BLOCK_SIZE])
+        else:
+            # Asynchronous iteration allows the body to wait, for example for throttling.
+            if hasattr(body, '__aiter__'):
+                async for block in body:
+                    await send_block(block)
+            else:
+                for block in body:
+                    await send_block(block)
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+
+        await deadline.wait_for(writer.drain(), 'idle', self.read_timeout)
+
+    @staticmethod
+    def _parse_status_line(status_line: bytes) -> tuple:
+        parts = status_line.decode('latin1').rstrip('\r\n').split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise TransportError('Invalid HTTP status line %r' % status_line)
+        try:
+            status_code = int(parts[1])
+        except ValueError:
+            raise TransportError('Invalid HTTP status line %r' % status_line)
+        reason = parts[2] if len(parts) > 2 else ''
+        return parts[0], status_code, reason
+
+    async def _read_headers(self, connection: _Connection) -> requests.structures.CaseInsensitiveDict:
+        headers = requests.structures.CaseInsensitiveDict()
+        for _ in range(MAX_HEADER_COUNT):
+            line = await deadline.wait_for(connection.reader.readline(),
+                                           'first_byte', self.read_timeout)
+            line = line.decode('latin1').rstrip('\r\n')
+            if not line:
+                return headers
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise TransportError('Invalid HTTP header line %r' % line)
+            name, value = name.strip(), value.strip()
+            if name in headers:
+                headers[name] = '%s, %s' % (headers[name], value)
+            else:
+                headers[name] = value
+        raise TransportError('Too many HTTP headers')
+
+
+class RequestsResponse:
+    """Wraps a streaming requests.Response in the interface of Response."""
+
+    def __init__(self, response: requests.Response):
+        self._response = response
+        self._iterator = None
+        self.url = response.url
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def __repr__(self):
+        return '<%s [%i] %s>' % (type(self).__name__, self.status_code, self.url)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+        # Requests follows redirects, so a redirect here can't be followed.
+        if _is_error_status(self.status_code):
+            raise requests.exceptions.HTTPError(
+                '%i %s for url: %s' % (self.status_code, self.reason, self.url),
+                response=self._response)
+
+    async def read_chunk(self, max_size=64 * 1024) -> bytes:
+        if self._iterator is None:
+            self._iterator = self._response.iter_content(chunk_size=max_size)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, next, self._iterator, b'')
+
+    async def read(self) -> bytes:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: self._response.content)
+
+    async def json(self):
+        body = await self.read()
+        return json.loads(body.decode('utf8'))
+
+    def close(self):
+        self._response.close()
+
+
+class RequestsTransport:
+    """Transport that performs the requests with a requests.Session in executor threads."""
+
+    def __init__(self, session: requests.Session):
+        self.session = session
+
+    async def request(self, method: str, url: str, *,
+                      headers: dict = None, body=None) -> RequestsResponse:
+        loop = asyncio.get_event_loop()
+
+        def perform_request():
+            return self.session.request(method, url, headers=headers, data=body,
+                                        stream=True, verify=True,
+                                        timeout=deadline.requests_timeout())
+
+        try:
+            response = await loop.run_in_executor(
+                None, deadline.call_with_requests_timeout(perform_request))
+        except requests.exceptions.ConnectionError as ex:
+            raise TransportError(str(ex))
+        return RequestsResponse(response)
+
+    def close(self):
+        pass
+
+
+def _is_error_status(status_code: int) -> bool:
+    """Returns True for 4xx and 5xx, and for 3xx other than 304 Not Modified."""
+    return status_code >= 400 or (300 <= status_code < 400 and status_code != 304)
+
+
+def proxies_configured() -> bool:
+    """Returns True when a HTTP(S) proxy is configured in the environment or OS."""
+
+    proxies = urllib.request.getproxies()
+    return bool(proxies.get('http') or proxies.get('https'))
+
+
+def create_transport(session: requests.Session):
+    """Returns an AsyncioTransport, or a RequestsTransport when a proxy is configured.
+
+    :param session: the session used by the RequestsTransport.
+    """
+
+    if proxies_configured():
+        log.info('Proxy configured, using Requests for file transfers')
+        return RequestsTransport(session)
+    return AsyncioTransport()
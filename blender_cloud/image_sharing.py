@@ -194,15 +194,13 @@ class PILLAR_OT_image_share(pillar.PillarOperatorMixin,
         """
 
         self.log.info('Uploading file %s', filename)
-        node = await pillar_call(pillarsdk.Node.create_asset_from_file,
-                                 self.home_project_id,
-                                 self.share_group_id,
-                                 'image',
-                                 filename,
-                                 extra_where={'user': self.user_id},
-                                 always_create_new_node=True,
-                                 fileobj=fileobj,
-                                 caching=False)
+        node = await pillar.upload_asset_file(self.home_project_id,
+                                              self.share_group_id,
+                                              'image',
+                                              filename,
+                                              extra_where={'user': self.user_id},
+                                              always_create_new_node=True,
+                                              fileobj=fileobj)
         node_id = node['_id']
         self.log.info('Created node %s', node_id)
         self.report({'INFO'}, 'File succesfully uploaded to the cloud!')
@@ -0,0 +1,145 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Lightweight listings of Pillar nodes.
+
+pillarsdk decodes every response into nested Resource objects, which is
+slow and takes a lot of memory for folders with many textures, while the
+texture browser only shows a few fields of each node. all_node_records()
+fetches a page of nodes and decodes it with the fastest JSON parser
+available; NodeRecord keeps the fields needed to show a node, and creates
+the full pillarsdk.Node only when the node is opened or downloaded.
+"""
+
+import json
+
+import pillarsdk
+import pillarsdk.utils
+
+from . import deadline
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _json_loads(data):
+    # Python 3.5's json module doesn't accept bytes.
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+# loads(data) decodes a JSON document from bytes or str.
+if orjson is not None:
+    JSON_PARSER = 'orjson'
+    loads = orjson.loads
+elif ujson is not None:
+    JSON_PARSER = 'ujson'
+    loads = ujson.loads
+else:
+    JSON_PARSER = 'json'
+    loads = _json_loads
+
+
+# Keys supported by NodeRecord.__getitem__, mapped to the attribute holding their value.
+_ITEM_ATTRIBUTES = {'_id': 'node_id', 'name': 'name', 'node_type': 'node_type',
+                    'picture': 'picture'}
+
+
+class NodeRecord:
+    """The fields of a node document that are needed to show the node in a listing.
+
+    Supports record['_id'], record['name'], record['node_type'] and
+    record['picture'] like a pillarsdk.Node does; call materialise() for
+    the full node.
+
+    :param document: the node document, as decoded from JSON.
+    """
+
+    __slots__ = ('node_id', 'name', 'node_type', 'order', 'picture', 'first_file',
+                 '_document', '_node')
+
+    def __init__(self, document: dict):
+        properties = document.get('properties') or {}
+        files = properties.get('files') or ()
+
+        self.node_id = document['_id']
+        self.name = document.get('name', '')
+        self.node_type = document.get('node_type')
+        self.order = properties.get('order')  # None when not set.
+        self.picture = document.get('picture')  # file ID, or None.
+        self.first_file = files[0].get('file') if files else None  # file ID, or None.
+
+        self._document = document
+        self._node = None
+
+    def __repr__(self):
+        return '<%s %s %r %s>' % (type(self).__name__, self.node_type, self.name, self.node_id)
+
+    def __getitem__(self, key: str):
+        try:
+            attribute = _ITEM_ATTRIBUTES[key]
+        except KeyError:
+            raise KeyError('%s has no %r, use materialise() for the full node'
+                           % (type(self).__name__, key))
+        return getattr(self, attribute)
+
+    @property
+    def is_materialised(self) -> bool:
+        return self._node is not None
+
+    def materialise(self) -> pillarsdk.Node:
+        """Returns the full node; it's created on the first call."""
+
+        if self._node is None:
+            self._node = pillarsdk.Node(pillarsdk.utils.convert_datetime(self._document))
+            self._document = None  # now owned by the node.
+        return self._node
+
+
+def all_node_records(params: dict = None, api: pillarsdk.Api = None) -> dict:
+    """Like pillarsdk.Node.all(), but returns the page as decoded JSON.
+
+    The items are left as dicts, so that the page can be stored as a
+    snapshot; convert them with NodeRecord. Use with pillar.pillar_call().
+
+    :raises pillarsdk.exceptions.ConnectionError: or one of its subclasses,
+        like pillarsdk.Node.all() does, when Pillar returns an error.
+    """
+
+    api = api or pillarsdk.Api.Default()
+
+    url = pillarsdk.Node.path
+    if params is not None:
+        pillarsdk.Node._ensure_projections(params, pillarsdk.Node.ensure_query_projections)
+        url = pillarsdk.utils.join_url_params(url, params)
+
+    response = api.requests_session.get(pillarsdk.utils.join_url(api.endpoint, url),
+                                        headers=api.headers(),
+                                        timeout=deadline.requests_timeout())
+    if not 200 <= response.status_code <= 299:
+        # Raises the same exception as pillarsdk would.
+        api.handle_response(response, response.text)
+    return loads(response.content)
@@ -0,0 +1,381 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Latency and throughput metrics of Pillar calls and file transfers.
+
+Operations are grouped by kind ('pillar', 'download' or 'upload'),
+endpoint and resource type. For Pillar calls the endpoint is the pillarsdk
+function (like 'find') and the resource type its class (like 'Node'); for
+transfers they are the host name and the file extension.
+
+Per group the number of operations, errors, timeouts and bytes
+transferred are counted, and histograms are kept of the latency, the time
+spent waiting for a concurrency limiter slot, and the time spent waiting
+for a thread of the executor. The latency doesn't include the wait for a limiter slot.
+Every attempt counts as an operation, so retries show up
+as errors followed by another call.
+
+Use `registry.measure(...)` to measure an operation, and
+`registry.snapshot()` or `registry.dump(path)` to get the results.
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+
+from . import deadline, utils
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds. Values above the last
+# bound go into an overflow bucket.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Counts values in buckets with fixed upper bounds.
+
+    Percentiles are estimated as the upper bound of the bucket they fall in,
+    so they are never underestimated.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return '<%s count=%i mean=%.3f max=%.3f>' % (
+            type(self).__name__, self.count, self.mean, self.max)
+
+    def observe(self, value: float):
+        value = max(0.0, value)
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, fraction: float) -> float:
+        """Returns the estimated value below which `fraction` of the values fall.
+
+        :param fraction: between 0.0 and 1.0, so 0.9 for the 90th percentile.
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.bounds, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        buckets = [[bound, bucket_count]
+                   for bound, bucket_count in zip(self.bounds, self.counts)]
+        # JSON has no infinity, so the overflow bucket has no bound.
+        buckets.append([None, self.counts[-1]])
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.mean,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': buckets,
+        }
+
+
+class OperationStats:
+    """Metrics of one group of operations."""
+
+    def __init__(self, kind: str, endpoint: str, resource: str):
+        self.kind = kind
+        self.endpoint = endpoint
+        self.resource = resource
+
+        self.calls = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.timeouts = 0  # errors that were timeouts; also counted as errors.
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.latency = Histogram()
+        self.slot_wait = Histogram()  # waiting for a slot of a concurrency.AdaptiveLimiter.
+        self.executor_wait = Histogram()  # waiting for a thread to run in.
+
+    def __repr__(self):
+        return '<%s %s calls=%i errors=%i>' % (type(self).__name__, self.name,
+                                               self.calls, self.errors)
+
+    @property
+    def name(self) -> str:
+        return '%s %s.%s' % (self.kind, self.resource, self.endpoint)
+
+    def to_dict(self) -> dict:
+        return {
+            'kind': self.kind,
+            'endpoint': self.endpoint,
+            'resource': self.resource,
+            'calls': self.calls,
+            'errors': self.errors,
+            'cancelled': self.cancelled,
+            'timeouts': self.timeouts,
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+            'latency': self.latency.to_dict(),
+            'slot_wait': self.slot_wait.to_dict(),
+            'executor_wait': self.executor_wait.to_dict(),
+        }
+
+    def summary(self) -> str:
+        """Returns a one-line summary for the user."""
+
+        parts = ['%i calls' % self.calls]
+        if self.errors:
+            parts.append('%i errors' % self.errors)
+        if self.timeouts:
+            parts.append('%i timeouts' % self.timeouts)
+        if self.latency.count:
+            parts.append('p50 %s, p90 %s' % (_format_seconds(self.latency.percentile(0.5)),
+                                              _format_seconds(self.latency.percentile(0.9))))
+        if self.slot_wait.max:
+            parts.append('queued %s avg' % _format_seconds(self.slot_wait.mean))
+        transferred = self.bytes_received + self.bytes_sent
+        if transferred:
+            parts.append(utils.sizeof_fmt(transferred))
+        return '%s: %s' % (self.name, ', '.join(parts))
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds < 1.0:
+        return '%.0f ms' % (seconds * 1000)
+    return '%.1f s' % seconds
+
+
+class Measurement:
+    """Context manager returned by Registry.measure().
+
+    Records the latency of the block, and counts an error when it raises
+    an exception. The stats can be updated inside the block, for example
+    with the number of bytes transferred.
+    """
+
+    def __init__(self, stats: OperationStats, clock):
+        self.stats = stats
+        self.clock = clock
+        self.start_time = None
+        self.slot = None  # the limiter slot, when created by Registry.measure_slot().
+
+    def __enter__(self):
+        self.start_time = self.clock()
+        self.stats.calls += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.latency.observe(self.clock() - self.start_time)
+        if exc_type is None:
+            return False
+        if issubclass(exc_type, asyncio.CancelledError):
+            self.stats.cancelled += 1
+            return False
+        self.stats.errors += 1
+        if deadline.is_timeout(exc_val):
+            self.stats.timeouts += 1
+        return False
+
+    def slot_acquired(self):
+        """Records the time spent waiting for a limiter slot.
+
+        Call this right after acquiring the slot; the latency is then
+        measured from that moment, so that it doesn't include queueing.
+        """
+
+        now = self.clock()
+        self.stats.slot_wait.observe(now - self.start_time)
+        self.start_time = now
+
+    def response_started(self):
+        """Marks the arrival of the response headers, for the limiter of the slot.
+
+        Call this for transfers whose duration depends on their size, so
+        that the limiter adapts to the server's latency, not to the size.
+        """
+
+        if self.slot is not None:
+            self.slot.response_started()
+
+    def skip_latency(self):
+        """Keeps the latency from updating the limiter of the slot, see _Slot.skip_latency()."""
+
+        if self.slot is not None:
+            self.slot.skip_latency()
+
+    async def run_in_executor(self, func: callable, executor=None):
+        """Runs func() in the executor, recording how long it waited for a thread."""
+
+        loop = asyncio.get_event_loop()
+        submitted = self.clock()
+        started = []  # list.append() is atomic, so safe to call from the thread.
+
+        def run():
+            started.append(self.clock())
+            return func()
+
+        try:
+            return await loop.run_in_executor(executor, run)
+        finally:
+            if started:
+                self.stats.executor_wait.observe(started[0] - submitted)
+
+
+class _MeasuredSlot:
+    """Async context manager returned by Registry.measure_slot()."""
+
+    def __init__(self, measurement: Measurement, slot):
+        self.measurement = measurement
+        self.slot = slot
+
+    async def __aenter__(self) -> Measurement:
+        self.measurement.__enter__()
+        try:
+            await self.slot.__aenter__()
+        except BaseException:
+            self.measurement.__exit__(*sys.exc_info())
+            raise
+        self.measurement.slot_acquired()
+        self.measurement.slot = self.slot
+        return self.measurement
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            return await self.slot.__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            self.measurement.__exit__(exc_type, exc_val, exc_tb)
+
+
+class Registry:
+    """Collection of OperationStats, one per (kind, endpoint, resource type).
+
+    :param clock: function returning monotonic time in seconds; for testing.
+    """
+
+    def __init__(self, *, clock=time.monotonic):
+        self.clock = clock
+        self._stats = {}
+        self.started_at = time.time()
+
+    def __repr__(self):
+        return '<%s with %i operations>' % (type(self).__name__, len(self._stats))
+
+    def stats(self, kind: str, endpoint: str, resource: str) -> OperationStats:
+        """Returns the stats of the group, creating them when necessary."""
+
+        key = (kind, endpoint, resource)
+        try:
+            return self._stats[key]
+        except KeyError:
+            stats = self._stats[key] = OperationStats(kind, endpoint, resource)
+            return stats
+
+    def measure(self, kind: str, endpoint: str, resource: str) -> Measurement:
+        """Returns a context manager that measures one operation."""
+        return Measurement(self.stats(kind, endpoint, resource), self.clock)
+
+    def measure_slot(self, limiter, priority, kind: str, endpoint: str,
+                     resource: str) -> '_MeasuredSlot':
+        """Returns an async context manager that measures one operation in a limiter slot.
+
+        Use as `async with registry.measure_slot(...) as measurement`; it
+        acquires a slot of the concurrency.AdaptiveLimiter with the given
+        priority, and records how long that took.
+        """
+        return _MeasuredSlot(self.measure(kind, endpoint, resource), limiter.slot(priority))
+
+    def all_stats(self) -> list:
+        """Returns all OperationStats, busiest first."""
+        return sorted(self._stats.values(), key=lambda stats: (-stats.calls, stats.name))
+
+    def reset(self):
+        self._stats.clear()
+        self.started_at = time.time()
+
+    def snapshot(self) -> dict:
+        """Returns all metrics as JSON-compatible dict."""
+
+        return {
+            'started_at': self.started_at,
+            'duration': time.time() - self.started_at,
+            'operations': [stats.to_dict() for stats in self.all_stats()],
+        }
+
+    def dump(self, path: str):
+        """Writes the snapshot to a JSON file."""
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w') as outfile:
+            json.dump(self.snapshot(), outfile, indent=1)
+        log.info('Wrote metrics of %i operations to %s', len(self._stats), path)
+
+    def summary_lines(self, max_lines=8) -> list:
+        """Returns one-line summaries of the busiest operations, for the user."""
+        return [stats.summary() for stats in self.all_stats()[:max_lines]]
+
+
+def resource_type(pillar_func) -> str:
+    """Returns the name of the pillarsdk class a function belongs to, like 'Node'."""
+
+    bound_to = getattr(pillar_func, '__self__', None)
+    if bound_to is None:
+        return getattr(pillar_func, '__module__', None) or '-'
+    if isinstance(bound_to, type):
+        return bound_to.__name__
+    return type(bound_to).__name__
+
+
+def transfer_group(url: str, filename: str = None) -> tuple:
+    """Returns the (endpoint, resource type) of a transfer: the host and the file extension.
+
+    :param filename: name of the file being transferred, when the URL doesn't end in it.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    extension = os.path.splitext(filename or parts.path)[1].lower()
+    return parts.hostname or '-', extension or '-'
+
+
+registry = Registry()
@@ -0,0 +1,411 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Offline mode, for when the Blender Cloud cannot be reached.
+
+While online, the responses of Pillar calls that the texture browser needs
+are stored as snapshots. When a call fails because the Cloud (or the proxy
+in front of it) can't be reached, the addon goes offline: snapshots are
+served instead, without any network traffic, until a probe shows that the
+Cloud can be reached again. Downloads that can't be served from the cache
+are queued, and started as soon as the Cloud is back.
+
+Probing only opens a TCP connection to the server (or to the HTTP proxy),
+so that it detects connectivity loss within PROBE_TIMEOUT seconds.
+"""
+
+import asyncio
+import collections
+import errno
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import urllib.parse
+import urllib.request
+
+import requests
+import pillarsdk.utils
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from . import deadline, http_transport
+
+log = logging.getLogger(__name__)
+
+PROBE_TIMEOUT = 3.0
+PROBE_INTERVAL = 30.0
+
+# Snapshots saved within this many seconds are written to disk together.
+SNAPSHOT_WRITE_DELAY = 1.0
+
+# Error numbers of OSErrors that mean the network can't reach the server.
+_UNREACHABLE_ERRNOS = frozenset(getattr(errno, name) for name in
+                                ('ENETUNREACH', 'ENETDOWN', 'EHOSTUNREACH', 'EHOSTDOWN')
+                                if hasattr(errno, name))
+
+
+class OfflineError(IOError):
+    """Raised when the Cloud is unreachable, and the requested data isn't cached."""
+
+
+def is_connectivity_error(exception: BaseException) -> bool:
+    """Returns True when the exception means that the Cloud could not be reached.
+
+    Only failures to set up a connection count: the host name couldn't be
+    resolved, the connection was refused, or the network is unreachable.
+    OfflineError counts too. Timeouts, overloaded servers (502-504) and open
+    circuit breakers don't mean connectivity was lost; they're handled by
+    retries and circuit breakers. Use may_be_offline() to decide whether to
+    probe.
+    """
+
+    if isinstance(exception, (OfflineError, http_transport.ConnectError)):
+        return True
+    return _is_connect_failure(exception, 0)
+
+
+def _is_connect_failure(exception: BaseException, depth: int) -> bool:
+    if isinstance(exception, (socket.gaierror, ConnectionRefusedError, NewConnectionError)):
+        return True
+    if isinstance(exception, OSError) and exception.errno in _UNREACHABLE_ERRNOS:
+        return True
+    if depth >= 4:
+        return False
+
+    # Requests and urllib3 wrap the original error, either as argument,
+    # as reason or as cause.
+    causes = [getattr(exception, 'reason', None), exception.__cause__, exception.__context__]
+    causes.extend(getattr(exception, 'args', ()))
+    return any(_is_connect_failure(cause, depth + 1) for cause in causes
+               if isinstance(cause, BaseException) and cause is not exception)
+
+
+def may_be_offline(exception: BaseException) -> bool:
+    """Returns True when the exception may be caused by lost connectivity.
+
+    Besides connectivity errors, this includes timeouts and dropped
+    connections. Connectivity.probe() finds out whether the Cloud can still
+    be reached.
+    """
+
+    if isinstance(exception, deadline.DeadlineExceeded):
+        return False
+    return is_connectivity_error(exception) or isinstance(
+        exception, (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    http_transport.TransportError,
+                    asyncio.TimeoutError,
+                    ConnectionError))
+
+
+def _probe_address(url: str) -> tuple:
+    """Returns the (host, port) to open a connection to, to see whether the URL can be reached."""
+
+    parts = urllib.parse.urlsplit(url)
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if proxy and not urllib.request.proxy_bypass(parts.hostname):
+        parts = urllib.parse.urlsplit(proxy)
+    return parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+class Connectivity:
+    """Keeps track of whether the Cloud can be reached.
+
+    :param probe_timeout: seconds to wait for a connection when probing.
+    :param probe_interval: minimum number of seconds between probes while offline.
+    """
+
+    def __init__(self, *, probe_timeout=PROBE_TIMEOUT, probe_interval=PROBE_INTERVAL):
+        self.probe_timeout = probe_timeout
+        self.probe_interval = probe_interval
+
+        self.offline_since = None  # time.time() of losing connectivity, or None when online.
+        self.reason = ''
+        # time.time() of the oldest snapshot that was served while offline.
+        self.stale_since = None
+
+        self._last_probe = None  # time.monotonic() of the last probe.
+        self._probe_task = None
+        self._listeners = []
+
+    @property
+    def is_offline(self) -> bool:
+        return self.offline_since is not None
+
+    def mark_offline(self, reason):
+        self.reason = str(reason)
+        if self.is_offline:
+            return
+        log.warning('Blender Cloud is unreachable, working offline: %s', reason)
+        self.offline_since = time.time()
+        # Don't probe right away; the failure we just saw is recent enough.
+        self._last_probe = time.monotonic()
+
+    def mark_online(self):
+        if not self.is_offline:
+            return
+        log.info('Blender Cloud is reachable again, after %.0f seconds offline',
+                  time.time() - self.offline_since)
+        self.offline_since = None
+        self.stale_since = None
+        self.reason = ''
+
+        for listener in list(self._listeners):
+            try:
+                listener()
+            except Exception:
+                log.exception('Error in connectivity listener %r', listener)
+
+    def add_listener(self, listener: callable):
+        """Registers a function to be called without arguments when connectivity returns."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: callable):
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def served_snapshot(self, saved_at: float):
+        """Records that data stored at the given time was served instead of fresh data."""
+
+        if self.stale_since is None or saved_at < self.stale_since:
+            self.stale_since = saved_at
+
+    def probe_due(self) -> bool:
+        if self._last_probe is None:
+            return True
+        return time.monotonic() - self._last_probe >= self.probe_interval
+
+    async def probe(self, url: str) -> bool:
+        """Tries to connect to the server of the URL, and updates the state accordingly.
+
+        Concurrent probes share the same connection attempt.
+
+        :returns: whether the server could be reached.
+        """
+
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.ensure_future(self._probe(url))
+        return await asyncio.shield(self._probe_task)
+
+    async def _probe(self, url: str) -> bool:
+        host, port = _probe_address(url)
+        self._last_probe = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port),
+                                               self.probe_timeout)
+        except (OSError, asyncio.TimeoutError) as ex:
+            self.mark_offline('unable to connect to %s:%i: %s'
+                              % (host, port, str(ex) or type(ex).__name__))
+            return False
+
+        writer.close()
+        self.mark_online()
+        return True
+
+    def status_text(self) -> str:
+        """Returns a description of the offline state for the user, or '' when online."""
+
+        if not self.is_offline:
+            return ''
+
+        text = 'Offline'
+        if self.stale_since is not None:
+            text += ', showing data from %s' % time.strftime('%Y-%m-%d %H:%M',
+                                                             time.localtime(self.stale_since))
+        if download_queue:
+            text += ', %i queued downloads' % len(download_queue)
+        return text
+
+
+class SnapshotStore:
+    """Stores Pillar responses on disk, to serve while offline.
+
+    Snapshots are keyed by a string that identifies the request; see
+    pillar.snapshot_key().
+    """
+
+    def __init__(self, directory: str, *, write_delay=SNAPSHOT_WRITE_DELAY):
+        self.directory = directory
+        self.write_delay = write_delay
+
+        # Mapping from key to serialised snapshot, for snapshots not yet on disk.
+        self._unwritten = {}
+        self._flush_task = None
+        self._write_task = None
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], '%s.json' % digest)
+
+    def _serialise(self, key: str, document) -> str:
+        snapshot = {'key': key, 'saved_at': time.time(), 'document': document}
+        return json.dumps(snapshot, cls=pillarsdk.utils.PillarJSONEncoder)
+
+    def save(self, key: str, document):
+        """Stores a JSON-compatible document or pillarsdk Resource."""
+
+        self._write({key: self._serialise(key, document)})
+
+    def save_later(self, key: str, document):
+        """Stores a document like save(), but writes it in the background.
+
+        Snapshots saved within write_delay seconds of each other are written
+        together, in a thread of the default executor. load() returns them
+        immediately.
+        """
+
+        self._unwritten[key] = self._serialise(key, document)
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.write_delay)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Writes the snapshots saved with save_later() to disk now."""
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        while self._unwritten:
+            if self._write_task is None:
+                self._write_task = asyncio.ensure_future(self._write_unwritten())
+            await asyncio.shield(self._write_task)
+
+    async def _write_unwritten(self):
+        snapshots = dict(self._unwritten)
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._write, snapshots)
+        finally:
+            self._write_task = None
+
+        for key, text in snapshots.items():
+            # Snapshots saved again while writing still have to be written.
+            if self._unwritten.get(key) is text:
+                del self._unwritten[key]
+
+    def _write(self, snapshots: dict):
+        for key, text in snapshots.items():
+            path = self._path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as outfile:
+                    outfile.write(text)
+            except OSError as ex:
+                log.warning('Unable to save snapshot %s, ignoring: %s', path, ex)
+
+    def load(self, key: str) -> tuple:
+        """Returns (document, time.time() it was saved), or (None, None) if there is none."""
+
+        if key in self._unwritten:
+            snapshot = json.loads(self._unwritten[key])
+            return snapshot['document'], snapshot['saved_at']
+
+        path = self._path(key)
+        try:
+            with open(path, 'r') as infile:
+                snapshot = json.load(infile)
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError) as ex:
+            log.warning('Unable to load snapshot %s, ignoring: %s', path, ex)
+            return None, None
+
+        if snapshot.get('key') != key:
+            # Hash collision, however unlikely.
+            return None, None
+        return snapshot['document'], snapshot['saved_at']
+
+
+class DownloadQueue:
+    """Downloads waiting until the Cloud can be reached again.
+
+    Queued downloads are started one by one once a probe succeeds. A download
+    that fails because the Cloud became unreachable again is requeued. Waiting
+    stops when the queue is empty, or when it is cancelled.
+    """
+
+    def __init__(self):
+        # Mapping from key to (description, function returning a coroutine).
+        self._pending = collections.OrderedDict()
+        self._resume_task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def descriptions(self) -> list:
+        return [description for description, _ in self._pending.values()]
+
+    def add(self, key, description: str, start: callable, *, probe_url: str) -> asyncio.Task:
+        """Queues a download; queueing the same key again replaces the earlier one.
+
+        :param start: function without arguments that returns the coroutine
+            performing the download.
+        :param probe_url: URL to probe for connectivity.
+        :returns: the task that waits for connectivity and runs the downloads.
+        """
+
+        log.info('Queueing download of %s until Blender Cloud is reachable', description)
+        self._pending[key] = (description, start)
+        if self._resume_task is None or self._resume_task.done():
+            self._resume_task = asyncio.ensure_future(self._resume_when_online(probe_url))
+        return self._resume_task
+
+    def cancel(self):
+        """Forgets all queued downloads, and stops waiting for connectivity."""
+
+        if self._pending:
+            log.info('Cancelling %i queued downloads', len(self._pending))
+        self._pending.clear()
+        if self._resume_task is not None:
+            self._resume_task.cancel()
+            self._resume_task = None
+
+    async def _resume_when_online(self, probe_url: str):
+        while self._pending:
+            if not await connectivity.probe(probe_url):
+                await asyncio.sleep(connectivity.probe_interval)
+                continue
+
+            pending, self._pending = self._pending, collections.OrderedDict()
+            log.info('Starting %i queued downloads', len(pending))
+            for key, (description, start) in pending.items():
+                try:
+                    await start()
+                except Exception as ex:
+                    if not is_connectivity_error(ex):
+                        log.warning('Queued download of %s failed: %s', description, ex)
+                        continue
+                    log.info('Unable to download %s, queueing it again: %s', description, ex)
+                    self._pending.setdefault(key, (description, start))
+
+            if self._pending:
+                # The server may be reachable while downloads still fail, so don't hammer it.
+                await asyncio.sleep(connectivity.probe_interval)
+
+
+connectivity = Connectivity()
+download_queue = DownloadQueue()
@@ -17,14 +17,22 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import asyncio
+import base64
+import copy
 import datetime
+import email.utils
+import hashlib
 import json
 import os
 import functools
 import logging
-from contextlib import closing, contextmanager
+from contextlib import contextmanager
 import urllib.parse
 import pathlib
+import shutil
+import tempfile
+import threading
+import time
 
 import requests
 import requests.structures
@@ -33,18 +41,41 @@ import pillarsdk.exceptions
 import pillarsdk.utils
 from pillarsdk.utils import sanitize_filename
 
-from . import cache
+from . import (bandwidth, blob_store, cache, concurrency, deadline, http_transport, listing,
+               metrics, offline, remote_file, resilience, segmented_download, session, tracing,
+               upload, utils)
+from .concurrency import Priority
 
 SUBCLIENT_ID = 'PILLAR'
 TEXTURE_NODE_TYPES = {'texture', 'hdri'}
 
 RFC1123_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
 
+# Projection of File documents used for showing thumbnails.
+THUMBNAIL_FILE_PROJECTION = {'filename': 1, 'variations': 1, 'width': 1, 'height': 1,
+                             'length': 1}
+# Projection of File documents used for downloading files.
+DOWNLOAD_FILE_PROJECTION = {'link': 1, 'link_expires': 1, 'filename': 1, 'length': 1,
+                            'md5': 1}
+
+# Cached download links are refreshed when they expire within this time.
+LINK_EXPIRY_MARGIN = datetime.timedelta(minutes=10)
+
+_upload_index = None  # upload.UploadIndex, created by upload_index().
+_snapshot_store = None  # offline.SnapshotStore, created by snapshot_store().
 _pillar_api = {}  # will become a mapping from bool (cached/non-cached) to pillarsdk.Api objects.
 log = logging.getLogger(__name__)
 uncached_session = requests.session()
 _testing_blender_id_profile = None  # Just for testing, overrides what is returned by blender_id_profile.
-_downloaded_urls = set()  # URLs we've downloaded this Blender session.
+# Downloaded files are used without contacting the server for this many seconds
+# after they were last validated, or shorter when the server says so.
+freshness_ttl = 24 * 3600.0
+
+# Background revalidations by download_to_file(), mapping filename to asyncio.Task.
+_background_revalidations = {}
+_transport = None  # created on first use by file_transport().
+# Per executor thread: counts the HTTP responses of the running Pillar call, see _count_responses().
+_thread_state = threading.local()
 
 
 class UserNotLoggedInError(RuntimeError):
@@ -173,49 +204,460 @@ def pillar_api(pillar_endpoint: str = None, caching=True) -> pillarsdk.Api:
         if pillar_endpoint is None:
             from . import blender
             pillar_endpoint = blender.preferences().pillar_server
-
-        _caching_api = pillarsdk.Api(endpoint=pillar_endpoint,
-                                     username=subclient['subclient_user_id'],
-                                     password=SUBCLIENT_ID,
-                                     token=subclient['token'])
-        _caching_api.requests_session = cache.requests_session()
-
-        _noncaching_api = pillarsdk.Api(endpoint=pillar_endpoint,
-                                        username=subclient['subclient_user_id'],
-                                        password=SUBCLIENT_ID,
-                                        token=subclient['token'])
-        _noncaching_api.requests_session = uncached_session
-
-        # Send the addon version as HTTP header.
-        from blender_cloud import bl_info
-        addon_version = '.'.join(str(v) for v in bl_info['version'])
-        _caching_api.global_headers['Blender-Cloud-Addon'] = addon_version
-        _noncaching_api.global_headers['Blender-Cloud-Addon'] = addon_version
-
-        _pillar_api = {
-            True: _caching_api,
-            False: _noncaching_api,
-        }
+        _pillar_api = _create_pillar_apis(pillar_endpoint, subclient)
 
     return _pillar_api[caching]
 
 
-# No more than this many Pillar calls should be made simultaneously
-pillar_semaphore = asyncio.Semaphore(3)
+class DeadlineApi(pillarsdk.Api):
+    """pillarsdk.Api that passes timeouts to Requests, see deadline.requests_timeout()."""
+
+    def http_call(self, url, method, **kwargs):
+        kwargs.setdefault('timeout', deadline.requests_timeout())
+        return super().http_call(url, method, **kwargs)
+
+    def handle_response(self, response, content):
+        counts = getattr(_thread_state, 'response_counts', None)
+        if counts is not None:
+            # CacheControl marks the responses it serves from its cache.
+            counts['cached' if getattr(response, 'from_cache', False) else 'network'] += 1
+        return super().handle_response(response, content)
+
+
+def _create_pillar_apis(pillar_endpoint: str, subclient: dict) -> dict:
+    """Returns a mapping from bool (cached/non-cached) to new pillarsdk.Api objects.
+
+    Both are created before either is used, so that replacing the mapping in
+    one assignment never mixes old and new credentials.
+    """
+
+    _caching_api = DeadlineApi(endpoint=pillar_endpoint,
+                               username=subclient['subclient_user_id'],
+                               password=SUBCLIENT_ID,
+                               token=subclient['token'])
+    _caching_api.requests_session = cache.requests_session()
+
+    _noncaching_api = DeadlineApi(endpoint=pillar_endpoint,
+                                  username=subclient['subclient_user_id'],
+                                  password=SUBCLIENT_ID,
+                                  token=subclient['token'])
+    _noncaching_api.requests_session = uncached_session
+
+    # Send the addon version as HTTP header.
+    from blender_cloud import bl_info
+    addon_version = '.'.join(str(v) for v in bl_info['version'])
+    _caching_api.global_headers['Blender-Cloud-Addon'] = addon_version
+    _noncaching_api.global_headers['Blender-Cloud-Addon'] = addon_version
+
+    return {
+        True: _caching_api,
+        False: _noncaching_api,
+    }
+
+
+def is_overload_error(exception: BaseException) -> bool:
+    """Returns True when the exception indicates that Pillar is overloaded.
+
+    This is the case for connection errors, timeouts, '429 Too Many Requests'
+    and 5xx responses. Other errors, such as '404 Not Found', are regular
+    answers from a healthy server.
+    """
+
+    if isinstance(exception, (requests.exceptions.ConnectionError,
+                              requests.exceptions.ChunkedEncodingError,
+                              requests.exceptions.Timeout,
+                              http_transport.TransportError,
+                              asyncio.TimeoutError)):
+        return True
+
+    response = getattr(exception, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    if status_code is None:
+        return False
+    return status_code == 429 or status_code >= 500
+
+
+def _is_transient_error(exception: BaseException) -> bool:
+    """Returns True when a failed call should be retried.
+
+    Connectivity errors are not retried while we know the Cloud is unreachable.
+    """
+
+    if offline.connectivity.is_offline and offline.is_connectivity_error(exception):
+        return False
+    return is_overload_error(exception)
+
+
+# Limits the number of simultaneous Pillar calls. The limit adapts
+# to the latency of the calls and backs off when Pillar is overloaded.
+pillar_limiter = concurrency.AdaptiveLimiter('pillar_call',
+                                             initial_limit=3, min_limit=3, max_limit=12,
+                                             is_overload=is_overload_error)
 
+# Same, but for downloading files from Pillar's storage backend.
+download_limiter = concurrency.AdaptiveLimiter('download',
+                                               initial_limit=4, min_limit=1, max_limit=8,
+                                               is_overload=is_overload_error)
 
-async def pillar_call(pillar_func, *args, caching=True, **kwargs):
+# Determines how transient errors are retried by pillar_call() and download_to_file().
+retry_policy = resilience.RetryPolicy(max_attempts=4, base_delay=0.5, max_delay=10.0)
+
+# Names of pillarsdk functions that only perform GET requests, and thus can be retried.
+IDEMPOTENT_PILLAR_FUNCTIONS = frozenset({
+    'find', 'find_one', 'find_first', 'find_from_endpoint',
+    'all', 'all_from_endpoint', 'me', 'thumbnail', 'all_node_records',
+})
+
+
+def _copy_result(result):
+    """Returns a copy of the result of a Pillar call, for callers that joined the call."""
+
+    if isinstance(result, pillarsdk.Resource):
+        return type(result)(result.to_dict())
+    return copy.deepcopy(result)
+
+
+# Coalesces identical read-only Pillar calls that are performed concurrently.
+# Callers that joined get their own copy, as Resources are modified in place.
+pillar_single_flight = concurrency.SingleFlight('pillar_call', copy_result=_copy_result)
+
+# Coalesces downloads of the same file into a blob store, see download_file_by_uuid().
+blob_download_single_flight = concurrency.SingleFlight('blob_download')
+
+
+def _coalescing_key(pillar_func, args, kwargs, caching: bool, priority: Priority):
+    """Returns a hashable key identifying this Pillar call, or None if it can't be coalesced.
+
+    Calls with different priorities aren't coalesced, so that an urgent call
+    never waits for a background call queued in the pillar_limiter.
+    """
+
+    func_name = getattr(pillar_func, '__name__', '')
+    if func_name not in IDEMPOTENT_PILLAR_FUNCTIONS:
+        return None
+
+    # Bound to a class (File.find) or to a document (file.thumbnail).
+    bound_to = getattr(pillar_func, '__self__', None)
+    if isinstance(bound_to, type):
+        bound_key = bound_to.__qualname__
+    elif bound_to is not None:
+        try:
+            bound_key = (type(bound_to).__qualname__, bound_to['_id'])
+        except (KeyError, TypeError):
+            return None
+    else:
+        bound_key = getattr(pillar_func, '__module__', None)
+
+    try:
+        args_key = json.dumps([args, kwargs], sort_keys=True)
+    except TypeError:
+        return None
+
+    return bound_key, func_name, args_key, caching, priority
+
+
+async def pillar_call(pillar_func, *args, caching=True, priority=Priority.VISIBLE, **kwargs):
     """Calls a Pillar function.
 
-    A semaphore is used to ensure that there won't be too many
-    calls to Pillar simultaneously.
+    The adaptive pillar_limiter is used to ensure that there won't be
+    too many calls to Pillar simultaneously. Transient errors are retried
+    for the read-only functions in IDEMPOTENT_PILLAR_FUNCTIONS, and all
+    calls fail fast with resilience.CircuitOpenError while Pillar is down.
+
+    Concurrent calls to the same read-only function with the same arguments
+    and priority are coalesced into a single HTTP request, and all receive
+    the same result. The shared request runs within its own deadline, and
+    every caller waits for it within theirs. See pillar_single_flight for
+    the number of deduplicated calls.
+
+    :param priority: calls with a more urgent priority are performed before
+        waiting calls with a less urgent one.
     """
 
-    partial = functools.partial(pillar_func, *args, api=pillar_api(caching=caching), **kwargs)
-    loop = asyncio.get_event_loop()
+    span_name = '%s.%s' % (metrics.resource_type(pillar_func), getattr(pillar_func, '__name__', ''))
+    with tracing.span(span_name, 'pillar', priority=priority.name):
+        key = _coalescing_key(pillar_func, args, kwargs, caching, priority)
+        if key is None:
+            return await _pillar_call(pillar_func, args, kwargs, caching, priority)
+
+        async def shared_call():
+            with deadline.detached(), tracing.detached():
+                with tracing.span(span_name, 'pillar', priority=priority.name, shared=True):
+                    return await _pillar_call(pillar_func, args, kwargs, caching, priority)
+
+        return await deadline.wait_for(pillar_single_flight.run(key, shared_call))
+
+
+@deadline.budgeted(deadline.PILLAR_CALL)
+async def _pillar_call(pillar_func, args, kwargs, caching: bool, priority: Priority):
+    api = pillar_api(caching=caching)
+    partial = functools.partial(pillar_func, *args, api=api, **kwargs)
+    func_name = getattr(pillar_func, '__name__', '')
+    resource_type = metrics.resource_type(pillar_func)
+
+    @tracing.coroutine_span('http', 'request')
+    async def attempt():
+        try:
+            async with metrics.registry.measure_slot(pillar_limiter, priority, 'pillar',
+                                                     func_name, resource_type) as measurement:
+                # Requests can't be interrupted, but it times out by itself before long.
+                call = _count_responses(deadline.call_with_requests_timeout(partial))
+                result, counts = await deadline.wait_for(measurement.run_in_executor(call))
+                if counts['cached'] and not counts['network']:
+                    # Cache hits say nothing about the server's latency.
+                    measurement.skip_latency()
+                return result
+        except Exception as ex:
+            # Find out quickly whether the Cloud is unreachable, instead of
+            # waiting for all retries to fail.
+            if offline.may_be_offline(ex) and not await offline.connectivity.probe(api.endpoint):
+                raise offline.OfflineError('Blender Cloud is unreachable: %s' % ex) from ex
+            raise
+
+    return await resilience.call_with_retries(
+        attempt,
+        policy=retry_policy,
+        breaker=resilience.breaker_for_url(api.endpoint),
+        is_transient=_is_transient_error,
+        retry=func_name in IDEMPOTENT_PILLAR_FUNCTIONS,
+        description='Pillar call %s' % func_name)
+
+
+def _count_responses(func: callable) -> callable:
+    """Returns a function that calls func() and returns (result, response counts).
+
+    The counts are a dict with the number of 'cached' and 'network'
+    responses handled by DeadlineApi during the call.
+    """
+
+    def call():
+        counts = _thread_state.response_counts = {'cached': 0, 'network': 0}
+        try:
+            return func(), counts
+        finally:
+            del _thread_state.response_counts
+
+    return call
+
+
+async def _find_file_docs(group: tuple, file_ids: list) -> dict:
+    """Batch function for file_doc_batcher; finds File documents with one query."""
+
+    projection_json, priority = group
+    params = {
+        'where': {'_id': {'$in': file_ids}},
+        'projection': json.loads(projection_json),
+        'max_results': len(file_ids),
+    }
+    found = await pillar_call(pillarsdk.File.all, params, priority=priority)
+    return {file_doc['_id']: file_doc for file_doc in found['_items']}
+
+
+# Combines File lookups performed within 50 ms into a single $in query.
+file_doc_batcher = concurrency.Batcher('File.find', _find_file_docs,
+                                       window=0.05, max_batch_size=50)
+
+
+async def find_file_doc(file_id: str, projection: dict, *,
+                        priority=Priority.VISIBLE) -> pillarsdk.File:
+    """Finds a File document, batching concurrent lookups into one request.
+
+    Lookups with the same projection and priority are combined.
+
+    :returns: the File, or None if it cannot be found.
+    """
+
+    group = (json.dumps(projection, sort_keys=True), priority)
+    return await with_offline_fallback(snapshot_key('File', file_id, group[0]),
+                                       lambda: file_doc_batcher.load(file_id, group),
+                                       restore=pillarsdk.File)
+
+
+def link_is_fresh(file_doc, *, now: datetime.datetime = None) -> bool:
+    """Returns True when the File's download link doesn't expire within LINK_EXPIRY_MARGIN.
+
+    Links without an expiry timestamp are considered stale, to be on the safe side.
+    """
+
+    if not file_doc.get('link') or not file_doc.get('link_expires'):
+        return False
+
+    expires = file_doc['link_expires']
+    if not isinstance(expires, datetime.datetime):
+        try:
+            expires = email.utils.parsedate_to_datetime(expires)
+        except (TypeError, ValueError):
+            log.debug('Unable to parse link_expires %r', expires)
+            return False
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=datetime.timezone.utc)
+
+    if now is None:
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return expires - now > LINK_EXPIRY_MARGIN
+
+
+async def find_file_doc_cached(file_uuid: str, metadata_directory: str, projection: dict, *,
+                               priority=Priority.VISIBLE) -> pillarsdk.File:
+    """Finds a File document, using the copy stored in metadata_directory when possible.
+
+    File documents don't change, except for their expiring download link.
+    A stored document is used when it contains all fields in the projection;
+    when its link is about to expire, only the link is fetched from Pillar.
+    Documents fetched from Pillar are stored in files/<uuid>.json.
+    """
+
+    metadata_file = os.path.join(metadata_directory, 'files', '%s.json' % file_uuid)
+
+    file_doc = None
+    try:
+        with open(metadata_file, 'r') as infile:
+            file_doc = json.load(infile)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as ex:
+        log.warning('Unable to load cached File document %s, ignoring: %s', metadata_file, ex)
+
+    if file_doc is not None and not all(field in file_doc for field in projection):
+        log.debug('Cached File document %s lacks fields, refetching', file_uuid)
+        file_doc = None
+
+    if file_doc is None:
+        await ensure_online()
+        file_desc = await pillar_call(pillarsdk.File.find, file_uuid,
+                                      params={'projection': projection}, priority=priority)
+        # Not every File document has every field (older ones lack 'md5', for example).
+        # Store them as None, so that the stored document is complete next time.
+        for field in projection:
+            if field not in file_desc:
+                file_desc[field] = None
+    elif 'link' in projection and not link_is_fresh(file_doc):
+        if offline.connectivity.is_offline:
+            # The link can't be used anyway, but the downloaded file may be cached.
+            log.debug('Offline, using cached File document %s with expired link', file_uuid)
+            return pillarsdk.File(file_doc)
+
+        log.debug('Refreshing download link of cached File document %s', file_uuid)
+        try:
+            link_doc = await pillar_call(pillarsdk.File.find, file_uuid,
+                                         params={'projection': {'link': 1, 'link_expires': 1}},
+                                         priority=priority)
+        except Exception as ex:
+            if not offline.is_connectivity_error(ex):
+                raise
+            offline.connectivity.mark_offline(ex)
+            return pillarsdk.File(file_doc)
+        file_doc['link'] = link_doc['link']
+        file_doc['link_expires'] = link_doc['link_expires']
+        file_desc = pillarsdk.File(file_doc)
+    else:
+        log.debug('Using cached File document %s', file_uuid)
+        return pillarsdk.File(file_doc)
+
+    save_as_json(file_desc, metadata_file)
+    return file_desc
 
-    async with pillar_semaphore:
-        return await loop.run_in_executor(None, partial)
+
+def snapshot_store() -> offline.SnapshotStore:
+    """Returns the store of Pillar responses for offline use, in the user's cache directory."""
+
+    global _snapshot_store
+
+    if _snapshot_store is None:
+        _snapshot_store = offline.SnapshotStore(cache.cache_directory('snapshots'))
+    return _snapshot_store
+
+
+def snapshot_key(*parts) -> str:
+    """Returns the key of a snapshot, given JSON-compatible parts identifying the request."""
+    return json.dumps(parts, sort_keys=True)
+
+
+def _pillar_endpoint() -> str:
+    return pillar_api().endpoint
+
+
+async def ensure_online(url: str = None):
+    """Raises offline.OfflineError when the Cloud is known to be unreachable.
+
+    While offline, the server is probed once every probe interval, so that
+    connectivity is restored automatically.
+
+    :param url: URL to probe; defaults to the Pillar endpoint.
+    """
+
+    connectivity = offline.connectivity
+    if not connectivity.is_offline:
+        return
+    if connectivity.probe_due() and await connectivity.probe(url or _pillar_endpoint()):
+        return
+    raise offline.OfflineError('Blender Cloud is unreachable (%s)' % connectivity.reason)
+
+
+async def with_offline_fallback(key: str, fetch: callable, *, restore: callable = None,
+                                snapshot=True):
+    """Fetches something from Pillar, or its snapshot while the Cloud is unreachable.
+
+    Successful results are stored in the snapshot store, so that they can be
+    served when offline. Connectivity errors switch to offline mode.
+
+    :param key: the snapshot key, see snapshot_key().
+    :param fetch: function without arguments returning a coroutine that fetches
+        the result. Its result should be JSON-compatible or a pillarsdk Resource.
+    :param restore: function that converts the stored JSON document back into
+        a result, for example pillarsdk.File.
+    :param snapshot: when False, the result is not stored, and nothing is
+        served while offline.
+    :raises offline.OfflineError: when offline and there is no snapshot.
+    """
+
+    try:
+        await ensure_online()
+        result = await fetch()
+    except Exception as ex:
+        if not offline.is_connectivity_error(ex):
+            raise
+        offline.connectivity.mark_offline(ex)
+
+        document, saved_at = snapshot_store().load(key) if snapshot else (None, None)
+        if document is None:
+            if isinstance(ex, offline.OfflineError):
+                raise
+            raise offline.OfflineError('Blender Cloud is unreachable, and nothing was cached: %s'
+                                       % ex)
+        log.debug('Offline, serving snapshot of %s', key)
+        offline.connectivity.served_snapshot(saved_at)
+        return restore(document) if restore is not None else document
+
+    offline.connectivity.mark_online()
+    if snapshot and result is not None:
+        snapshot_store().save_later(key, result)
+    return result
+
+
+async def shutdown():
+    """Stops the background work of this module, and writes pending snapshots.
+
+    Call this when the add-on is unregistered.
+    """
+
+    offline.download_queue.cancel()
+    await file_doc_batcher.close()
+    if _snapshot_store is not None:
+        await _snapshot_store.flush()
+
+
+def file_transport():
+    """Returns the HTTP transport used for downloading and uploading files.
+
+    Pillar calls still go through pillarsdk, which uses Requests.
+    """
+
+    global _transport
+
+    if _transport is None:
+        _transport = http_transport.create_transport(uncached_session)
+    return _transport
 
 
 def sync_call(pillar_func, *args, caching=True, **kwargs):
@@ -246,8 +688,15 @@ async def check_pillar_credentials(required_roles: set):
     if not pillar_user_id:
         raise CredentialsNotSyncedError()
 
+    async def fetch_user():
+        db_user = await with_offline_fallback(snapshot_key('User.me', pillar_user_id),
+                                              lambda: pillar_call(pillarsdk.User.me),
+                                              restore=pillarsdk.User)
+        # A snapshot served while offline proves nothing about the token.
+        return db_user, not offline.connectivity.is_offline
+
     try:
-        db_user = await pillar_call(pillarsdk.User.me)
+        db_user = await session.manager.validated_user(_credentials_key(subclient), fetch_user)
     except (pillarsdk.UnauthorizedAccess, pillarsdk.ResourceNotFound, pillarsdk.ForbiddenAccess):
         raise CredentialsNotSyncedError()
 
@@ -258,18 +707,37 @@ async def check_pillar_credentials(required_roles: set):
         # then pick up on the user's new status.
         del profile.subclients[SUBCLIENT_ID]
         profile.save_json()
+        session.manager.invalidate()
         raise NotSubscribedToCloudError()
 
     return db_user
 
 
+def _credentials_key(subclient: dict) -> tuple:
+    """Returns what identifies the credentials in the subclient dict for session.manager."""
+    return subclient['subclient_user_id'], subclient['token']
+
+
 async def refresh_pillar_credentials(required_roles: set):
     """Refreshes the authentication token on Pillar.
 
+    Concurrent refreshes of the same token are coalesced into one.
+
     :raises blender_id.BlenderIdCommError: when Blender ID refuses to send a token to Pillar.
     :raises Exception: when the Pillar credential check fails.
     """
 
+    profile = blender_id_profile()
+    old_subclient = profile.subclients.get(SUBCLIENT_ID) if profile else None
+    old_credentials = _credentials_key(old_subclient) if old_subclient else None
+
+    await session.manager.refresh(old_credentials, _refresh_subclient_token)
+
+    # Test the new token
+    return await check_pillar_credentials(required_roles)
+
+
+async def _refresh_subclient_token():
     global _pillar_api
 
     import blender_id
@@ -285,9 +753,8 @@ async def refresh_pillar_credentials(required_roles: set):
         log.warning("Unable to create authentication token: %s", ex)
         raise CredentialsNotSyncedError()
 
-    # Test the new URL
-    _pillar_api = None
-    return await check_pillar_credentials(required_roles)
+    # Replace both Api objects at once, so that concurrent calls always find a pair.
+    _pillar_api = _create_pillar_apis(pillar_endpoint, blender_id_subclient())
 
 
 async def get_project_uuid(project_url: str) -> str:
@@ -306,16 +773,142 @@ async def get_project_uuid(project_url: str) -> str:
     return project['_id']
 
 
-async def get_nodes(project_uuid: str = None, parent_node_uuid: str = None,
-                    node_type=None, max_results=None) -> list:
-    """Gets nodes for either a project or given a parent node.
+class PageIterator:
+    """Asynchronous iterator over the pages of an Eve collection.
 
-    @param project_uuid: the UUID of the project, or None if only querying by parent_node_uuid.
-    @param parent_node_uuid: the UUID of the parent node. Can be the empty string if the
-        node should be a top-level node in the project. Can also be None to query all nodes in a
-        project. In both these cases the project UUID should be given.
+    Every iteration produces the list of items on the next page. The next
+    page is fetched as soon as the current one has arrived, so that it's
+    already underway while the caller processes the current page.
+
+    Use as `async for items in PageIterator(...)`, and call close() when
+    stopping before the last page, to cancel fetching of the next page.
+
+    @param pillar_func: pillarsdk function returning an Eve collection, like Node.all.
+    @param params: Eve query parameters; 'page' is set by the iterator.
+    @param max_items: stop after this many items, or None to fetch all pages.
+    @param item_factory: function that converts each item, like listing.NodeRecord,
+        or None to produce the items as they are.
+    """
+
+    def __init__(self, pillar_func, *args, params: dict, max_items: int = None,
+                 priority=Priority.VISIBLE, item_factory: callable = None):
+        self.pillar_func = pillar_func
+        self.args = args
+        self.params = params
+        self.max_items = max_items
+        self.priority = priority
+        self.item_factory = item_factory
+
+        self.page_count = 0
+        self.item_count = 0
+        self._fetch_task = None
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> list:
+        if self._fetch_task is None:
+            if self._done:
+                raise StopAsyncIteration
+            self._fetch_task = self._fetch_page(1)
+
+        fetch_task, self._fetch_task = self._fetch_task, None
+        page = await fetch_task
+
+        items = page['_items']
+        if self.max_items is not None:
+            items = items[:self.max_items - self.item_count]
+        self.page_count += 1
+        self.item_count += len(items)
+
+        if self._has_next_page(page) and (self.max_items is None
+                                          or self.item_count < self.max_items):
+            self._fetch_task = self._fetch_page(self.page_count + 1)
+        else:
+            self._done = True
+
+        if self.item_factory is not None:
+            items = [self.item_factory(item) for item in items]
+        return items
+
+    def close(self):
+        """Stops the iteration, cancelling fetching of the next page."""
+
+        self._done = True
+        if self._fetch_task is not None:
+            self._fetch_task.cancel()
+            self._fetch_task = None
+
+    def _fetch_page(self, page_nr: int) -> asyncio.Task:
+        params = dict(self.params, page=page_nr)
+        func_name = getattr(self.pillar_func, '__name__', '')
+        log.debug('Fetching page %i of %s', page_nr, func_name)
+
+        resource_class = getattr(self.pillar_func, '__self__', None)
+        key = snapshot_key(getattr(resource_class, '__name__', None), func_name,
+                           self.args, params)
+
+        def fetch():
+            return pillar_call(self.pillar_func, *self.args, params=params,
+                               priority=self.priority)
+
+        return asyncio.ensure_future(with_offline_fallback(key, fetch, restore=self._restore_page))
+
+    def _restore_page(self, page: dict) -> dict:
+        """Converts the items of a page snapshot back to pillarsdk Resources."""
+
+        resource_class = getattr(self.pillar_func, '__self__', None)
+        if isinstance(resource_class, type) and issubclass(resource_class, pillarsdk.Resource):
+            page['_items'] = [resource_class(pillarsdk.utils.convert_datetime(item))
+                              for item in page['_items']]
+        return page
+
+    def _has_next_page(self, page) -> bool:
+        # Pages are pillarsdk Resources, which support 'in' and [] but not get().
+        if '_links' in page and 'next' in page['_links']:
+            return True
+        if '_meta' not in page:
+            return False
+
+        meta = page['_meta']
+        try:
+            return self.page_count * meta['max_results'] < meta['total']
+        except (KeyError, TypeError):
+            return False
+
+
+def iter_node_pages(project_uuid: str = None, parent_node_uuid: str = None,
+                    node_type=None, max_results=None,
+                    priority=Priority.VISIBLE) -> PageIterator:
+    """Iterates over pages of nodes for either a project or given a parent node.
+
+    See get_nodes() for the parameters.
+    """
+
+    params = _node_query_params(project_uuid, parent_node_uuid, node_type, max_results)
+    return PageIterator(pillarsdk.Node.all, params=params,
+                        max_items=int(max_results) if max_results else None,
+                        priority=priority)
+
+
+def iter_node_record_pages(project_uuid: str = None, parent_node_uuid: str = None,
+                           node_type=None, max_results=None,
+                           priority=Priority.VISIBLE) -> PageIterator:
+    """Iterates over pages of listing.NodeRecord, see iter_node_pages().
+
+    Large listings are decoded much faster and take less memory this way;
+    use NodeRecord.materialise() to get the pillarsdk.Node of a record.
     """
 
+    params = _node_query_params(project_uuid, parent_node_uuid, node_type, max_results)
+    return PageIterator(listing.all_node_records, params=params,
+                        max_items=int(max_results) if max_results else None,
+                        priority=priority, item_factory=listing.NodeRecord)
+
+
+def _node_query_params(project_uuid: str, parent_node_uuid: str, node_type,
+                       max_results) -> dict:
     if not project_uuid and not parent_node_uuid:
         raise ValueError('get_nodes(): either project_uuid or parent_node_uuid must be given.')
 
@@ -348,9 +941,40 @@ async def get_nodes(project_uuid: str = None, parent_node_uuid: str = None,
     if max_results:
         params['max_results'] = int(max_results)
 
-    children = await pillar_call(pillarsdk.Node.all, params)
+    return params
+
+
+async def get_nodes(project_uuid: str = None, parent_node_uuid: str = None,
+                    node_type=None, max_results=None, priority=Priority.VISIBLE) -> list:
+    """Gets nodes for either a project or given a parent node.
+
+    All pages are fetched; use iter_node_pages() to process the nodes page by page.
+
+    @param project_uuid: the UUID of the project, or None if only querying by parent_node_uuid.
+    @param parent_node_uuid: the UUID of the parent node. Can be the empty string if the
+        node should be a top-level node in the project. Can also be None to query all nodes in a
+        project. In both these cases the project UUID should be given.
+    @param max_results: the maximum number of nodes to return, or None to return all.
+    @param priority: scheduling priority of the Pillar call.
+    """
+
+    nodes = []
+    async for page in iter_node_pages(project_uuid, parent_node_uuid, node_type,
+                                      max_results=max_results, priority=priority):
+        nodes.extend(page)
+    return nodes
+
 
-    return children['_items']
+async def get_node_records(project_uuid: str = None, parent_node_uuid: str = None,
+                           node_type=None, max_results=None,
+                           priority=Priority.VISIBLE) -> list:
+    """Like get_nodes(), but returns listing.NodeRecord objects."""
+
+    records = []
+    async for page in iter_node_record_pages(project_uuid, parent_node_uuid, node_type,
+                                             max_results=max_results, priority=priority):
+        records.extend(page)
+    return records
 
 
 async def get_texture_projects(max_results=None) -> list:
@@ -362,22 +986,47 @@ async def get_texture_projects(max_results=None) -> list:
     if max_results:
         params['max_results'] = int(max_results)
 
+    pages = PageIterator(pillarsdk.Project.all_from_endpoint, '/bcloud/texture-libraries',
+                         params=params, max_items=int(max_results) if max_results else None)
+    projects = []
     try:
-        children = await pillar_call(pillarsdk.Project.all_from_endpoint,
-                                     '/bcloud/texture-libraries',
-                                     params=params)
+        async for page in pages:
+            projects.extend(page)
     except pillarsdk.ResourceNotFound as ex:
         log.warning('Unable to find texture projects: %s', ex)
         raise PillarError('Unable to find texture projects: %s' % ex)
 
-    return children['_items']
+    return projects
 
 
+@tracing.coroutine_span('download')
+@deadline.budgeted(deadline.DOWNLOAD)
 async def download_to_file(url, filename, *,
                            header_store: str,
                            chunk_size=100 * 1024,
+                           priority=Priority.VISIBLE,
+                           expected_md5: str = None,
+                           revalidate_in_background=False,
                            future: asyncio.Future = None):
-    """Downloads a file via HTTP(S) directly to the filesystem."""
+    """Downloads a file via HTTP(S) directly to the filesystem.
+
+    A cached file is used without any request while it is fresh: within
+    freshness_ttl seconds (or the server's shorter cache lifetime) after it
+    was downloaded or last revalidated. A stale cached file is revalidated
+    with a conditional GET.
+
+    :param priority: downloads with a more urgent priority are started
+        before waiting downloads with a less urgent one. It also determines
+        the bandwidth budget the download draws from, see the bandwidth module.
+    :param expected_md5: hex MD5 digest of the file, as given by its File
+        document. When given, the MD5 is computed while downloading, and a
+        mismatch discards the download. A cached file is checked against it
+        once; the verified digest is recorded in the header store.
+    :param revalidate_in_background: when True, a stale cached file is
+        used immediately, and revalidated by a background task.
+    """
+
+    tracing.current_span().set(url=url, priority=priority.name)
 
     stored_headers = {}
     if os.path.exists(filename) and os.path.exists(header_store):
@@ -392,9 +1041,20 @@ async def download_to_file(url, filename, *,
             if expected_content_length == statinfo.st_size:
                 # File exists, and is of the correct length. Don't bother downloading again
                 # if we already downloaded it this session.
-                if url in _downloaded_urls:
-                    log.debug('Already downloaded %s this session, skipping this request.',
-                              url)
+                if expected_md5 and not await _cached_file_verified(filename, header_store,
+                                                                    stored_headers,
+                                                                    expected_md5):
+                    stored_headers = {}
+                elif _is_fresh(stored_headers):
+                    log.debug('Cached %s is fresh, skipping this request.', url)
+                    return
+                elif offline.connectivity.is_offline:
+                    log.debug('Offline, using cached %s without revalidating.', url)
+                    return
+                elif revalidate_in_background:
+                    _revalidate_in_background(url, filename, header_store=header_store,
+                                              chunk_size=chunk_size,
+                                              expected_md5=expected_md5)
                     return
             else:
                 log.debug('File size should be %i but is %i; ignoring cache.',
@@ -402,148 +1062,503 @@ async def download_to_file(url, filename, *,
                 stored_headers = {}
         except Exception as ex:
             log.warning('Unable to load headers from %r, ignoring cache: %s', header_store, str(ex))
+            stored_headers = {}
 
-    loop = asyncio.get_event_loop()
-
-    # Separated doing the GET and downloading the body of the GET, so that we can cancel
-    # the download in between.
-
-    def perform_get_request() -> requests.Request:
-        headers = {}
-        try:
-            if stored_headers['Last-Modified']:
-                headers['If-Modified-Since'] = stored_headers['Last-Modified']
-        except KeyError:
-            pass
-        try:
-            if stored_headers['ETag']:
-                headers['If-None-Match'] = stored_headers['ETag']
-        except KeyError:
-            pass
+    conditional_headers = {}
+    try:
+        if stored_headers['Last-Modified']:
+            conditional_headers['If-Modified-Since'] = stored_headers['Last-Modified']
+    except KeyError:
+        pass
+    try:
+        if stored_headers['ETag']:
+            conditional_headers['If-None-Match'] = stored_headers['ETag']
+    except KeyError:
+        pass
 
-        if is_cancelled(future):
-            log.debug('Downloading was cancelled before doing the GET.')
-            raise asyncio.CancelledError('Downloading was cancelled')
-        log.debug('Performing GET request, waiting for response.')
-        return uncached_session.get(url, headers=headers, stream=True, verify=True)
-
-    # Download the file in a different thread.
-    def download_loop():
-        with with_existing_dir(filename, 'wb') as outfile:
-            with closing(response):
-                for block in response.iter_content(chunk_size=chunk_size):
-                    if is_cancelled(future):
-                        raise asyncio.CancelledError('Downloading was cancelled')
-                    outfile.write(block)
+    # The file is downloaded to a '.part' file, which is moved into place when complete.
+    # A partial download is resumed when the server still has the same version of the file.
+    part_path = filename + '.part'
+    resume_state_path = part_path + '.json'
 
     # Check for cancellation even before we start our GET request
     if is_cancelled(future):
         log.debug('Downloading was cancelled before doing the GET')
         raise asyncio.CancelledError('Downloading was cancelled')
 
-    log.debug('Performing GET %s', url)
-    response = await loop.run_in_executor(None, perform_get_request)
-    log.debug('Status %i from GET %s', response.status_code, url)
-    response.raise_for_status()
+    await ensure_online(url)
+
+    transfer_group = metrics.transfer_group(url)
+    stats = metrics.registry.stats('download', *transfer_group)
+
+    def throttle(amount: int):
+        stats.bytes_received += amount
+        return bandwidth.downloaded(amount, priority)
+
+    @tracing.coroutine_span('http', 'GET')
+    async def attempt():
+        headers = dict(conditional_headers)
+        offset, validator = _resume_position(part_path, resume_state_path)
+        if offset:
+            log.debug('Resuming download of %s at byte %i', url, offset)
+            headers = {'Range': 'bytes=%i-' % offset, 'If-Range': validator}
+
+        # Hash while downloading, to prevent reading the file again afterwards.
+        hasher = hashlib.md5() if expected_md5 else None
+
+        async with metrics.registry.measure_slot(download_limiter, priority,
+                                                 'download', *transfer_group) as measurement:
+            log.debug('Performing GET %s', url)
+            response = await file_transport().request('GET', url, headers=headers)
+            measurement.response_started()
+            with response:
+                log.debug('Status %i from GET %s', response.status_code, url)
+                tracing.current_span().set(status=response.status_code)
+                if response.status_code == 416:
+                    # Our partial file doesn't match the file on the server.
+                    _remove_partial_download(part_path, resume_state_path)
+                    raise PartialDownloadMismatch('Server refused to resume %s' % url)
+                response.raise_for_status()
+
+                if response.status_code == 304:
+                    # The file we have cached is still good, just use that instead.
+                    return response, None, None
+
+                # After we performed the GET request, we should check whether we should start
+                # the download at all.
+                if is_cancelled(future):
+                    log.debug('Downloading was cancelled before downloading the GET response')
+                    raise asyncio.CancelledError('Downloading was cancelled')
+
+                if response.status_code == 206:
+                    start, total_length = _parse_content_range(response.headers)
+                    if start != offset:
+                        _remove_partial_download(part_path, resume_state_path)
+                        raise PartialDownloadMismatch('Server resumed %s at byte %s instead of %i'
+                                                      % (url, start, offset))
+                    open_mode = 'ab'
+                    if hasher is not None:
+                        # Only the part we already have needs to be read back.
+                        await _hash_file(part_path, hasher)
+                else:
+                    if offset:
+                        log.debug('Server sent entire file, restarting download of %s', url)
+                    offset = 0
+                    total_length = response.headers.get('Content-Length')
+                    open_mode = 'wb'
+
+                    if segmented_download.should_segment(response, total_length):
+                        # Segmented downloads are not resumable, as the file has holes.
+                        log.debug('Downloading %s bytes of %s in segments', total_length, url)
+                        _remove_partial_download(part_path, resume_state_path)
+                        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+                        await segmented_download.download(
+                            file_transport(), url, response, part_path,
+                            total_length=int(total_length),
+                            validator=_resume_validator(response.headers),
+                            limiter=download_limiter, priority=priority,
+                            is_cancelled=lambda: is_cancelled(future),
+                            hasher=hasher, throttle=throttle)
+                        return response, total_length, _check_md5(hasher, expected_md5, url,
+                                                                  part_path, resume_state_path)
+
+                    _save_resume_state(resume_state_path, response.headers, total_length)
+
+                log.debug('Downloading response of GET %s', url)
+                with with_existing_dir(part_path, open_mode) as outfile:
+                    while True:
+                        if is_cancelled(future):
+                            raise asyncio.CancelledError('Downloading was cancelled')
+                        block = await response.read_chunk(chunk_size)
+                        if not block:
+                            break
+                        outfile.write(block)
+                        if hasher is not None:
+                            hasher.update(block)
+                        await throttle(len(block))
+                log.debug('Done downloading response of GET %s', url)
+            return response, total_length, _check_md5(hasher, expected_md5, url,
+                                                      part_path, resume_state_path)
+
+    try:
+        response, total_length, verified_md5 = await resilience.call_with_retries(
+            attempt,
+            policy=retry_policy,
+            breaker=resilience.breaker_for_url(url),
+            is_transient=_is_transient_error,
+            is_restartable=_is_restartable_download_error,
+            description='GET %s' % url)
+    except Exception as ex:
+        if not stored_headers or not offline.is_connectivity_error(ex):
+            raise
+        # A stale file is better than no file at all.
+        log.info('Unable to revalidate %s, using cached file: %s', url, ex)
+        return
 
     if response.status_code == 304:
         # The file we have cached is still good, just use that instead.
-        _downloaded_urls.add(url)
+        stored_headers.update(_freshness_headers(response.headers))
+        _save_header_store(header_store, stored_headers)
         return
 
-    # After we performed the GET request, we should check whether we should start
-    # the download at all.
-    if is_cancelled(future):
-        log.debug('Downloading was cancelled before downloading the GET response')
-        raise asyncio.CancelledError('Downloading was cancelled')
+    if total_length is not None and os.path.getsize(part_path) != int(total_length):
+        _remove_partial_download(part_path, resume_state_path)
+        raise PillarError('Downloaded %s has size %i, expected %s'
+                          % (url, os.path.getsize(part_path), total_length))
 
-    log.debug('Downloading response of GET %s', url)
-    await loop.run_in_executor(None, download_loop)
-    log.debug('Done downloading response of GET %s', url)
+    os.replace(part_path, filename)
+    _remove_partial_download(part_path, resume_state_path)
 
     # We're done downloading, now we have something cached we can use.
     log.debug('Saving header cache to %s', header_store)
-    _downloaded_urls.add(url)
 
+    headers = {
+        'ETag': str(response.headers.get('etag', '')),
+        'Last-Modified': response.headers.get('Last-Modified'),
+        'Content-Length': str(total_length) if total_length is not None else None,
+    }
+    headers.update(_freshness_headers(response.headers))
+    if verified_md5:
+        headers.update(_verification_headers(filename, verified_md5))
+    _save_header_store(header_store, headers)
+
+
+def _cache_lifetime(headers) -> float:
+    """Returns the cache lifetime in seconds the server gave, or None if it gave none."""
+
+    cache_control = headers.get('Cache-Control', '')
+    directives = [directive.strip().lower() for directive in cache_control.split(',')]
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0.0
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return max(0.0, float(directive[8:]))
+            except ValueError:
+                log.debug('Invalid Cache-Control header %r', cache_control)
+
+    expires = headers.get('Expires')
+    if expires:
+        try:
+            expires = email.utils.parsedate_to_datetime(expires).timestamp()
+            date = headers.get('Date')
+            now = email.utils.parsedate_to_datetime(date).timestamp() if date else time.time()
+        except (TypeError, ValueError):
+            # Invalid dates, like "0", mean "already expired".
+            return 0.0
+        return max(0.0, expires - now)
+
+    return None
+
+
+def _freshness_headers(response_headers) -> dict:
+    """Returns the header store entries that record a successful validation now."""
+
+    return {
+        'Validated-At': time.time(),
+        'Max-Age': _cache_lifetime(response_headers),
+    }
+
+
+def _is_fresh(stored_headers) -> bool:
+    """Returns whether a cached file can be used without asking the server."""
+
+    validated_at = stored_headers.get('Validated-At')
+    if validated_at is None:
+        return False
+
+    lifetime = freshness_ttl
+    max_age = stored_headers.get('Max-Age')
+    if max_age is not None:
+        lifetime = min(lifetime, max_age)
+    return 0 <= time.time() - validated_at < lifetime
+
+
+def _revalidate_in_background(url: str, filename: str, **kwargs):
+    """Starts a background task that revalidates the cached file."""
+
+    if filename in _background_revalidations:
+        return
+
+    log.debug('Revalidating %s in the background', url)
+    task = asyncio.ensure_future(download_to_file(url, filename, priority=Priority.BACKGROUND,
+                                                  **kwargs))
+    _background_revalidations[filename] = task
+
+    def done(_):
+        del _background_revalidations[filename]
+        if not task.cancelled() and task.exception() is not None:
+            log.info('Unable to revalidate %s: %s', url, task.exception())
+
+    task.add_done_callback(done)
+
+
+class PartialDownloadMismatch(IOError):
+    """Raised when a partial download cannot be resumed; the next attempt starts over."""
+
+
+class ChecksumMismatch(IOError):
+    """Raised when a downloaded file doesn't match the MD5 from its File document."""
+
+
+def _is_restartable_download_error(exception: BaseException) -> bool:
+    """Returns True for errors after which the download starts over from scratch."""
+
+    return isinstance(exception, (PartialDownloadMismatch, ChecksumMismatch,
+                                  segmented_download.SegmentMismatch))
+
+
+async def _hash_file(path: str, hasher, block_size=1024 * 1024):
+    """Updates the hasher with the file's contents, reading it in an executor."""
+
+    def hash_file():
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(block_size), b''):
+                hasher.update(block)
+
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, hash_file)
+
+
+def _check_md5(hasher, expected_md5: str, url: str, part_path: str,
+               resume_state_path: str) -> str:
+    """Compares the downloaded file's digest to the expected one.
+
+    :returns: the verified digest, or None if there was nothing to verify.
+    :raises ChecksumMismatch: when the digests differ; the partial download
+        is removed, so that the next attempt starts from scratch.
+    """
+
+    if hasher is None:
+        return None
+
+    digest = hasher.hexdigest()
+    if digest != expected_md5.lower():
+        _remove_partial_download(part_path, resume_state_path)
+        raise ChecksumMismatch('Downloaded %s has MD5 %s, expected %s'
+                               % (url, digest, expected_md5))
+    return digest
+
+
+def _verification_headers(filename: str, md5: str) -> dict:
+    # The modification time is recorded too, so that a file that was changed
+    # after verification isn't trusted.
+    return {
+        'Verified-MD5': md5,
+        'Verified-Mtime': os.stat(filename).st_mtime_ns,
+    }
+
+
+def _save_header_store(header_store: str, headers):
     with with_existing_dir(header_store, 'w') as outfile:
-        json.dump({
-            'ETag': str(response.headers.get('etag', '')),
-            'Last-Modified': response.headers.get('Last-Modified'),
-            'Content-Length': response.headers.get('Content-Length'),
-        }, outfile, sort_keys=True)
+        json.dump(dict(headers), outfile, sort_keys=True)
+
+
+async def _cached_file_verified(filename: str, header_store: str, stored_headers,
+                                expected_md5: str) -> bool:
+    """Returns whether the cached file has the expected MD5 digest.
+
+    The digest is only computed when the header store doesn't already record
+    a verification of this file; a successful check is recorded there.
+    """
+
+    expected_md5 = expected_md5.lower()
+    if stored_headers.get('Verified-MD5') == expected_md5 and \
+            stored_headers.get('Verified-Mtime') == os.stat(filename).st_mtime_ns:
+        return True
+
+    hasher = hashlib.md5()
+    await _hash_file(filename, hasher)
+    if hasher.hexdigest() != expected_md5:
+        log.warning('Cached %s has MD5 %s, expected %s; downloading it again.',
+                    filename, hasher.hexdigest(), expected_md5)
+        return False
+
+    log.debug('Verified MD5 of cached %s', filename)
+    stored_headers.update(_verification_headers(filename, expected_md5))
+    _save_header_store(header_store, stored_headers)
+    return True
+
+
+def _resume_validator(headers) -> str:
+    """Returns the validator to use in an If-Range header, or None if there is none.
+
+    If-Range requires a strong validator, so weak ETags cannot be used.
+    """
+
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified') or None
 
 
-async def fetch_thumbnail_info(file: pillarsdk.File, directory: str, desired_size: str):
+def _save_resume_state(resume_state_path: str, headers, total_length):
+    validator = _resume_validator(headers)
+    if not validator or total_length is None:
+        # Without these we can't resume, so don't bother storing anything.
+        return
+
+    with with_existing_dir(resume_state_path, 'w') as outfile:
+        json.dump({'validator': validator, 'length': int(total_length)}, outfile)
+
+
+def _resume_position(part_path: str, resume_state_path: str) -> tuple:
+    """Returns (offset, validator) to resume a download, or (0, None) to start from scratch."""
+
+    try:
+        with open(resume_state_path, 'r') as infile:
+            state = json.load(infile)
+        part_size = os.path.getsize(part_path)
+        validator = state['validator']
+        length = state['length']
+    except FileNotFoundError:
+        return 0, None
+    except (OSError, ValueError, KeyError) as ex:
+        log.debug('Unable to resume download of %s: %s', part_path, ex)
+        return 0, None
+
+    if not 0 < part_size < length:
+        return 0, None
+    return part_size, validator
+
+
+def _remove_partial_download(part_path: str, resume_state_path: str):
+    for path in (part_path, resume_state_path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _parse_content_range(headers) -> tuple:
+    """Returns (start, total length) from the Content-Range header.
+
+    The total length is None when the server doesn't know it.
+    """
+
+    content_range = headers.get('Content-Range', '')
+    try:
+        unit, range_spec = content_range.split(' ', 1)
+        byte_range, total = range_spec.split('/', 1)
+        start = int(byte_range.split('-', 1)[0])
+    except ValueError:
+        raise PartialDownloadMismatch('Invalid Content-Range header %r' % content_range)
+    if unit != 'bytes':
+        raise PartialDownloadMismatch('Invalid Content-Range header %r' % content_range)
+    return start, None if total == '*' else int(total)
+
+
+async def fetch_thumbnail_info(file: pillarsdk.File, directory: str, desired_size: str, *,
+                               priority=Priority.VISIBLE):
     """Fetches thumbnail information from Pillar.
 
     @param file: the pillar File object that represents the image whose thumbnail to download.
     @param directory: the directory to save the file to.
     @param desired_size: thumbnail size
+    @param priority: scheduling priority of the Pillar call.
     @return: (url, path), where 'url' is the URL to download the thumbnail from, and 'path' is the absolute path of the
         where the thumbnail should be downloaded to. Returns None, None if the task was cancelled before downloading
-        finished.
+        finished. While offline, 'url' is None when the thumbnail was downloaded before.
     """
 
-    thumb_link = await pillar_call(file.thumbnail, desired_size)
+    root, ext = os.path.splitext(file['file_path'])
+    thumb_fname = sanitize_filename('{0}-{1}.jpg'.format(root, desired_size))
+    thumb_path = os.path.abspath(os.path.join(directory, thumb_fname))
+
+    # Thumbnail links aren't snapshotted; a thumbnail that was downloaded before will do.
+    try:
+        thumb_link = await with_offline_fallback(
+            snapshot_key('File.thumbnail', file['_id'], desired_size),
+            lambda: pillar_call(file.thumbnail, desired_size, priority=priority),
+            snapshot=False)
+    except offline.OfflineError:
+        if not os.path.exists(thumb_path):
+            raise
+        return None, thumb_path
 
     if thumb_link is None:
         raise ValueError("File {} has no thumbnail of size {}"
                          .format(file['_id'], desired_size))
 
-    root, ext = os.path.splitext(file['file_path'])
-    thumb_fname = sanitize_filename('{0}-{1}.jpg'.format(root, desired_size))
-    thumb_path = os.path.abspath(os.path.join(directory, thumb_fname))
-
     return thumb_link, thumb_path
 
 
+@deadline.budgeted(deadline.TEXTURE_FOLDER)
 async def fetch_texture_thumbs(parent_node_uuid: str, desired_size: str,
                                thumbnail_directory: str,
                                *,
                                thumbnail_loading: callable,
                                thumbnail_loaded: callable,
+                               priority=Priority.VISIBLE,
                                future: asyncio.Future = None):
     """Generator, fetches all texture thumbnails in a certain parent node.
 
     @param parent_node_uuid: the UUID of the parent node. All sub-nodes will be downloaded.
     @param desired_size: size indicator, from 'sbtmlh'.
     @param thumbnail_directory: directory in which to store the downloaded thumbnails.
-    @param thumbnail_loading: callback function that takes (pillarsdk.Node, pillarsdk.File)
-        parameters, which is called before a thumbnail will be downloaded. This allows you to
-        show a "downloading" indicator.
-    @param thumbnail_loaded: callback function that takes (pillarsdk.Node, pillarsdk.File object,
-        thumbnail path) parameters, which is called for every thumbnail after it's been downloaded.
+    @param thumbnail_loading: callback function that takes (listing.NodeRecord,
+        listing.NodeRecord) parameters, which is called before a thumbnail will be downloaded.
+        This allows you to show a "downloading" indicator.
+    @param thumbnail_loaded: callback function that takes (listing.NodeRecord, pillarsdk.File
+        object, thumbnail path) parameters, which is called for every thumbnail after it's been
+        downloaded.
+    @param priority: scheduling priority of the Pillar calls and thumbnail downloads.
     @param future: Future that's inspected; if it is not None and cancelled, texture downloading
         is aborted.
     """
 
-    # Download all texture nodes in parallel.
+    # Download all texture nodes in parallel. Thumbnails of a page of nodes
+    # are downloaded while the next page is still being fetched.
     log.debug('Getting child nodes of node %r', parent_node_uuid)
-    texture_nodes = await get_nodes(parent_node_uuid=parent_node_uuid,
-                                    node_type=TEXTURE_NODE_TYPES)
+    pages = iter_node_record_pages(parent_node_uuid=parent_node_uuid,
+                                   node_type=TEXTURE_NODE_TYPES,
+                                   priority=priority)
+    tasks = []
+    try:
+        async for texture_nodes in pages:
+            if is_cancelled(future):
+                log.warning('fetch_texture_thumbs: Texture downloading cancelled')
+                break
+
+            tasks.extend(asyncio.ensure_future(
+                download_texture_thumbnail(texture_node, desired_size,
+                                           thumbnail_directory,
+                                           thumbnail_loading=thumbnail_loading,
+                                           thumbnail_loaded=thumbnail_loaded,
+                                           priority=priority,
+                                           future=future))
+                for texture_node in texture_nodes)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        pages.close()
+
+    # A failing thumbnail shouldn't abort the downloading of the others.
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    _log_gather_errors('fetch_texture_thumbs', results)
 
-    if is_cancelled(future):
-        log.warning('fetch_texture_thumbs: Texture downloading cancelled')
-        return
+    log.info('fetch_texture_thumbs: Done downloading texture thumbnails')
 
-    coros = (download_texture_thumbnail(texture_node, desired_size,
-                                        thumbnail_directory,
-                                        thumbnail_loading=thumbnail_loading,
-                                        thumbnail_loaded=thumbnail_loaded,
-                                        future=future)
-             for texture_node in texture_nodes)
 
-    # raises any exception from failed handle_texture_node() calls.
-    await asyncio.gather(*coros)
+def _log_gather_errors(func_name: str, results: list):
+    """Logs the exceptions in the results of asyncio.gather(..., return_exceptions=True)."""
 
-    log.info('fetch_texture_thumbs: Done downloading texture thumbnails')
+    errors = [result for result in results
+              if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError)]
+    for error in errors:
+        log.warning('%s: %s: %s', func_name, type(error).__name__, error)
+    if errors:
+        log.warning('%s: %i of %i downloads failed', func_name, len(errors), len(results))
 
 
-async def download_texture_thumbnail(texture_node, desired_size: str,
+async def download_texture_thumbnail(texture_node: listing.NodeRecord, desired_size: str,
                                      thumbnail_directory: str,
                                      *,
                                      thumbnail_loading: callable,
                                      thumbnail_loaded: callable,
+                                     priority=Priority.VISIBLE,
                                      future: asyncio.Future = None):
     # Skip non-texture nodes, as we can't thumbnail them anyway.
     if texture_node['node_type'] not in TEXTURE_NODE_TYPES:
@@ -562,44 +1577,43 @@ async def download_texture_thumbnail(texture_node, desired_size: str,
         # Fall back to the first texture file, if it exists.
         log.debug('Node %r does not have a picture, falling back to first file.',
                   texture_node['_id'])
-        files = texture_node.properties and texture_node.properties.files
-        if not files:
-            log.info('Node %r does not have a picture nor files, skipping.', texture_node['_id'])
-            return
-        pic_uuid = files[0].file
+        pic_uuid = texture_node.first_file
         if not pic_uuid:
             log.info('Node %r does not have a picture nor files, skipping.', texture_node['_id'])
             return
 
     # Load the File that belongs to this texture node's picture.
     loop.call_soon_threadsafe(thumbnail_loading, texture_node, texture_node)
-    file_desc = await pillar_call(pillarsdk.File.find, pic_uuid, params={
-        'projection': {'filename': 1, 'variations': 1, 'width': 1, 'height': 1,
-                       'length': 1},
-    })
+    file_desc = thumb_path = None
+    try:
+        file_desc = await find_file_doc(pic_uuid, THUMBNAIL_FILE_PROJECTION, priority=priority)
 
-    if file_desc is None:
-        log.warning('Unable to find file for texture node %s', pic_uuid)
+        if file_desc is None:
+            log.warning('Unable to find file for texture node %s', pic_uuid)
+        else:
+            if is_cancelled(future):
+                log.debug('fetch_texture_thumbs cancelled before downloading file %r',
+                          file_desc['_id'])
+                return
+
+            # Get the thumbnail information from Pillar
+            thumb_url, thumb_path = await fetch_thumbnail_info(file_desc, thumbnail_directory,
+                                                               desired_size, priority=priority)
+            if thumb_path is None:
+                # The task got cancelled, we should abort too.
+                log.debug('fetch_texture_thumbs cancelled while downloading file %r',
+                          file_desc['_id'])
+                return
+
+            if thumb_url is not None:
+                # Cached headers are stored next to thumbnails in sidecar files.
+                header_store = '%s.headers' % thumb_path
+                await download_to_file(thumb_url, thumb_path, header_store=header_store,
+                                       priority=priority, revalidate_in_background=True,
+                                       future=future)
+    except offline.OfflineError as ex:
+        log.debug('No thumbnail for texture node %s while offline: %s', texture_node['_id'], ex)
         thumb_path = None
-    else:
-        if is_cancelled(future):
-            log.debug('fetch_texture_thumbs cancelled before downloading file %r',
-                      file_desc['_id'])
-            return
-
-        # Get the thumbnail information from Pillar
-        thumb_url, thumb_path = await fetch_thumbnail_info(file_desc, thumbnail_directory,
-                                                           desired_size)
-        if thumb_path is None:
-            # The task got cancelled, we should abort too.
-            log.debug('fetch_texture_thumbs cancelled while downloading file %r',
-                      file_desc['_id'])
-            return
-
-        # Cached headers are stored next to thumbnails in sidecar files.
-        header_store = '%s.headers' % thumb_path
-
-        await download_to_file(thumb_url, thumb_path, header_store=header_store, future=future)
 
     loop.call_soon_threadsafe(thumbnail_loaded, texture_node, file_desc, thumb_path)
 
@@ -632,8 +1646,9 @@ async def fetch_node_files(node: pillarsdk.Node,
                                future=future)
              for file_ref in node.properties.files)
 
-    # raises any exception from failed handle_texture_node() calls.
-    await asyncio.gather(*coros)
+    # A failing file document shouldn't abort the downloading of the others.
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    _log_gather_errors('fetch_node_files', results)
 
     log.info('fetch_node_files: Done downloading %i files', len(node.properties.files))
 
@@ -652,10 +1667,7 @@ async def download_file_doc(file_id,
 
     # Load the File that belongs to this texture node's picture.
     loop.call_soon_threadsafe(file_doc_loading, file_id)
-    file_desc = await pillar_call(pillarsdk.File.find, file_id, params={
-        'projection': {'filename': 1, 'variations': 1, 'width': 1, 'height': 1,
-                       'length': 1},
-    })
+    file_desc = await find_file_doc(file_id, THUMBNAIL_FILE_PROJECTION)
 
     if file_desc is None:
         log.warning('Unable to find File for file_id %s', file_id)
@@ -672,11 +1684,16 @@ async def download_file_by_uuid(file_uuid,
                                 file_loading: callable = None,
                                 file_loaded: callable = None,
                                 file_loaded_sync: callable = None,
+                                priority=Priority.VISIBLE,
+                                texture_store: blob_store.BlobStore = None,
                                 future: asyncio.Future):
     """Downloads a file from Pillar by its UUID.
 
     :param filename: overrules the filename in file_doc['filename'] if given.
         The extension from file_doc['filename'] is still used, though.
+    :param priority: scheduling priority of the Pillar call and the download.
+    :param texture_store: when given, the file is downloaded into this store,
+        and linked from there into target_directory.
     """
     if is_cancelled(future):
         log.debug('download_file_by_uuid(%r) cancelled.', file_uuid)
@@ -684,14 +1701,9 @@ async def download_file_by_uuid(file_uuid,
 
     loop = asyncio.get_event_loop()
 
-    # Find the File document.
-    file_desc = await pillar_call(pillarsdk.File.find, file_uuid, params={
-        'projection': {'link': 1, 'filename': 1, 'length': 1},
-    })
-
-    # Save the file document to disk
-    metadata_file = os.path.join(metadata_directory, 'files', '%s.json' % file_uuid)
-    save_as_json(file_desc, metadata_file)
+    # Find the File document, from disk if we downloaded it before.
+    file_desc = await find_file_doc_cached(file_uuid, metadata_directory,
+                                           DOWNLOAD_FILE_PROJECTION, priority=priority)
 
     # Let the caller override the filename root.
     root, ext = os.path.splitext(file_desc['filename'])
@@ -708,11 +1720,24 @@ async def download_file_by_uuid(file_uuid,
     if file_loading is not None:
         loop.call_soon_threadsafe(file_loading, file_path, file_desc, map_type)
 
-    # Cached headers are stored in the project space
-    header_store = os.path.join(metadata_directory, 'files',
-                                sanitize_filename('%s.headers' % file_uuid))
+    md5 = utils.md5_hex(file_desc['md5'])
+    if texture_store is None:
+        # Cached headers are stored in the project space
+        header_store = os.path.join(metadata_directory, 'files',
+                                    sanitize_filename('%s.headers' % file_uuid))
+
+        await download_to_file(file_url, file_path, header_store=header_store,
+                               priority=priority, expected_md5=md5, future=future)
+    else:
+        blob_path = texture_store.blob_path(file_uuid, md5, ext)
+
+        def download_blob():
+            return download_to_file(file_url, blob_path, header_store=blob_path + '.headers',
+                                    priority=priority, expected_md5=md5, future=future)
 
-    await download_to_file(file_url, file_path, header_store=header_store, future=future)
+        await blob_download_single_flight.run(blob_path, download_blob)
+        # Linking falls back to copying the file, so keep it off the loop.
+        await loop.run_in_executor(None, texture_store.link, blob_path, file_path)
 
     if file_loaded is not None:
         loop.call_soon_threadsafe(file_loaded, file_path, file_desc, map_type)
@@ -720,12 +1745,47 @@ async def download_file_by_uuid(file_uuid,
         await file_loaded_sync(file_path, file_desc, map_type)
 
 
+async def open_remote_blend(file_uuid: str, *,
+                            block_size: int = remote_file.DEFAULT_BLOCK_SIZE,
+                            future: asyncio.Future = None):
+    """Opens a blend file on the Cloud for reading, without downloading all of it.
+
+    Only the parts of the file that are actually read are downloaded, using
+    HTTP Range requests. Note that reading from the returned BlendFile is
+    blocking, so do it in an executor when using it from asyncio code.
+
+    :returns: a blendfile.BlendFile, or None if the task was cancelled.
+    """
+
+    from . import blendfile
+
+    if is_cancelled(future):
+        log.debug('open_remote_blend(%r) cancelled.', file_uuid)
+        return None
+
+    file_desc = await pillar_call(pillarsdk.File.find, file_uuid, params={
+        'projection': {'link': 1, 'filename': 1, 'length': 1},
+    })
+
+    reader = remote_file.HTTPRangeReader(file_desc['link'],
+                                         session=uncached_session,
+                                         block_size=block_size)
+
+    loop = asyncio.get_event_loop()
+    bfile = await loop.run_in_executor(None, blendfile.open_blend, reader)
+    log.debug('Opened remote blend file %s using %i requests, %i bytes transferred',
+              file_uuid, reader.request_count, reader.bytes_fetched)
+    return bfile
+
+
 async def download_texture(texture_node,
                            target_directory: str,
                            metadata_directory: str,
                            *,
                            texture_loading: callable,
                            texture_loaded: callable,
+                           priority=Priority.INTERACTIVE,
+                           texture_store: blob_store.BlobStore = None,
                            future: asyncio.Future):
     node_type_name = texture_node['node_type']
     if node_type_name not in TEXTURE_NODE_TYPES:
@@ -744,43 +1804,104 @@ async def download_texture(texture_node,
                                     map_type=file_info.map_type or file_info.resolution,
                                     file_loading=texture_loading,
                                     file_loaded=texture_loaded,
+                                    priority=priority,
+                                    texture_store=texture_store,
                                     future=future)
         downloaders.append(dlr)
 
     return await asyncio.gather(*downloaders, return_exceptions=True)
 
 
-async def upload_file(project_id: str, file_path: pathlib.Path, *,
-                      future: asyncio.Future) -> str:
-    """Uploads a file to the Blender Cloud, returning a file document ID."""
-
-    from .blender import PILLAR_SERVER_URL
+def basic_auth_header(username: str, password: str) -> str:
+    credentials = ('%s:%s' % (username, password)).encode('utf8')
+    return 'Basic %s' % base64.b64encode(credentials).decode('ascii')
 
-    loop = asyncio.get_event_loop()
-    url = urllib.parse.urljoin(PILLAR_SERVER_URL, '/storage/stream/%s' % project_id)
 
-    # Upload the file in a different thread.
-    def upload():
-        auth_token = blender_id_subclient()['token']
+@deadline.budgeted(deadline.UPLOAD)
+async def upload_file(project_id: str, file_path: pathlib.Path, *,
+                      progress: callable = None,
+                      resumable=False,
+                      priority=Priority.INTERACTIVE,
+                      mimetype: str = None,
+                      future: asyncio.Future = None) -> str:
+    """Uploads a file to the Blender Cloud, returning a file document ID.
+
+    The file is streamed from disk while uploading; cancelling the future
+    stops the upload at the next block. Error responses are raised as the
+    pillarsdk exception for their status code, like they would be by
+    pillarsdk.File.upload_to_project().
+
+    :param progress: called with (bytes sent, file size) while uploading.
+        This can happen in an executor thread; see upload.progress_reporter().
+    :param resumable: upload in chunks using the resumable upload protocol
+        (see the upload module), so that a dropped connection only requires
+        re-sending the current chunk. Requires server support.
+    :param priority: determines the bandwidth budget the upload draws from.
+    :param mimetype: MIME type of the file; guessed from its name when not given.
+    """
 
-        with file_path.open(mode='rb') as infile:
-            return uncached_session.post(url,
-                                         files={'file': infile},
-                                         auth=(auth_token, SUBCLIENT_ID))
+    endpoint = pillar_api().endpoint
+    if resumable:
+        url = urllib.parse.urljoin(endpoint, '/storage/resumable/%s' % project_id)
+    else:
+        url = urllib.parse.urljoin(endpoint, '/storage/stream/%s' % project_id)
 
     # Check for cancellation even before we start our POST request
     if is_cancelled(future):
         log.debug('Uploading was cancelled before doing the POST')
         raise asyncio.CancelledError('Uploading was cancelled')
 
-    log.debug('Performing POST %s', url)
-    response = await loop.run_in_executor(None, upload)
-    log.debug('Status %i from POST %s', response.status_code, url)
-    response.raise_for_status()
+    auth_token = blender_id_subclient()['token']
+    headers = {
+        'Authorization': basic_auth_header(auth_token, SUBCLIENT_ID),
+    }
+
+    bandwidth_throttle = bandwidth.upload_throttle(priority)
+    transfer_group = metrics.transfer_group(url, str(file_path))
+    stats = metrics.registry.stats('upload', *transfer_group)
 
-    resp = response.json()
+    def throttle(amount: int) -> float:
+        stats.bytes_sent += amount
+        return bandwidth_throttle(amount)
+
+    with metrics.registry.measure('upload', *transfer_group):
+        try:
+            if resumable:
+                log.debug('Performing resumable upload to %s', url)
+                resp = await upload.resumable_upload(
+                    file_transport(), url, file_path,
+                    headers=headers,
+                    mimetype=mimetype,
+                    policy=retry_policy,
+                    breaker=resilience.breaker_for_url(url),
+                    is_transient=is_overload_error,
+                    progress=progress,
+                    is_cancelled=lambda: is_cancelled(future),
+                    throttle=throttle)
+            else:
+                content_type, body = upload.multipart_file_body(
+                    'file', file_path, mimetype=mimetype, progress=progress,
+                    is_cancelled=lambda: is_cancelled(future), throttle=throttle)
+                headers['Content-Type'] = content_type
+                headers['Content-Length'] = str(len(body))
+
+                log.debug('Performing POST %s', url)
+                with (await file_transport().request('POST', url, headers=headers, body=body)) \
+                        as response:
+                    log.debug('Status %i from POST %s', response.status_code, url)
+                    response.raise_for_status()
+                    resp = await response.json()
+        except (http_transport.HTTPError, requests.exceptions.HTTPError) as ex:
+            error_class = pillarsdk.exceptions.exception_for_status(ex.response.status_code)
+            if error_class is None:
+                raise
+            raise error_class(ex.response) from ex
     log.debug('Upload response: %s', resp)
 
+    if resp.get('status', 'ok') != 'ok':
+        log.error('Upload was not accepted: %s', resp)
+        raise PillarError('Upload was not accepted: %s' % resp)
+
     try:
         file_id = resp['file_id']
     except KeyError:
@@ -798,6 +1919,7 @@ def is_cancelled(future: asyncio.Future) -> bool:
 
 
 class PillarOperatorMixin:
+    @tracing.coroutine_span('pillar')
     async def check_credentials(self, context, required_roles) -> bool:
         """Checks credentials with Pillar, and if ok returns the user document from Pillar/MongoDB.
 
@@ -840,6 +1962,7 @@ class PillarOperatorMixin:
                     'Please subscribe to the blender cloud at https://cloud.blender.org/join')
 
 
+@tracing.coroutine_span('pillar')
 async def find_or_create_node(where: dict,
                               additional_create_props: dict = None,
                               projection: dict = None,
@@ -882,17 +2005,174 @@ async def find_or_create_node(where: dict,
 async def attach_file_to_group(file_path: pathlib.Path,
                                home_project_id: str,
                                group_node_id: str,
-                               user_id: str = None) -> pillarsdk.Node:
-    """Creates an Asset node and attaches a file document to it."""
-
-    node = await pillar_call(pillarsdk.Node.create_asset_from_file,
-                             home_project_id,
-                             group_node_id,
-                             'file',
-                             str(file_path),
-                             extra_where=user_id and {'user': user_id},
+                               user_id: str = None,
+                               *,
+                               progress: callable = None,
+                               future: asyncio.Future = None) -> pillarsdk.Node:
+    """Creates an Asset node and attaches a file document to it.
+
+    The file is only uploaded when it wasn't uploaded to the project before.
+
+    :param progress: passed to upload_file().
+    :param future: cancelling this future stops the upload.
+    """
+
+    node = await upload_asset_file(home_project_id,
+                                   group_node_id,
+                                   'file',
+                                   str(file_path),
+                                   extra_where=user_id and {'user': user_id},
+                                   progress=progress,
+                                   future=future)
+
+    return node
+
+
+def upload_index() -> upload.UploadIndex:
+    """Returns the index of uploaded files, stored in the user's cache directory."""
+
+    global _upload_index
+
+    if _upload_index is None:
+        _upload_index = upload.UploadIndex(
+            os.path.join(cache.cache_directory('uploads'), 'file_ids.json'))
+    return _upload_index
+
+
+async def find_uploaded_file(project_id: str, md5: str) -> str:
+    """Returns the ID of a file document in the project with this MD5, or None.
+
+    The local upload index is consulted first, so that Pillar is only
+    queried for files we didn't upload ourselves.
+    """
+
+    file_id = upload_index().get(project_id, md5)
+    if file_id is not None:
+        return file_id
+
+    # Depending on the storage backend, Pillar has the MD5 hex or base64 encoded.
+    digest = bytes.fromhex(md5)
+    params = {
+        'where': {'project': project_id,
+                  'md5': {'$in': [md5, base64.b64encode(digest).decode('ascii')]}},
+        'projection': {'_id': 1},
+        'max_results': 1,
+    }
+    found = await pillar_call(pillarsdk.File.all, params, caching=False)
+    if not found['_items']:
+        return None
+
+    file_id = found['_items'][0]['_id']
+    upload_index().remember(project_id, md5, file_id)
+    return file_id
+
+
+async def upload_asset_file(project_id: str,
+                            parent_node_id: str,
+                            asset_type: str,
+                            filename: str,
+                            *,
+                            extra_where: dict = None,
+                            always_create_new_node=False,
+                            fileobj=None,
+                            progress: callable = None,
+                            future: asyncio.Future = None) -> pillarsdk.Node:
+    """Uploads the file and creates or updates an asset node for it.
+
+    Works like pillarsdk.Node.create_asset_from_file(), except that the file
+    isn't uploaded again when the project already has a file with the same
+    contents; the existing file document is used instead. An existing asset
+    node that already refers to that file is returned unchanged.
+
+    :param fileobj: file object to upload instead of the file itself; the
+        filename then only determines the name on the server.
+    :param progress: passed to upload_file().
+    :param future: cancelling this future stops the upload.
+    """
+
+    loop = asyncio.get_event_loop()
+    md5 = await loop.run_in_executor(None, functools.partial(upload.file_md5, filename,
+                                                             fileobj=fileobj))
+
+    file_id = await find_uploaded_file(project_id, md5)
+    if file_id is not None:
+        log.info('%s was uploaded before as file %s, not uploading again', filename, file_id)
+        try:
+            return await pillar_call(_asset_node_for_file,
+                                     project_id, parent_node_id, asset_type,
+                                     os.path.basename(filename), file_id,
+                                     extra_where=extra_where,
+                                     always_create_new_node=always_create_new_node,
+                                     caching=False)
+        except (pillarsdk.exceptions.ResourceNotFound,
+                pillarsdk.exceptions.ResourceInvalid,
+                pillarsdk.exceptions.BadRequest) as ex:
+            # The file document may have been deleted since we uploaded it.
+            log.info('Unable to reuse file %s, uploading %s: %s', file_id, filename, ex)
+            upload_index().forget(project_id, md5)
+
+    if fileobj is None:
+        file_id = await upload_file(project_id, pathlib.Path(filename),
+                                    progress=progress, future=future)
+    else:
+        # Uploads are streamed from disk, so the file object has to be written there first.
+        with tempfile.TemporaryDirectory(prefix='bcloud-upload-') as tmpdir:
+            file_path = pathlib.Path(tmpdir) / os.path.basename(filename)
+            await loop.run_in_executor(None, _write_fileobj, fileobj, file_path)
+            file_id = await upload_file(project_id, file_path,
+                                        progress=progress, future=future)
+    upload_index().remember(project_id, md5, file_id)
+
+    return await pillar_call(_asset_node_for_file,
+                             project_id, parent_node_id, asset_type,
+                             os.path.basename(filename), file_id,
+                             extra_where=extra_where,
+                             always_create_new_node=always_create_new_node,
                              caching=False)
 
+
+def _write_fileobj(fileobj, file_path: pathlib.Path):
+    with file_path.open('wb') as outfile:
+        shutil.copyfileobj(fileobj, outfile)
+    fileobj.seek(0)
+
+
+def _asset_node_for_file(project_id: str, parent_node_id: str, asset_type: str, name: str,
+                         file_id: str, *, extra_where: dict, always_create_new_node: bool,
+                         api) -> pillarsdk.Node:
+    """Creates or updates an asset node for an already uploaded file.
+
+    Mirrors the node handling of pillarsdk.Node.create_asset_from_file().
+    Performs blocking HTTP requests, so use via pillar_call().
+    """
+
+    basic_properties = {
+        'project': project_id,
+        'node_type': 'asset',
+        'name': name,
+    }
+    if parent_node_id:
+        basic_properties['parent'] = parent_node_id
+
+    if not always_create_new_node:
+        where = dict(basic_properties)
+        if extra_where:
+            where.update(extra_where)
+        existing_node = pillarsdk.Node.find_first({'where': where}, api=api)
+        if existing_node:
+            if existing_node.properties.file == file_id and \
+                    existing_node.properties.content_type == asset_type:
+                log.debug('Node %s already refers to file %s', existing_node['_id'], file_id)
+                return existing_node
+            existing_node.properties.content_type = asset_type
+            existing_node.properties.file = file_id
+            existing_node.update(api=api)
+            return existing_node
+
+    basic_properties['properties'] = {'content_type': asset_type,
+                                      'file': file_id}
+    node = pillarsdk.Node(basic_properties)
+    node.create(api=api)
     return node
 
 
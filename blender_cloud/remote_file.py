@@ -0,0 +1,297 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Read-only file-like access to remote files via HTTP Range requests.
+
+This allows us to inspect (parts of) a file on the Cloud without downloading
+it completely. For example, parsing the DNA and a few blocks of a blend file
+only costs a few requests, regardless of the size of the file.
+
+The reader is blocking, and should be used from a thread when it is used in
+combination with asyncio.
+"""
+
+import collections
+import io
+import logging
+import os
+import re
+
+import requests
+
+from . import deadline
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_CACHED_BLOCKS = 256  # so by default at most 16 MiB is kept in memory.
+
+_content_range_re = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class RangeRequestError(IOError):
+    """Raised when the server does not properly respond to a Range request."""
+
+
+class HTTPRangeReader(io.RawIOBase):
+    """Seekable, read-only file object backed by HTTP Range GET requests.
+
+    Data is fetched in blocks of `block_size` bytes, aligned to multiples of
+    that size, and kept in an LRU cache. Consecutive missing blocks are fetched
+    with a single request.
+
+    :param url: the URL to read from.
+    :param session: the requests.Session to use; defaults to pillar.uncached_session.
+    :param block_size: number of bytes per cached block.
+    :param max_cached_blocks: maximum number of blocks to keep in memory.
+    :param headers: extra HTTP headers to send with every request.
+    """
+
+    def __init__(self, url: str, *,
+                 session: requests.Session = None,
+                 block_size: int = DEFAULT_BLOCK_SIZE,
+                 max_cached_blocks: int = DEFAULT_MAX_CACHED_BLOCKS,
+                 headers: dict = None):
+        super().__init__()
+
+        if block_size <= 0:
+            raise ValueError('block_size must be positive, not %r' % block_size)
+        if max_cached_blocks <= 0:
+            raise ValueError('max_cached_blocks must be positive, not %r' % max_cached_blocks)
+
+        if session is None:
+            from . import pillar
+            session = pillar.uncached_session
+
+        self.url = url
+        self.name = url
+        self.session = session
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.headers = dict(headers or {})
+
+        self._position = 0
+        self._size = None
+        self._etag = None
+        self._blocks = collections.OrderedDict()  # block index -> bytes, in LRU order.
+
+        # Statistics, mostly useful for testing and debugging.
+        self.request_count = 0
+        self.bytes_fetched = 0
+
+    def __repr__(self):
+        return '<%s url=%r size=%r>' % (type(self).__name__, self.url, self._size)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    @property
+    def size(self) -> int:
+        """The size of the remote file in bytes."""
+
+        if self._size is None:
+            self._fetch_blocks(0, 1)
+        return self._size
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._checkClosed()
+
+        if whence == os.SEEK_SET:
+            new_position = offset
+        elif whence == os.SEEK_CUR:
+            new_position = self._position + offset
+        elif whence == os.SEEK_END:
+            new_position = self.size + offset
+        else:
+            raise ValueError('Invalid whence %r' % whence)
+
+        if new_position < 0:
+            raise ValueError('Negative seek position %i' % new_position)
+
+        self._position = new_position
+        return new_position
+
+    def readinto(self, buffer) -> int:
+        self._checkClosed()
+
+        wanted = len(buffer)
+        if wanted == 0:
+            return 0
+
+        start = self._position
+        end = min(start + wanted, self.size)
+        if start >= end:
+            return 0
+
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+        blocks = self._ensure_blocks(first_block, last_block + 1)
+
+        view = memoryview(buffer)
+        written = 0
+        for block_idx in range(first_block, last_block + 1):
+            try:
+                block = blocks[block_idx]
+            except KeyError:
+                break  # The file turned out to be shorter.
+
+            block_start = block_idx * self.block_size
+            from_ofs = max(start, block_start) - block_start
+            to_ofs = min(end, block_start + len(block)) - block_start
+            chunk_len = to_ofs - from_ofs
+            view[written:written + chunk_len] = block[from_ofs:to_ofs]
+            written += chunk_len
+
+        self._position += written
+        return written
+
+    def _ensure_blocks(self, first_block: int, end_block: int) -> dict:
+        """Returns the blocks in range(first_block, end_block), fetching missing ones.
+
+        Runs of missing blocks are fetched with one request each. The blocks
+        are returned as mapping from block index to bytes, as they may not
+        all fit in the cache.
+        """
+
+        blocks = {}
+        missing_start = None
+        for block_idx in range(first_block, end_block):
+            block = self._blocks.get(block_idx)
+            if block is not None:
+                self._blocks.move_to_end(block_idx)
+                blocks[block_idx] = block
+                if missing_start is not None:
+                    blocks.update(self._fetch_blocks(missing_start, block_idx))
+                    missing_start = None
+                continue
+            if missing_start is None:
+                missing_start = block_idx
+
+        if missing_start is not None:
+            blocks.update(self._fetch_blocks(missing_start, end_block))
+        return blocks
+
+    def _fetch_blocks(self, first_block: int, end_block: int) -> dict:
+        """Fetches the blocks in range(first_block, end_block) with a single request.
+
+        :returns: mapping from block index to bytes of the fetched blocks;
+            these can be more blocks than requested, or fewer at the end of the file.
+        """
+
+        byte_start = first_block * self.block_size
+        byte_end = end_block * self.block_size - 1
+        if self._size is not None:
+            byte_end = min(byte_end, self._size - 1)
+
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%i-%i' % (byte_start, byte_end)
+        if self._etag:
+            # Make sure we don't mix blocks from different versions of the file.
+            headers['If-Range'] = self._etag
+
+        log.debug('GET %s Range: %s', self.url, headers['Range'])
+        response = self.session.get(self.url, headers=headers, verify=True,
+                                    timeout=deadline.requests_timeout())
+        self.request_count += 1
+
+        if response.status_code == 416:
+            # Requested range not satisfiable; we're past the end of the file.
+            self._update_size_from_unsatisfiable(response)
+            return {}
+
+        response.raise_for_status()
+        data = response.content
+        self.bytes_fetched += len(data)
+
+        if response.status_code == 206:
+            start, total = self._parse_content_range(response)
+            if start != byte_start:
+                raise RangeRequestError('Requested range starting at %i, got %i'
+                                        % (byte_start, start))
+            if total is not None:
+                self._size = total
+        elif response.status_code == 200:
+            # The server ignored our Range header and sent the entire file.
+            # We might as well cache all of it.
+            log.info('Server does not support Range requests for %s, '
+                     'got the entire file (%i bytes)', self.url, len(data))
+            self._size = len(data)
+            byte_start = 0
+        else:
+            raise RangeRequestError('Unexpected status %i for Range request on %s'
+                                    % (response.status_code, self.url))
+
+        etag = response.headers.get('ETag')
+        if self._etag and etag and etag != self._etag:
+            raise RangeRequestError('Remote file %s changed while reading it' % self.url)
+        self._etag = self._etag or etag
+
+        return self._store_blocks(byte_start, data)
+
+    def _store_blocks(self, byte_start: int, data: bytes) -> dict:
+        """Caches the data, evicting the least recently used blocks.
+
+        :returns: mapping from block index to bytes of all blocks in the data,
+            including those that didn't fit in the cache.
+        """
+        assert byte_start % self.block_size == 0
+
+        blocks = {}
+        block_idx = byte_start // self.block_size
+        for ofs in range(0, len(data), self.block_size):
+            block = data[ofs:ofs + self.block_size]
+            blocks[block_idx] = block
+            self._blocks[block_idx] = block
+            self._blocks.move_to_end(block_idx)
+            block_idx += 1
+
+        while len(self._blocks) > self.max_cached_blocks:
+            self._blocks.popitem(last=False)
+        return blocks
+
+    @staticmethod
+    def _parse_content_range(response) -> (int, int):
+        content_range = response.headers.get('Content-Range', '')
+        match = _content_range_re.match(content_range)
+        if not match:
+            raise RangeRequestError('Invalid Content-Range header %r' % content_range)
+
+        start = int(match.group(1))
+        total = match.group(3)
+        return start, (None if total == '*' else int(total))
+
+    def _update_size_from_unsatisfiable(self, response):
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes \*/(\d+)', content_range)
+        if not match:
+            raise RangeRequestError('Range not satisfiable on %s' % self.url)
+        self._size = int(match.group(1))
+
+    def close(self):
+        self._blocks.clear()
+        super().close()
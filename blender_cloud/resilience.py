@@ -0,0 +1,253 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Retrying of transient errors, and circuit breakers that fail fast while a host is down."""
+
+import asyncio
+import email.utils
+import logging
+import random
+import time
+import urllib.parse
+
+from . import deadline
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a call is refused because the circuit breaker of its host is open."""
+
+    def __init__(self, host: str, retry_in: float):
+        super().__init__('%s is unavailable, not retrying for another %.0f seconds'
+                         % (host, retry_in))
+        self.host = host
+        self.retry_in = retry_in
+
+
+def retry_after_seconds(exception: BaseException) -> float:
+    """Returns the delay requested by the Retry-After header of the exception's response.
+
+    :returns: the delay in seconds, or None if there is no (valid) Retry-After header.
+    """
+
+    response = getattr(exception, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        timestamp = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        log.debug('Unable to parse Retry-After header %r', value)
+        return None
+    return max(0.0, timestamp - time.time())
+
+
+class RetryPolicy:
+    """Determines how often and how long to wait before retrying.
+
+    Uses exponential backoff with "full jitter": the n-th retry waits a
+    random time between 0 and min(max_delay, base_delay * 2**n) seconds.
+    A Retry-After header on the error response takes precedence, capped
+    at max_retry_after.
+
+    :param max_attempts: total number of attempts, including the first one.
+    """
+
+    def __init__(self, *, max_attempts=4, base_delay=0.5, max_delay=10.0,
+                 max_retry_after=60.0, rng: random.Random = None):
+        assert max_attempts >= 1
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.rng = rng or random.Random()
+
+    def delay(self, attempt: int, exception: BaseException) -> float:
+        """Returns the number of seconds to wait after the given failed attempt.
+
+        :param attempt: zero-based index of the attempt that failed.
+        """
+
+        retry_after = retry_after_seconds(exception)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return self.rng.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """Stops calls to a host after repeated failures.
+
+    After `failure_threshold` consecutive failures the circuit opens, and
+    calls fail immediately with CircuitOpenError. After `reset_timeout`
+    seconds a single trial call is let through (half-open); its outcome
+    closes or re-opens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host: str, *, failure_threshold=5, reset_timeout=30.0,
+                 clock=time.monotonic):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.state = self.CLOSED
+        self.failure_count = 0
+        self._opened_at = 0.0
+        self._trial_in_progress = False
+
+    def __repr__(self):
+        return '<%s %r %s failures=%i>' % (type(self).__name__, self.host,
+                                           self.state, self.failure_count)
+
+    def before_call(self):
+        """Raises CircuitOpenError when the call should not be performed."""
+
+        if self.state == self.CLOSED:
+            return
+
+        if self.state == self.OPEN:
+            retry_in = self._opened_at + self.reset_timeout - self.clock()
+            if retry_in > 0:
+                raise CircuitOpenError(self.host, retry_in)
+            log.info('Circuit breaker for %s is half-open, trying one call', self.host)
+            self.state = self.HALF_OPEN
+            self._trial_in_progress = False
+
+        # Half-open: only a single trial call at a time.
+        if self._trial_in_progress:
+            raise CircuitOpenError(self.host, self.reset_timeout)
+        self._trial_in_progress = True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            log.info('Circuit breaker for %s is closed again', self.host)
+        self.state = self.CLOSED
+        self.failure_count = 0
+        self._trial_in_progress = False
+
+    def record_failure(self):
+        self.failure_count += 1
+        self._trial_in_progress = False
+
+        if self.state == self.HALF_OPEN or self.failure_count >= self.failure_threshold:
+            if self.state != self.OPEN:
+                log.warning('Circuit breaker for %s opened after %i failures',
+                            self.host, self.failure_count)
+            self.state = self.OPEN
+            self._opened_at = self.clock()
+
+    def record_cancelled(self):
+        """Called when the call was cancelled; doesn't count as success or failure."""
+        self._trial_in_progress = False
+
+
+_breakers = {}
+
+
+def breaker_for_url(url: str) -> CircuitBreaker:
+    """Returns the circuit breaker for the host of this URL, creating it if necessary."""
+
+    host = urllib.parse.urlsplit(url).netloc
+    try:
+        return _breakers[host]
+    except KeyError:
+        breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+async def call_with_retries(coro_func, *,
+                            policy: RetryPolicy,
+                            breaker: CircuitBreaker,
+                            is_transient: callable,
+                            is_restartable: callable = None,
+                            retry=True,
+                            description=''):
+    """Awaits coro_func(), retrying transient errors.
+
+    :param coro_func: function without arguments returning an awaitable.
+        It is called once for every attempt.
+    :param policy: determines the number of attempts and the delays between them.
+    :param breaker: consulted before every attempt, and informed of the outcome.
+    :param is_transient: function that receives an exception and returns
+        whether it is a transient error. Only transient errors are retried
+        and counted as failures by the circuit breaker.
+    :param is_restartable: function that receives an exception and returns
+        whether the attempt failed on local state that it has since discarded,
+        like a partial download that doesn't match the file on the server.
+        Such a failure is restarted once, without delay, and doesn't count
+        as a circuit breaker failure.
+    :param retry: when False, only a single attempt is made. Use this for
+        calls that are not idempotent; the circuit breaker is still used.
+    :param description: used in log messages.
+    """
+
+    max_attempts = policy.max_attempts if retry else 1
+    attempt = 0
+    restarted = False
+    while True:
+        breaker.before_call()
+        try:
+            result = await coro_func()
+        except (asyncio.CancelledError, deadline.DeadlineExceeded):
+            # Running out of our own time budget says nothing about the host.
+            breaker.record_cancelled()
+            raise
+        except Exception as ex:
+            if is_restartable is not None and not restarted and is_restartable(ex):
+                breaker.record_success()  # The host answered, so it's up.
+                restarted = True
+                log.info('%s failed with %s, restarting', description or 'Call', ex)
+                continue
+            if not is_transient(ex):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+
+            attempt += 1
+            if attempt >= max_attempts or breaker.state == CircuitBreaker.OPEN:
+                raise
+
+            delay = policy.delay(attempt - 1, ex)
+            remaining = deadline.remaining()
+            if remaining is not None and delay >= remaining:
+                log.info('%s failed with %s, no time left to retry', description or 'Call', ex)
+                raise
+            log.info('%s failed with %s, attempt %i of %i, retrying in %.1f seconds',
+                     description or 'Call', ex, attempt, max_attempts, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result
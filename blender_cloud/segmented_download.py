@@ -0,0 +1,288 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Downloads large files over multiple connections using HTTP Range requests.
+
+The file is split into pieces, which are fetched by a number of concurrent
+workers into a preallocated file. The number of workers adapts to the
+observed throughput: another worker is added as long as doing so increases
+the total throughput, up to MAX_SEGMENTS. The number of workers that was
+used is remembered as the starting point for the next download.
+
+A hash of the file can be computed along the way. Hashing has to happen in
+file order, so every piece is hashed as soon as all pieces before it are
+written, reading it back while it's still in the OS cache. This happens in
+an executor thread, through a file object of its own, so that the event
+loop isn't blocked.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Files smaller than this are downloaded over a single connection.
+THRESHOLD = 32 * 1024 * 1024
+PIECE_SIZE = 8 * 1024 * 1024
+MAX_SEGMENTS = 8
+
+# A worker is only added when the throughput increased by at least this factor.
+GROWTH_FACTOR = 1.1
+
+# Number of workers to start with; updated after every segmented download.
+initial_segments = 2
+
+
+class SegmentMismatch(IOError):
+    """Raised when the server doesn't return the requested range of the same file version."""
+
+
+def should_segment(response, total_length) -> bool:
+    """Returns whether a download should be segmented, given the response to a plain GET."""
+
+    if total_length is None or int(total_length) < THRESHOLD:
+        return False
+    return response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+
+class _Download:
+    def __init__(self, transport, url: str, outfile, total_length: int, validator: str, *,
+                 limiter, priority, is_cancelled: callable, chunk_size: int, hasher=None,
+                 hash_infile=None, throttle: callable = None):
+        self.transport = transport
+        self.url = url
+        self.outfile = outfile
+        self.total_length = total_length
+        self.validator = validator
+        self.limiter = limiter
+        self.priority = priority
+        self.is_cancelled = is_cancelled
+        self.chunk_size = chunk_size
+        self.hasher = hasher
+        # Unbuffered file object to read pieces back for hashing; a buffered
+        # one could return read-ahead data from before the piece was written.
+        self.hash_infile = hash_infile
+        self.throttle = throttle
+        self.hashed_until = 0
+        self._unhashed_pieces = {}  # mapping from start to end offset of written pieces.
+        self._hash_lock = asyncio.Lock()
+
+        self.pieces = collections.deque(
+            (start, min(start + PIECE_SIZE, total_length) - 1)
+            for start in range(0, total_length, PIECE_SIZE))
+        self.workers = []
+        self.started_workers = 0
+        self.growing = True
+        self.last_worker_helped = True
+
+        self.bytes_done = 0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._last_rate = None
+
+    async def run(self, first_response):
+        # The first response is a plain GET of the entire file; use it for the first piece.
+        first_piece = self.pieces.popleft()
+        self.workers.append(asyncio.ensure_future(self._worker(first_response, first_piece)))
+        for _ in range(min(initial_segments, len(self.pieces) + 1) - 1):
+            self._add_worker()
+
+        try:
+            # Workers can be added while we wait, so keep waiting until all
+            # pieces are written and hashed. Workers that are still waiting
+            # for a slot by then are cancelled below.
+            while self.bytes_done < self.total_length or self._hashing_pending():
+                running = [worker for worker in self.workers if not worker.done()]
+                if not running:
+                    break
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for worker in self.workers:
+                    if worker.done() and not worker.cancelled() and worker.exception():
+                        raise worker.exception()
+        finally:
+            for worker in self.workers:
+                worker.cancel()
+            # Wait for the workers to stop before the output file is closed;
+            # this also retrieves their exceptions.
+            await asyncio.gather(*self.workers, return_exceptions=True)
+
+        log.debug('Downloaded %s with %i segments', self.url, self.started_workers)
+        return self.started_workers
+
+    def _add_worker(self):
+        self.workers.append(asyncio.ensure_future(self._slotted_worker()))
+
+    async def _slotted_worker(self):
+        # The first worker runs in the slot of the caller; additional ones need their own.
+        async with self.limiter.slot(self.priority) as slot:
+            await self._worker(None, None, slot)
+
+    async def _worker(self, response, piece, slot=None):
+        self.started_workers += 1
+        if piece is not None:
+            await self._read_piece(response, piece, response_has_range=False)
+
+        while self.pieces:
+            piece = self.pieces.popleft()
+            start, end = piece
+            headers = {'Range': 'bytes=%i-%i' % (start, end)}
+            if self.validator:
+                headers['If-Range'] = self.validator
+            response = await self.transport.request('GET', self.url, headers=headers)
+            if slot is not None:
+                slot.response_started()
+            await self._read_piece(response, piece, response_has_range=True)
+
+    async def _read_piece(self, response, piece: tuple, *, response_has_range: bool):
+        start, end = piece
+        with response:
+            response.raise_for_status()
+            if response_has_range:
+                if response.status_code != 206:
+                    raise SegmentMismatch('Server sent status %i for range %i-%i of %s'
+                                          % (response.status_code, start, end, self.url))
+                content_range = response.headers.get('Content-Range', '')
+                expected = 'bytes %i-%i/%i' % (start, end, self.total_length)
+                if content_range != expected:
+                    raise SegmentMismatch('Server sent range %r instead of %r for %s'
+                                          % (content_range, expected, self.url))
+
+            position = start
+            while position <= end:
+                if self.is_cancelled():
+                    raise asyncio.CancelledError('Downloading was cancelled')
+                block = await response.read_chunk(min(self.chunk_size, end + 1 - position))
+                if not block:
+                    raise SegmentMismatch('Range %i-%i of %s ended at byte %i'
+                                          % (start, end, self.url, position))
+                self.outfile.seek(position)
+                self.outfile.write(block)
+                position += len(block)
+                if self.throttle is not None:
+                    await self.throttle(len(block))
+            # When this was the first response, the rest of the body is not
+            # read; closing the response closes its connection.
+
+        self._piece_done(start, end)
+        if self.hasher is not None:
+            await self._hash_pieces(start, end)
+
+    async def _hash_pieces(self, start: int, end: int):
+        """Hashes all pieces that are written contiguously from the start of the file."""
+
+        self._unhashed_pieces[start] = end
+        loop = asyncio.get_event_loop()
+        async with self._hash_lock:
+            while self.hashed_until in self._unhashed_pieces:
+                end = self._unhashed_pieces.pop(self.hashed_until)
+                # Make the written data visible to the other file object.
+                self.outfile.flush()
+                self.hashed_until = await loop.run_in_executor(
+                    None, self._hash_range, self.hashed_until, end)
+
+    def _hash_range(self, position: int, end: int) -> int:
+        """Hashes bytes position up to and including end; runs in an executor."""
+
+        self.hash_infile.seek(position)
+        while position <= end:
+            block = self.hash_infile.read(min(self.chunk_size, end + 1 - position))
+            if not block:
+                raise SegmentMismatch('Unable to read back byte %i of %s' % (position, self.url))
+            self.hasher.update(block)
+            position += len(block)
+        return position
+
+    def _hashing_pending(self) -> bool:
+        return self.hasher is not None and self.hashed_until < self.total_length
+
+    def _piece_done(self, start: int, end: int):
+        size = end + 1 - start
+        self.bytes_done += size
+        self._window_bytes += size
+        if not self.growing or not self.pieces:
+            return
+        if len(self.workers) >= MAX_SEGMENTS:
+            self.growing = False
+            return
+
+        # Measure once every worker finished about one piece since the last change.
+        if self._window_bytes < max(1, self.started_workers) * PIECE_SIZE:
+            return
+        now = time.monotonic()
+        rate = self._window_bytes / max(now - self._window_start, 1e-6)
+
+        if self._last_rate is not None and rate < self._last_rate * GROWTH_FACTOR:
+            log.debug('%i segments: %.1f MiB/s, not adding more', len(self.workers),
+                      rate / 2 ** 20)
+            self.growing = False
+            self.last_worker_helped = False
+            return
+
+        log.debug('%i segments: %.1f MiB/s, adding one', len(self.workers), rate / 2 ** 20)
+        self._last_rate = rate
+        self._window_start = now
+        self._window_bytes = 0
+        self._add_worker()
+
+
+async def download(transport, url: str, first_response, part_path: str, *,
+                   total_length: int, validator: str,
+                   limiter, priority, is_cancelled: callable, chunk_size=256 * 1024,
+                   hasher=None, throttle: callable = None):
+    """Downloads the file at the URL into part_path, over multiple connections.
+
+    :param transport: the http_transport to perform range requests with.
+    :param first_response: response to a plain GET of the URL; it is used for
+        the first piece of the file, and closed afterwards.
+    :param total_length: the size of the file.
+    :param validator: ETag or Last-Modified to use in If-Range headers, to
+        ensure all pieces come from the same version of the file.
+    :param limiter: the concurrency.AdaptiveLimiter that additional
+        connections acquire a slot from. The caller should already hold a
+        slot for the first response.
+    :param is_cancelled: function that returns True when the download should stop.
+    :param hasher: optional hashlib object, which is updated with the entire file.
+    :param throttle: optional coroutine function, awaited with the size of
+        every block that was downloaded.
+    """
+
+    global initial_segments
+
+    total_length = int(total_length)
+
+    # Preallocate the file, so that pieces can be written at their offsets.
+    with open(part_path, 'wb') as outfile:
+        outfile.truncate(total_length)
+
+    with open(part_path, 'r+b') as outfile, open(part_path, 'rb', buffering=0) as hash_infile:
+        dl = _Download(transport, url, outfile, total_length, validator,
+                       limiter=limiter, priority=priority, is_cancelled=is_cancelled,
+                       chunk_size=chunk_size, hasher=hasher, hash_infile=hash_infile,
+                       throttle=throttle)
+        segments = await dl.run(first_response)
+
+    if dl.bytes_done != total_length:
+        raise SegmentMismatch('Downloaded %i of %i bytes of %s'
+                              % (dl.bytes_done, total_length, url))
+
+    # When the last worker didn't increase throughput, start without it next time.
+    if not dl.last_worker_helped:
+        segments -= 1
+    initial_segments = max(1, segments)
@@ -0,0 +1,164 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Caching of the validated Pillar session.
+
+Every operator checks the user's credentials with Pillar before doing
+anything, which costs a round trip to Pillar's /users/me. The
+SessionManager remembers the user document for a while, per set of
+credentials, so that a new token or another user is never served a stale
+document. Concurrent validations and token refreshes are coalesced into
+one, and a cached validation that is about to expire is renewed in the
+background, so that operators don't have to wait for it.
+"""
+
+import asyncio
+import logging
+import time
+
+from . import concurrency
+
+log = logging.getLogger(__name__)
+
+# Seconds a validated user document is used before asking Pillar again.
+DEFAULT_TTL = 300.0
+
+# Seconds before expiry at which a cached validation is renewed in the background.
+REFRESH_MARGIN = 60.0
+
+
+class _Validation:
+    __slots__ = ('credentials', 'user', 'expires_at')
+
+    def __init__(self, credentials, user, expires_at: float):
+        self.credentials = credentials
+        self.user = user
+        self.expires_at = expires_at
+
+
+class SessionManager:
+    """Caches the validated user per set of credentials.
+
+    :param ttl: seconds a validation is valid.
+    :param refresh_margin: seconds before expiry at which a validation is
+        renewed in the background.
+    :param clock: function returning monotonic time in seconds; for testing.
+    """
+
+    def __init__(self, *, ttl=DEFAULT_TTL, refresh_margin=REFRESH_MARGIN, clock=time.monotonic):
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+
+        self._validation = None
+        self._single_flight = concurrency.SingleFlight('session')
+        self._background_tasks = set()
+
+        self.hits = 0  # number of validations served from the cache.
+        self.misses = 0  # number of validations that had to wait for Pillar.
+        self.refreshes = 0  # number of token refreshes.
+
+    def __repr__(self):
+        return '<%s hits=%i misses=%i refreshes=%i>' % (
+            type(self).__name__, self.hits, self.misses, self.refreshes)
+
+    def cached_user(self, credentials):
+        """Returns the cached user document for the credentials, or None."""
+
+        validation = self._validation
+        if validation is None or validation.credentials != credentials:
+            return None
+        if self.clock() >= validation.expires_at:
+            return None
+        return validation.user
+
+    async def validated_user(self, credentials, validate: callable):
+        """Returns the user document for the credentials, validating them when necessary.
+
+        :param credentials: hashable identification of the credentials, like
+            (user ID, token); a cached validation is only used for equal credentials.
+        :param validate: function without arguments returning a coroutine that
+            returns a tuple (user, cacheable). Its exceptions are propagated,
+            and drop the cached validation of these credentials.
+        """
+
+        user = self.cached_user(credentials)
+        if user is None:
+            self.misses += 1
+            return await self._validate(credentials, validate)
+
+        self.hits += 1
+        if self._validation.expires_at - self.clock() < self.refresh_margin:
+            self._revalidate_in_background(credentials, validate)
+        return user
+
+    def _validate(self, credentials, validate: callable):
+        async def run():
+            try:
+                user, cacheable = await validate()
+            except BaseException:
+                self._forget(credentials)
+                raise
+            if cacheable:
+                self._validation = _Validation(credentials, user, self.clock() + self.ttl)
+            return user
+
+        return self._single_flight.run(('validate', credentials), run)
+
+    def _revalidate_in_background(self, credentials, validate: callable):
+        if self._single_flight.in_flight:
+            return
+        log.debug('Renewing validation of Pillar credentials before it expires')
+
+        task = asyncio.ensure_future(self._validate(credentials, validate))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: asyncio.Task):
+        self._background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # The next call to validated_user() validates again, and reports the error.
+            log.info('Unable to renew validation of Pillar credentials: %s', task.exception())
+
+    async def refresh(self, credentials, refresh: callable):
+        """Refreshes the token, once for all concurrent callers with the same old credentials.
+
+        The cached validation is dropped, as the token is about to change.
+
+        :param credentials: the credentials that failed to validate.
+        :param refresh: function without arguments returning a coroutine that
+            obtains a new token.
+        """
+
+        async def run():
+            self.refreshes += 1
+            self.invalidate()
+            return await refresh()
+
+        return await self._single_flight.run(('refresh', credentials), run)
+
+    def _forget(self, credentials):
+        if self._validation is not None and self._validation.credentials == credentials:
+            self._validation = None
+
+    def invalidate(self):
+        """Drops the cached validation, so that the next check asks Pillar."""
+        self._validation = None
+
+
+manager = SessionManager()
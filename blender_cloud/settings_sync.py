@@ -34,7 +34,7 @@ import asyncio
 import pillarsdk
 from pillarsdk import exceptions as sdk_exceptions
 from .pillar import pillar_call
-from . import async_loop, pillar, cache, blendfile, home_project
+from . import async_loop, pillar, cache, blendfile, home_project, upload
 
 SETTINGS_FILES_TO_UPLOAD = ['userpref.blend', 'startup.blend']
 
@@ -359,10 +359,15 @@ class PILLAR_OT_sync(pillar.PillarOperatorMixin,
 
             self.bss_report({'INFO'}, 'Uploading %s' % fname)
             try:
-                await pillar.attach_file_to_group(path,
-                                                  self.home_project_id,
-                                                  self.sync_group_versioned_id,
-                                                  self.user_id)
+                await pillar.attach_file_to_group(
+                    path,
+                    self.home_project_id,
+                    self.sync_group_versioned_id,
+                    self.user_id,
+                    progress=upload.progress_reporter(
+                        lambda message: self.bss_report({'INFO'}, message),
+                        'Uploading %s' % fname),
+                    future=self.signalling_future)
             except sdk_exceptions.RequestEntityTooLarge as ex:
                 self.log.error('File too big to upload: %s' % ex)
                 self.log.error('To upload larger files, please subscribe to Blender Cloud.')
@@ -26,7 +26,8 @@ import bgl
 import blf
 
 import pillarsdk
-from . import async_loop, pillar, cache, blender, utils
+from . import async_loop, pillar, bandwidth, cache, blender, listing, offline, utils
+from .concurrency import Priority
 
 REQUIRED_ROLES_FOR_TEXTURE_BROWSER = {'subscriber', 'demo'}
 MOUSE_SCROLL_PIXELS_PER_TICK = 50
@@ -38,6 +39,7 @@ TARGET_ITEM_HEIGHT = 128
 ITEM_MARGIN_X = 5
 ITEM_MARGIN_Y = 5
 ITEM_PADDING_X = 5
+OFFLINE_BANNER_HEIGHT = 30
 
 library_path = '/tmp'
 library_icons_path = os.path.join(os.path.dirname(__file__), "icons")
@@ -82,6 +84,7 @@ class MenuItem:
     DEFAULT_ICONS = {
         'FOLDER': os.path.join(library_icons_path, 'folder.png'),
         'SPINNER': os.path.join(library_icons_path, 'spinner.png'),
+        'CLOUD': os.path.join(library_icons_path, 'icon-cloud.png'),
     }
 
     FOLDER_NODE_TYPES = {'group_texture', 'group_hdri', UpNode.NODE_TYPE, ProjectNode.NODE_TYPE}
@@ -94,9 +97,10 @@ class MenuItem:
             raise TypeError('Node of type %r not supported; supported are %r.' % (
                 node['node_type'], self.SUPPORTED_NODE_TYPES))
 
-        assert isinstance(node, pillarsdk.Node), 'wrong type for node: %r' % type(node)
+        assert isinstance(node, (pillarsdk.Node, listing.NodeRecord)), \
+            'wrong type for node: %r' % type(node)
         assert isinstance(node['_id'], str), 'wrong type for node["_id"]: %r' % type(node['_id'])
-        self.node = node  # pillarsdk.Node, contains 'node_type' key to indicate type
+        self._node = node  # pillarsdk.Node or listing.NodeRecord, see the node property.
         self.file_desc = file_desc  # pillarsdk.File object, or None if a 'folder' node.
         self.label_text = label_text
         self._thumb_path = ''
@@ -107,7 +111,10 @@ class MenuItem:
         # Determine sorting order.
         # by default, sort all the way at the end and folders first.
         self._order = 0 if self._is_folder else 10000
-        if node and node.properties and node.properties.order is not None:
+        if isinstance(node, listing.NodeRecord):
+            if node.order is not None:
+                self._order = node.order
+        elif node and node.properties and node.properties.order is not None:
             self._order = node.properties.order
 
         self.thumb_path = thumb_path
@@ -136,9 +143,21 @@ class MenuItem:
         else:
             self.icon = None
 
+    @property
+    def node(self) -> pillarsdk.Node:
+        """The node, contains 'node_type' key to indicate type.
+
+        Items of a listing are shown from their listing.NodeRecord; the full
+        node is only created when it's needed, like when opening the item.
+        """
+
+        if isinstance(self._node, listing.NodeRecord):
+            self._node = self._node.materialise()
+        return self._node
+
     @property
     def node_uuid(self) -> str:
-        return self.node['_id']
+        return self._node['_id']
 
     def represents(self, node) -> bool:
         """Returns True iff this MenuItem represents the given node."""
@@ -152,7 +171,7 @@ class MenuItem:
         if self.node_uuid != node['_id']:
             raise ValueError("Don't change the node ID this MenuItem reflects, "
                              "just create a new one.")
-        self.node = node
+        self._node = node
         self.file_desc = file_desc  # pillarsdk.File object, or None if a 'folder' node.
         self.thumb_path = thumb_path
 
@@ -422,6 +441,8 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         self.log.debug('Finishing the modal operator')
         async_loop.AsyncModalOperatorMixin._finish(self, context)
         self.clear_images()
+        # Stop probing for the downloads queued from this browser.
+        offline.download_queue.cancel()
 
         context.space_data.draw_handler_remove(self._draw_handle, 'WINDOW')
         context.window.cursor_modal_restore()
@@ -496,14 +517,16 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         if node_uuid:
             # Query for sub-nodes of this node.
             self.log.debug('Getting subnodes for parent node %r', node_uuid)
-            children = await pillar.get_nodes(parent_node_uuid=node_uuid,
-                                              node_type={'group_texture', 'group_hdri'})
+            pages = pillar.iter_node_record_pages(parent_node_uuid=node_uuid,
+                                                  node_type={'group_texture', 'group_hdri'},
+                                                  priority=Priority.INTERACTIVE)
         elif project_uuid:
             # Query for top-level nodes.
             self.log.debug('Getting subnodes for project node %r', project_uuid)
-            children = await pillar.get_nodes(project_uuid=project_uuid,
-                                              parent_node_uuid='',
-                                              node_type={'group_texture', 'group_hdri'})
+            pages = pillar.iter_node_record_pages(project_uuid=project_uuid,
+                                                  parent_node_uuid='',
+                                                  node_type={'group_texture', 'group_hdri'},
+                                                  priority=Priority.INTERACTIVE)
         else:
             # Query for projects
             self.log.debug('No node UUID and no project UUID, listing available projects')
@@ -515,14 +538,18 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         # Make sure we can go up again.
         self.add_menu_item(UpNode(), None, 'FOLDER', '.. up ..')
 
-        # Download all child nodes
+        # Download all child nodes, showing each page as soon as it arrives.
         self.log.debug('Iterating over child nodes of %r', self.current_path)
-        for child in children:
-            # print('  - %(_id)s = %(name)s' % child)
-            if child['node_type'] not in MenuItem.SUPPORTED_NODE_TYPES:
-                self.log.debug('Skipping node of type %r', child['node_type'])
-                continue
-            self.add_menu_item(child, None, 'FOLDER', child['name'])
+        try:
+            async for children in pages:
+                for child in children:
+                    # print('  - %(_id)s = %(name)s' % child)
+                    if child['node_type'] not in MenuItem.SUPPORTED_NODE_TYPES:
+                        self.log.debug('Skipping node of type %r', child['node_type'])
+                        continue
+                    self.add_menu_item(child, None, 'FOLDER', child['name'])
+        finally:
+            pages.close()
 
         # There are only sub-nodes at the project level, no texture nodes,
         # so we won't have to bother looking for textures.
@@ -538,11 +565,13 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
             self.add_menu_item(node, None, 'SPINNER', texture_node['name'])
 
         def thumbnail_loaded(node, file_desc, thumb_path):
-            self.update_menu_item(node, file_desc, thumb_path)
+            # Without thumbnail (for example while offline), show the Cloud icon instead.
+            self.update_menu_item(node, file_desc, thumb_path or 'CLOUD')
 
         await pillar.fetch_texture_thumbs(node_uuid, 's', directory,
                                           thumbnail_loading=thumbnail_loading,
                                           thumbnail_loaded=thumbnail_loaded,
+                                          priority=Priority.VISIBLE,
                                           future=self.signalling_future)
 
     def browse_assets(self):
@@ -571,8 +600,25 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         blf.size(font_id, 20, 72)
         blf.position(font_id, 5, 5, 0)
         blf.draw(font_id, '%s %s' % (self._state, self.project_name))
+
+        self._draw_throughput(context)
         bgl.glDisable(bgl.GL_BLEND)
 
+    def _draw_throughput(self, context):
+        """Draws the current download and upload speed in the bottom-right corner."""
+
+        text = bandwidth.status_text()
+        if not text:
+            return
+
+        _, content_width = self._window_size(context)
+        font_id = 0
+        bgl.glColor4f(1.0, 1.0, 1.0, 1.0)
+        blf.size(font_id, 16, 72)
+        text_width, _ = blf.dimensions(font_id, text)
+        blf.position(font_id, content_width - text_width - 5, 5, 0)
+        blf.draw(font_id, text)
+
     @staticmethod
     def _window_region(context):
         window_regions = [region
@@ -637,9 +683,31 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
                          content_y - content_height * 0.3 + text_height * 0.5, 0)
             blf.draw(font_id, text)
 
+        self._draw_offline_banner(window_region.width)
+
         bgl.glDisable(bgl.GL_BLEND)
         # bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
 
+    def _draw_offline_banner(self, width):
+        """Marks the shown data as stale while the Cloud is unreachable."""
+
+        text = offline.connectivity.status_text()
+        if not text:
+            return
+
+        bgl.glEnable(bgl.GL_BLEND)
+        bgl.glColor4f(0.6, 0.3, 0.0, 0.9)
+        bgl.glRectf(0, 0, width, OFFLINE_BANNER_HEIGHT)
+
+        font_id = 0
+        bgl.glColor4f(1.0, 1.0, 1.0, 1.0)
+        blf.size(font_id, 16, 72)
+        text_width, text_height = blf.dimensions(font_id, text)
+        blf.position(font_id,
+                     width * 0.5 - text_width * 0.5,
+                     (OFFLINE_BANNER_HEIGHT - text_height) * 0.5, 0)
+        blf.draw(font_id, text)
+
     def _draw_downloading(self, context):
         """OpenGL drawing code for the DOWNLOADING_TEXTURE state."""
 
@@ -759,26 +827,17 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
         def texture_downloading(file_path, *_):
             self.log.info('Texture downloading to %s', file_path)
 
+        relative_paths = context.scene.local_texture_dir.startswith('//')
+
         def texture_downloaded(file_path, file_desc, map_type):
             nonlocal select_dblock
 
             self.log.info('Texture downloaded to %r.', file_path)
 
-            if context.scene.local_texture_dir.startswith('//'):
+            if relative_paths:
                 file_path = bpy.path.relpath(file_path)
 
-            image_dblock = bpy.data.images.load(filepath=file_path)
-            image_dblock['bcloud_file_uuid'] = file_desc['_id']
-            image_dblock['bcloud_node_uuid'] = node['_id']
-            image_dblock['bcloud_node_type'] = node['node_type']
-            image_dblock['bcloud_node'] = pillar.node_to_id(node)
-
-            if node['node_type'] == 'hdri':
-                # All HDRi variations should use the same image datablock, hence once name.
-                image_dblock.name = node['name']
-            else:
-                # All texture variations are loaded at once, and thus need the map type in the name.
-                image_dblock.name = '%s-%s' % (node['name'], map_type)
+            image_dblock = load_texture_image(node, file_path, file_desc, map_type)
 
             # Select the image in the image editor (if the context is right).
             # Just set the first image we download,
@@ -789,7 +848,16 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
 
             file_paths.append(file_path)
 
-        def texture_download_completed(_):
+        def texture_download_completed(task):
+            results = [] if task.cancelled() or task.exception() else task.result()
+            if any(isinstance(result, Exception) and offline.is_connectivity_error(result)
+                   for result in results):
+                self.queue_texture_download(download_node, local_path, meta_path,
+                                            relative_paths=relative_paths)
+                # Keep browsing; the queued download is shown in the offline banner.
+                self.browse_assets()
+                return
+
             self.log.info('Texture download complete, inspect:\n%s', '\n'.join(file_paths))
             self._state = 'QUIT'
 
@@ -803,9 +871,36 @@ class BlenderCloudBrowser(pillar.PillarOperatorMixin,
                                                      metadata_directory=meta_path,
                                                      texture_loading=texture_downloading,
                                                      texture_loaded=texture_downloaded,
+                                                     priority=Priority.INTERACTIVE,
+                                                     texture_store=blender.texture_store(),
                                                      future=signalling_future))
         self.async_task.add_done_callback(texture_download_completed)
 
+    def queue_texture_download(self, node, local_path: str, meta_path: str, *,
+                               relative_paths: bool):
+        """Downloads the texture as soon as the Cloud can be reached again."""
+
+        def texture_loaded(file_path, file_desc, map_type):
+            # Files that could be downloaded earlier were already loaded.
+            if any(image.get('bcloud_file_uuid') == file_desc['_id']
+                   for image in bpy.data.images):
+                return
+            if relative_paths:
+                file_path = bpy.path.relpath(file_path)
+            load_texture_image(node, file_path, file_desc, map_type)
+
+        def download():
+            return pillar.download_texture(node, local_path,
+                                           metadata_directory=meta_path,
+                                           texture_loading=lambda *_: None,
+                                           texture_loaded=texture_loaded,
+                                           priority=Priority.BACKGROUND,
+                                           texture_store=blender.texture_store(),
+                                           future=None)
+
+        offline.download_queue.add(node['_id'], node['name'], download,
+                                   probe_url=blender.preferences().pillar_server)
+
     def open_browser_subscribe(self):
         import webbrowser
 
@@ -925,6 +1020,8 @@ class PILLAR_OT_switch_hdri(pillar.PillarOperatorMixin,
                                            map_type=resolution,
                                            file_loading=file_loading,
                                            file_loaded_sync=file_loaded,
+                                           priority=Priority.INTERACTIVE,
+                                           texture_store=blender.texture_store(),
                                            future=self.signalling_future)
 
         self.report({'INFO'}, 'Image download complete')
@@ -934,6 +1031,25 @@ class PILLAR_OT_switch_hdri(pillar.PillarOperatorMixin,
 addon_keymaps = []
 
 
+def load_texture_image(node, file_path: str, file_desc, map_type: str):
+    """Loads a downloaded texture file as image datablock, and links it to its node."""
+
+    image_dblock = bpy.data.images.load(filepath=file_path)
+    image_dblock['bcloud_file_uuid'] = file_desc['_id']
+    image_dblock['bcloud_node_uuid'] = node['_id']
+    image_dblock['bcloud_node_type'] = node['node_type']
+    image_dblock['bcloud_node'] = pillar.node_to_id(node)
+
+    if node['node_type'] == 'hdri':
+        # All HDRi variations should use the same image datablock, hence once name.
+        image_dblock.name = node['name']
+    else:
+        # All texture variations are loaded at once, and thus need the map type in the name.
+        image_dblock.name = '%s-%s' % (node['name'], map_type)
+
+    return image_dblock
+
+
 def image_editor_menu(self, context):
     self.layout.operator(BlenderCloudBrowser.bl_idname,
                          text='Get image from Blender Cloud',
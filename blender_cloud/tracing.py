@@ -0,0 +1,358 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Span-based tracing of asynchronous operations.
+
+A span measures one operation, like running an operator, a Pillar call, or
+waiting for a concurrency limiter. Spans started while another span is
+active become its children. The active span is tracked per asyncio task
+with contextvars, so new tasks inherit the span that was active when they
+were created. Python versions without contextvars (before 3.7) track it per
+task instead, and only tasks started with traced() know their parent.
+
+Tracing is disabled by default; while disabled, span() returns a span that
+does nothing. Finished spans are kept in a bounded buffer, and can be
+exported as Chrome trace-event JSON, to open in chrome://tracing or
+https://ui.perfetto.dev/.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import time
+import weakref
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+log = logging.getLogger(__name__)
+
+# Number of finished spans to keep; older spans are discarded.
+MAX_SPANS = 50000
+
+
+def _current_task():
+    try:
+        current_task = asyncio.current_task
+    except AttributeError:
+        current_task = asyncio.Task.current_task
+    try:
+        return current_task()
+    except RuntimeError:
+        # No event loop is running.
+        return None
+
+
+class _TaskLocal:
+    """Stand-in for contextvars.ContextVar, with a value per asyncio task.
+
+    New tasks start with the default value, rather than inheriting the
+    value of the task that created them.
+    """
+
+    def __init__(self, name: str, *, default=None):
+        self.name = name
+        self._default = default
+        self._values = weakref.WeakKeyDictionary()  # mapping from task to value.
+        self._outside_tasks = default
+
+    def get(self):
+        task = _current_task()
+        if task is None:
+            return self._outside_tasks
+        return self._values.get(task, self._default)
+
+    def set(self, value) -> tuple:
+        token = (_current_task(), self.get())
+        if token[0] is None:
+            self._outside_tasks = value
+        else:
+            self._values[token[0]] = value
+        return token
+
+    def reset(self, token: tuple):
+        task, value = token
+        if task is None:
+            self._outside_tasks = value
+        else:
+            self._values[task] = value
+
+
+if contextvars is not None:
+    _current_span = contextvars.ContextVar('blender_cloud_span', default=None)
+else:
+    _current_span = _TaskLocal('blender_cloud_span')
+
+
+class Span:
+    """One traced operation; use as context manager.
+
+    :param parent: the parent span, or None for a root span.
+    :param args: extra information shown in the trace viewer.
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, category: str, parent: 'Span', args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.span_id = next(tracer._span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.args = args
+        self.start = None
+        self.end = None
+        self.error = None
+        self._token = None
+
+    def __repr__(self):
+        return '<%s %r id=%i parent=%s>' % (type(self).__name__, self.name,
+                                           self.span_id, self.parent_id)
+
+    @property
+    def duration(self) -> float:
+        """Duration in seconds, or None if the span hasn't finished."""
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def set(self, **args):
+        """Adds information to the span."""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = self.tracer.clock()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = self.tracer.clock()
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            if issubclass(exc_type, asyncio.CancelledError):
+                self.error = 'cancelled'
+            else:
+                self.error = '%s: %s' % (exc_type.__name__, exc_val)
+        self.tracer._finished(self)
+        return False
+
+
+class _NullSpan:
+    """Span that does nothing, used while tracing is disabled."""
+
+    span_id = None
+    trace_id = None
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Creates spans and keeps the finished ones.
+
+    :param clock: function returning monotonic time in seconds; for testing.
+    """
+
+    def __init__(self, *, enabled=False, max_spans=MAX_SPANS, clock=time.perf_counter):
+        self.enabled = enabled
+        self.clock = clock
+        self.epoch = clock()
+        self._spans = collections.deque(maxlen=max_spans)
+        self._span_ids = itertools.count(1)
+
+    def __repr__(self):
+        return '<%s enabled=%s spans=%i>' % (type(self).__name__, self.enabled, len(self._spans))
+
+    def span(self, name: str, category='', *, parent: Span = None, **args):
+        """Returns a new span, a child of `parent` or of the currently active span.
+
+        Returns NULL_SPAN while tracing is disabled.
+        """
+
+        if not self.enabled:
+            return NULL_SPAN
+        if parent is None:
+            parent = current_span()
+        if parent is NULL_SPAN:
+            parent = None
+        return Span(self, name, category, parent, args)
+
+    def _finished(self, span: Span):
+        self._spans.append(span)
+
+    def spans(self) -> list:
+        """Returns the finished spans, in order of finishing."""
+        return list(self._spans)
+
+    def clear(self):
+        self._spans.clear()
+
+    def chrome_trace(self) -> dict:
+        """Returns the finished spans in Chrome's trace-event format.
+
+        Concurrent spans of asynchronous operations can overlap without
+        nesting, which trace viewers can't show on one row. Spans are
+        therefore spread over rows ("threads") so that every row only
+        contains properly nested spans, keeping children on the row of
+        their parent where possible.
+        """
+
+        pid = os.getpid()
+        events = []
+        lanes = []  # per lane, the stack of spans that may still contain later spans.
+        lane_of = {}  # mapping from span ID to lane number.
+
+        def fits(lane_nr: int, span: Span) -> bool:
+            stack = lanes[lane_nr]
+            while stack and stack[-1].end <= span.start:
+                stack.pop()
+            return not stack or span.end <= stack[-1].end
+
+        for span in sorted(self._spans, key=lambda s: (s.start, -s.end)):
+            preferred = lane_of.get(span.parent_id)
+            candidates = range(len(lanes))
+            if preferred is not None:
+                candidates = itertools.chain([preferred], candidates)
+            for lane_nr in candidates:
+                if fits(lane_nr, span):
+                    break
+            else:
+                lane_nr = len(lanes)
+                lanes.append([])
+            lanes[lane_nr].append(span)
+            lane_of[span.span_id] = lane_nr
+
+            args = dict(span.args, span_id=span.span_id, trace_id=span.trace_id)
+            if span.parent_id is not None:
+                args['parent_id'] = span.parent_id
+            if span.error is not None:
+                args['error'] = span.error
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self.epoch) * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': pid,
+                'tid': lane_nr,
+                'args': args,
+            })
+
+        for lane_nr in range(len(lanes)):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': lane_nr,
+                           'args': {'name': 'lane %i' % lane_nr}})
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': 'Blender Cloud add-on'}})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path: str):
+        """Writes the finished spans as Chrome trace-event JSON file."""
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w') as outfile:
+            json.dump(self.chrome_trace(), outfile, default=str)
+        log.info('Wrote %i spans to %s', len(self._spans), path)
+
+
+def current_span():
+    """Returns the active span, or NULL_SPAN if there is none."""
+
+    span = _current_span.get()
+    if span is None:
+        return NULL_SPAN
+    return span
+
+
+def span(name: str, category='', **args):
+    """Returns a new span of the global tracer; see Tracer.span()."""
+    return tracer.span(name, category, **args)
+
+
+@contextlib.contextmanager
+def detached():
+    """Context manager, runs the block without an active span.
+
+    Spans started in the block are roots of a new trace.
+    """
+
+    token = _current_span.set(None)
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+
+
+def traced(coro, name: str, category='', **args):
+    """Returns a coroutine that runs `coro` in a new span.
+
+    The span is a child of the span that is active when traced() is called,
+    also when the coroutine is run in a new task on Python versions without
+    contextvars. Returns `coro` itself while tracing is disabled.
+    """
+
+    if not tracer.enabled:
+        return coro
+
+    parent = current_span()
+
+    async def run():
+        with tracer.span(name, category, parent=parent, **args):
+            return await coro
+
+    return run()
+
+
+def coroutine_span(category: str, name: str = None):
+    """Decorator that runs every call of a coroutine function in a span.
+
+    :param name: name of the span, defaults to the name of the function.
+        The function can add information with current_span().set(...).
+    """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(span_name, category):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+tracer = Tracer()
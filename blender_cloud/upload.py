@@ -0,0 +1,401 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""Streaming file uploads.
+
+Request bodies are produced by FileBody, which reads the file block by block
+while it is being sent, instead of loading it into memory first. It reports
+progress and checks for cancellation between blocks, and can be throttled
+to limit the bandwidth it uses.
+
+Resumable uploads send a file in chunks, following the protocol of Google
+Cloud Storage resumable uploads:
+
+1. POST to the upload URL, with X-Upload-Content-Length and
+   X-Upload-Content-Type headers. The Location header of the response is
+   the URL of the upload session.
+2. PUT every chunk to the session URL, with a "Content-Range: bytes
+   start-end/total" header. The server responds with "308 Resume
+   Incomplete" and a "Range: bytes=0-N" header stating what it received,
+   and with 200 or 201 after the last chunk.
+3. After a failure, PUT an empty body with "Content-Range: bytes */total"
+   to ask the server how much it received, and continue from there.
+
+To prevent uploading the same file twice, UploadIndex remembers the file
+document IDs of uploaded files by the MD5 of their contents.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import pathlib
+import time
+import urllib.parse
+import uuid
+
+from . import resilience
+
+log = logging.getLogger(__name__)
+
+# Size of the blocks that are read from disk and written to the connection.
+BLOCK_SIZE = 256 * 1024
+
+# Size of the chunks of a resumable upload; must be a multiple of 256 KiB.
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class ResumableUploadError(IOError):
+    """Raised when the server's response doesn't fit the resumable upload protocol."""
+
+
+class FileBody:
+    """Request body that streams (a range of) a file.
+
+    Iterating produces the head, the file contents, and the tail. The
+    progress callback is called with (bytes of the file sent, file size)
+    after every block was handed to the transport.
+
+    Transports iterate asynchronously when they can; throttling then waits
+    without blocking the event loop. Synchronous iteration, as done by
+    Requests in an executor thread, sleeps instead.
+
+    :param start: offset of the first byte of the file to send.
+    :param end: offset of the last byte of the file to send, or None for
+        the end of the file.
+    :param offset_for_progress: number of bytes that were sent before
+        'start', reported as part of the progress.
+    :param throttle: function that receives the size of a block that is
+        about to be sent, and returns the number of seconds to wait first;
+        see bandwidth.upload_throttle().
+    """
+
+    def __init__(self, file_path: pathlib.Path, *, start=0, end: int = None,
+                 head=b'', tail=b'', block_size=BLOCK_SIZE,
+                 progress: callable = None, is_cancelled: callable = None,
+                 offset_for_progress=0, throttle: callable = None):
+        self.file_path = file_path
+        self.file_size = os.path.getsize(str(file_path))
+        self.start = start
+        self.end = self.file_size - 1 if end is None else end
+        self.head = head
+        self.tail = tail
+        self.block_size = block_size
+        self.progress = progress
+        self.is_cancelled = is_cancelled
+        self.offset_for_progress = offset_for_progress
+        self.throttle = throttle
+
+    def __len__(self):
+        return len(self.head) + (self.end + 1 - self.start) + len(self.tail)
+
+    def __iter__(self):
+        for block in self._blocks():
+            if self.throttle is not None:
+                delay = self.throttle(len(block))
+                if delay > 0:
+                    time.sleep(delay)
+            yield block
+
+    def __aiter__(self):
+        return _AsyncBlocks(self)
+
+    def _blocks(self):
+        if self.head:
+            yield self.head
+
+        sent = 0
+        to_send = self.end + 1 - self.start
+        with open(str(self.file_path), 'rb') as infile:
+            infile.seek(self.start)
+            while sent < to_send:
+                if self.is_cancelled is not None and self.is_cancelled():
+                    raise asyncio.CancelledError('Uploading was cancelled')
+                block = infile.read(min(self.block_size, to_send - sent))
+                if not block:
+                    raise IOError('%s was truncated while uploading it' % self.file_path)
+                yield block
+                sent += len(block)
+                if self.progress is not None:
+                    self.progress(self.offset_for_progress + sent, self.file_size)
+
+        if self.tail:
+            yield self.tail
+
+
+class _AsyncBlocks:
+    """Asynchronous iterator over the blocks of a FileBody."""
+
+    def __init__(self, body: FileBody):
+        self._blocks = body._blocks()
+        self._throttle = body.throttle
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            block = next(self._blocks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+        if self._throttle is not None:
+            delay = self._throttle(len(block))
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return block
+
+
+def multipart_file_body(field_name: str, file_path: pathlib.Path, *,
+                        mimetype: str = None, **kwargs) -> tuple:
+    """Returns (content type, FileBody) of a multipart/form-data body containing one file.
+
+    :param mimetype: MIME type of the file; guessed from its name when not given.
+
+    Other keyword arguments are passed to FileBody.
+    """
+
+    boundary = uuid.uuid4().hex
+    part_headers = ['Content-Disposition: form-data; name="%s"; filename="%s"'
+                    % (field_name, file_path.name.replace('"', '%22'))]
+    if not mimetype:
+        mimetype, _ = mimetypes.guess_type(file_path.name)
+    if mimetype:
+        part_headers.append('Content-Type: %s' % mimetype)
+
+    head = '--%s\r\n%s\r\n\r\n' % (boundary, '\r\n'.join(part_headers))
+    tail = '\r\n--%s--\r\n' % boundary
+    body = FileBody(file_path, head=head.encode('utf8'), tail=tail.encode('utf8'), **kwargs)
+    return 'multipart/form-data; boundary=%s' % boundary, body
+
+
+def progress_reporter(report: callable, description: str, *, step=10,
+                      loop: asyncio.AbstractEventLoop = None) -> callable:
+    """Returns a progress callback that reports every 'step' percent of an upload.
+
+    The report function is called with a message like "Uploading x: 40%". It
+    is always called on the event loop, also when the progress callback is
+    called from an executor thread, so it may touch Blender data.
+    """
+
+    loop = loop or asyncio.get_event_loop()
+    last_reported = 0
+
+    def progress(sent: int, size: int):
+        nonlocal last_reported
+
+        percentage = 100 * sent // size if size else 100
+        if percentage - last_reported < step and percentage < 100:
+            return
+        if percentage == last_reported:
+            return
+        last_reported = percentage
+        loop.call_soon_threadsafe(report, '%s: %i%%' % (description, percentage))
+
+    return progress
+
+
+def file_md5(file_path: str = None, fileobj=None, block_size=BLOCK_SIZE) -> str:
+    """Returns the hex MD5 digest of a file.
+
+    :param fileobj: file object to read instead of opening file_path. It is
+        rewound to its start afterwards.
+    """
+
+    hasher = hashlib.md5()
+    if fileobj is not None:
+        for block in iter(lambda: fileobj.read(block_size), b''):
+            hasher.update(block)
+        fileobj.seek(0)
+    else:
+        with open(str(file_path), 'rb') as infile:
+            for block in iter(lambda: infile.read(block_size), b''):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+class UploadIndex:
+    """Persistent mapping from (project ID, MD5) to the ID of an uploaded file document."""
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._index = None  # loaded on first use.
+
+    def _load(self) -> dict:
+        if self._index is not None:
+            return self._index
+
+        try:
+            with open(self.index_path, 'r') as infile:
+                self._index = json.load(infile)
+        except FileNotFoundError:
+            self._index = {}
+        except (OSError, ValueError) as ex:
+            log.warning('Unable to load upload index %s, starting afresh: %s',
+                        self.index_path, ex)
+            self._index = {}
+        return self._index
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(self.index_path, 'w') as outfile:
+            json.dump(self._index, outfile, sort_keys=True, indent=1)
+
+    def get(self, project_id: str, md5: str) -> str:
+        """Returns the file ID, or None if no such file was uploaded."""
+        return self._load().get(project_id, {}).get(md5)
+
+    def remember(self, project_id: str, md5: str, file_id: str):
+        project_files = self._load().setdefault(project_id, {})
+        if project_files.get(md5) == file_id:
+            return
+        project_files[md5] = file_id
+        self._save()
+
+    def forget(self, project_id: str, md5: str):
+        project_files = self._load().get(project_id, {})
+        if project_files.pop(md5, None) is not None:
+            self._save()
+
+
+def _received_until(response) -> int:
+    """Returns the number of bytes the server received, from a 308 response."""
+
+    range_header = response.headers.get('Range')
+    if not range_header:
+        return 0
+    try:
+        unit, byte_range = range_header.split('=', 1)
+        start, end = byte_range.split('-', 1)
+        if unit.strip() != 'bytes' or int(start) != 0:
+            raise ValueError()
+        return int(end) + 1
+    except ValueError:
+        raise ResumableUploadError('Invalid Range header %r' % range_header)
+
+
+async def resumable_upload(transport, url: str, file_path: pathlib.Path, *,
+                           headers: dict,
+                           policy: resilience.RetryPolicy,
+                           breaker: resilience.CircuitBreaker,
+                           is_transient: callable,
+                           chunk_size=RESUMABLE_CHUNK_SIZE,
+                           mimetype: str = None,
+                           progress: callable = None,
+                           is_cancelled: callable = None,
+                           throttle: callable = None):
+    """Uploads a file in chunks, resuming after failures.
+
+    Every chunk is retried according to the retry policy; before a retry,
+    the server is asked which part it already received.
+
+    :param transport: the http_transport to perform the requests with.
+    :param url: URL to start the upload session at.
+    :param headers: extra headers (like Authorization) for every request.
+    :param is_transient: function that receives an exception and returns
+        whether it is a transient error. ResumableUploadError is always
+        considered transient.
+    :param mimetype: MIME type of the file; guessed from its name when not given.
+    :param progress: called with (bytes sent, file size).
+    :param throttle: passed to FileBody.
+    :returns: the parsed JSON response to the last chunk.
+    """
+
+    total = os.path.getsize(str(file_path))
+    content_type = (mimetype or mimetypes.guess_type(file_path.name)[0]
+                    or 'application/octet-stream')
+
+    def with_headers(**extra) -> dict:
+        request_headers = dict(headers)
+        request_headers.update(extra)
+        return request_headers
+
+    async def start_session():
+        start_headers = with_headers(**{'X-Upload-Content-Type': content_type,
+                                        'X-Upload-Content-Length': str(total)})
+        with (await transport.request('POST', url, headers=start_headers)) as response:
+            response.raise_for_status()
+            try:
+                return urllib.parse.urljoin(url, response.headers['Location'])
+            except KeyError:
+                raise ResumableUploadError('No Location header in response to POST %s' % url)
+
+    session_url = await resilience.call_with_retries(
+        start_session, policy=policy, breaker=breaker, is_transient=is_transient,
+        retry=False, description='POST %s' % url)
+    log.debug('Upload session for %s at %s', file_path, session_url)
+
+    def transient(exception: BaseException) -> bool:
+        return isinstance(exception, ResumableUploadError) or is_transient(exception)
+
+    # Shared by the attempts. The offset is uncertain when a chunk was (partially) sent
+    # without receiving the response, and has to be asked from the server.
+    state = {'offset': 0, 'uncertain': False}
+
+    async def handle_response(response):
+        """Updates the offset; returns the JSON document when the upload is complete."""
+
+        with response:
+            if response.status_code == 308:
+                state['offset'] = _received_until(response)
+                return None
+            response.raise_for_status()
+            return await response.json()
+
+    async def send_chunk():
+        if state['uncertain']:
+            query_headers = with_headers(**{'Content-Range': 'bytes */%i' % total})
+            response = await transport.request('PUT', session_url, headers=query_headers)
+            result = await handle_response(response)
+            if result is not None:
+                return result
+            state['uncertain'] = False
+            log.debug('Server received %i of %i bytes of %s, resuming',
+                      state['offset'], total, file_path)
+
+        start = state['offset']
+        end = min(start + chunk_size, total) - 1
+        if total:
+            content_range = 'bytes %i-%i/%i' % (start, end, total)
+        else:
+            content_range = 'bytes */0'
+        body = FileBody(file_path, start=start, end=end, progress=progress,
+                        is_cancelled=is_cancelled, offset_for_progress=start,
+                        throttle=throttle)
+
+        state['uncertain'] = True
+        response = await transport.request(
+            'PUT', session_url, headers=with_headers(**{'Content-Range': content_range,
+                                                        'Content-Length': str(len(body))}),
+            body=body)
+        result = await handle_response(response)
+        state['uncertain'] = False
+
+        if result is None and state['offset'] <= start:
+            raise ResumableUploadError('Server accepted none of bytes %i-%i of %s'
+                                       % (start, end, file_path))
+        return result
+
+    while True:
+        result = await resilience.call_with_retries(
+            send_chunk, policy=policy, breaker=breaker, is_transient=transient,
+            description='PUT %s' % session_url)
+        if result is not None:
+            return result
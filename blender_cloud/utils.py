@@ -16,7 +16,10 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
+import base64
+import binascii
 import pathlib
+import re
 
 
 def sizeof_fmt(num: int, suffix='B') -> str:
@@ -62,3 +65,25 @@ def find_in_path(path: pathlib.Path, filename: str) -> pathlib.Path:
                 return subpath
 
     return None
+
+
+def md5_hex(md5: str) -> str:
+    """Returns the MD5 digest as lower-case hexadecimal string.
+
+    Storage backends report MD5 digests either hex-encoded or base64-encoded
+    (Google Cloud Storage does the latter); both are accepted.
+
+    :returns: the hex digest, or None if md5 is empty or not an MD5 digest.
+    """
+
+    if not md5:
+        return None
+    if re.fullmatch(r'[0-9a-fA-F]{32}', md5):
+        return md5.lower()
+    try:
+        digest = base64.b64decode(md5, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    if len(digest) != 16:
+        return None
+    return binascii.hexlify(digest).decode('ascii')
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Benchmark suite for blender_cloud.blendfile.
+
+Generates synthetic blend files with blendfile_generator, times the common
+operations on them, and writes the results as JSON so that they can be
+compared over time. Run from the top-level directory of the repository:
+
+    python tests/benchmark_blendfile.py --size-mb 50 --output bench.json
+
+Every benchmark is repeated a number of times; the JSON contains the
+individual timings as well as min/median/mean, all in seconds.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+my_dir = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(my_dir.parent))
+sys.path.insert(0, str(my_dir))
+
+from blender_cloud import blendfile  # noqa: E402
+import blendfile_generator  # noqa: E402
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Decorator, registers a benchmark function.
+
+    The function receives the BenchmarkContext and returns a dict of
+    extra information to store with the result (may be None). Only the
+    time spent inside ctx.timer() is measured.
+    """
+
+    BENCHMARKS.append(func)
+    return func
+
+
+class BenchmarkContext:
+    def __init__(self, path: pathlib.Path, compressed_path: pathlib.Path, tmpdir: pathlib.Path):
+        self.path = path
+        self.compressed_path = compressed_path
+        self.tmpdir = tmpdir
+        self.timings = []
+
+    def timer(self):
+        return _Timer(self.timings)
+
+    def open(self) -> blendfile.BlendFile:
+        return blendfile.open_blend(str(self.path))
+
+
+class _Timer:
+    def __init__(self, timings: list):
+        self.timings = timings
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timings.append(time.perf_counter() - self.start)
+
+
+@benchmark
+def open_file(ctx: BenchmarkContext):
+    """Opens the file, which reads all block headers and decodes the DNA."""
+
+    with ctx.timer():
+        bfile = ctx.open()
+    block_count = len(bfile.blocks)
+    bfile.close()
+    return {'blocks': block_count}
+
+
+@benchmark
+def header_scan(ctx: BenchmarkContext):
+    """Iterates over all block headers, without decoding the DNA."""
+
+    with ctx.path.open('rb') as handle:
+        with ctx.timer():
+            header = blendfile.BlendFileHeader(handle)
+            bfile = blendfile.BlendFile.__new__(blendfile.BlendFile)
+            bfile.header = header
+            bfile.block_header_struct = header.create_block_header_struct()
+
+            count = 0
+            block = blendfile.BlendFileBlock(handle, bfile)
+            while block.code != b'ENDB':
+                count += 1
+                handle.seek(block.size, os.SEEK_CUR)
+                block = blendfile.BlendFileBlock(handle, bfile)
+    return {'blocks': count}
+
+
+@benchmark
+def dna_decode(ctx: BenchmarkContext):
+    """Decodes the DNA1 block."""
+
+    with ctx.open() as bfile:
+        dna_block = bfile.find_blocks_from_code(b'DNA1')[0]
+        bfile.handle.seek(dna_block.file_offset, os.SEEK_SET)
+        with ctx.timer():
+            structs, _ = blendfile.BlendFile.decode_structs(bfile.header, dna_block,
+                                                            bfile.handle)
+    return {'structs': len(structs)}
+
+
+@benchmark
+def field_get(ctx: BenchmarkContext):
+    """Reads a pointer, a nested string, a float array and an int from every object."""
+
+    with ctx.open() as bfile:
+        objects = bfile.find_blocks_from_code(b'OB')
+        with ctx.timer():
+            for ob in objects:
+                ob[b'data']
+                ob[b'id', b'name']
+                ob[b'loc']
+                ob[b'lay']
+    return {'objects': len(objects), 'gets': 4 * len(objects)}
+
+
+@benchmark
+def field_set(ctx: BenchmarkContext):
+    """Writes int and string fields of the user preferences, like Blender Sync does."""
+
+    repeat = 1000
+    work_path = ctx.tmpdir / 'field_set.blend'
+    shutil.copy(str(ctx.path), str(work_path))
+
+    with blendfile.open_blend(str(work_path), 'rb+') as bfile:
+        prefs = bfile.find_blocks_from_code(b'USER')[0]
+        with ctx.timer():
+            for idx in range(repeat):
+                prefs[b'dpi'] = 72 + idx % 2
+                prefs[b'fontdir'] = '//fonts-%i/' % idx
+    work_path.unlink()
+    return {'sets': 2 * repeat}
+
+
+@benchmark
+def pointer_chasing(ctx: BenchmarkContext):
+    """Follows object -> next object and object -> mesh -> vertices pointers."""
+
+    with ctx.open() as bfile:
+        ob = bfile.find_blocks_from_code(b'OB')[0]
+        hops = 0
+        with ctx.timer():
+            while ob is not None:
+                mesh = ob.get_pointer(b'data')
+                mesh.get_pointer(b'mvert')
+                ob = ob.get_pointer((b'id', b'next'))
+                hops += 3
+    return {'hops': hops}
+
+
+@benchmark
+def hashing(ctx: BenchmarkContext):
+    """Computes the data hash of all objects and images."""
+
+    with ctx.open() as bfile:
+        blocks = bfile.find_blocks_from_code(b'OB') + bfile.find_blocks_from_code(b'IM')
+        with ctx.timer():
+            for block in blocks:
+                block.get_data_hash()
+    return {'hashed_blocks': len(blocks)}
+
+
+@benchmark
+def close_recompress(ctx: BenchmarkContext):
+    """Opens a compressed file, modifies it, and closes it, which recompresses it."""
+
+    work_path = ctx.tmpdir / 'recompress.blend'
+    shutil.copy(str(ctx.compressed_path), str(work_path))
+
+    bfile = blendfile.open_blend(str(work_path), 'rb+')
+    prefs = bfile.find_blocks_from_code(b'USER')[0]
+    prefs[b'dpi'] = 96
+    with ctx.timer():
+        bfile.close()
+    size = work_path.stat().st_size
+    work_path.unlink()
+    return {'compressed_size': size}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(my_dir),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-bench-'))
+    try:
+        gen_options = {
+            'object_count': args.objects,
+            'pointer_size': args.pointer_size,
+            'endian': args.endian,
+        }
+        path = tmpdir / 'synthetic.blend'
+        compressed_path = tmpdir / 'synthetic-compressed.blend'
+        size = blendfile_generator.generate_blend(path, target_size=args.size_mb * 1024 * 1024,
+                                                  **gen_options)
+        blendfile_generator.generate_blend(compressed_path,
+                                           target_size=args.size_mb * 1024 * 1024,
+                                           compress=True, **gen_options)
+
+        results = []
+        for bench_func in BENCHMARKS:
+            if args.only and bench_func.__name__ not in args.only:
+                continue
+
+            ctx = BenchmarkContext(path, compressed_path, tmpdir)
+            info = None
+            for _ in range(args.repeat):
+                info = bench_func(ctx)
+
+            result = {
+                'name': bench_func.__name__,
+                'description': bench_func.__doc__.strip().splitlines()[0],
+                'repeat': args.repeat,
+                'timings': ctx.timings,
+                'min': min(ctx.timings),
+                'median': statistics.median(ctx.timings),
+                'mean': statistics.mean(ctx.timings),
+                'info': info or {},
+            }
+            results.append(result)
+            print('%-18s min %9.4f s  median %9.4f s' % (result['name'], result['min'],
+                                                          result['median']),
+                  file=sys.stderr)
+    finally:
+        shutil.rmtree(str(tmpdir))
+
+    return {
+        'suite': 'blendfile',
+        'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'file': dict(gen_options, size=size, compressed=False),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size-mb', type=int, default=20,
+                        help='approximate size of the generated blend file in MiB')
+    parser.add_argument('--objects', type=int, default=500,
+                        help='number of objects (and meshes and images) in the file')
+    parser.add_argument('--pointer-size', type=int, choices=(4, 8), default=8)
+    parser.add_argument('--endian', choices=('<', '>'), default='<')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of times to run each benchmark')
+    parser.add_argument('--only', nargs='*', metavar='BENCHMARK',
+                        help='only run these benchmarks: %s'
+                             % ', '.join(func.__name__ for func in BENCHMARKS))
+    parser.add_argument('--output', '-o', type=pathlib.Path,
+                        help='file to write the JSON results to; defaults to stdout')
+    args = parser.parse_args()
+
+    report = run(args)
+    as_json = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with args.output.open('w') as outfile:
+            outfile.write(as_json)
+    else:
+        print(as_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""Generator for synthetic, valid blend files.
+
+The files are built around a subset of the DNA of Blender 2.79: the ID,
+Object, Mesh, MVert, Image and UserDef structs with their most important
+fields, transcribed from makesdna. This makes the files realistic enough
+to test and benchmark blendfile.py, without having to ship real blend
+files with the tests.
+
+Usage:
+
+    >>> generate_blend('/tmp/synthetic.blend', object_count=100, verts_per_mesh=1000)
+
+or use blend_bytes() to obtain the file contents in memory.
+"""
+
+import gzip
+import struct
+
+# Sizes of the basic DNA types, independent of the platform.
+BASIC_TYPES = [
+    ('char', 1), ('uchar', 1), ('short', 2), ('ushort', 2), ('int', 4),
+    ('long', 4), ('ulong', 4), ('float', 4), ('double', 8), ('int64_t', 8),
+    ('uint64_t', 8), ('void', 0),
+]
+
+# The captured DNA: (struct name, [(field type, field name), ...]).
+# Structs must be defined before they are embedded (not pointed to) in another struct.
+CAPTURED_DNA = [
+    ('Link', [('Link', '*next'), ('Link', '*prev')]),
+    ('ListBase', [('void', '*first'), ('void', '*last')]),
+    ('IDProperty', [('IDProperty', '*next'), ('IDProperty', '*prev'), ('char', 'type'),
+                    ('char', 'subtype'), ('short', 'flag'), ('char', 'name[64]'),
+                    ('int', 'saved'), ('void', '*pointer'), ('ListBase', 'group'),
+                    ('int', 'val'), ('int', 'val2'), ('int', 'len'), ('int', 'totallen')]),
+    ('ID', [('void', '*next'), ('void', '*prev'), ('ID', '*newid'), ('Library', '*lib'),
+            ('char', 'name[66]'), ('short', 'flag'), ('short', 'tag'), ('short', 'pad_s1'),
+            ('int', 'us'), ('int', 'icon_id'), ('IDProperty', '*properties')]),
+    ('Library', [('ID', 'id'), ('void', '*filedata'), ('char', 'name[1024]'),
+                 ('char', 'filepath[1024]'), ('Library', '*parent')]),
+    ('MVert', [('float', 'co[3]'), ('short', 'no[3]'), ('char', 'flag'), ('char', 'bweight')]),
+    ('Mesh', [('ID', 'id'), ('void', '*adt'), ('void', '*bb'), ('void', '*ipo'),
+              ('void', '*key'), ('void', '**mat'), ('MVert', '*mvert'), ('void', '*medge'),
+              ('void', '*mpoly'), ('void', '*mloop'), ('int', 'totvert'), ('int', 'totedge'),
+              ('int', 'totface'), ('int', 'totselect'), ('int', 'totpoly'), ('int', 'totloop'),
+              ('int', 'act_face'), ('float', 'loc[3]'), ('float', 'size[3]'),
+              ('float', 'rot[3]'), ('int', 'drawflag'), ('short', 'texflag'),
+              ('short', 'flag'), ('float', 'smoothresh'), ('int', 'pad2')]),
+    ('Image', [('ID', 'id'), ('char', 'name[1024]'), ('void', '*cache'),
+               ('void', '*gputexture[2]'), ('ListBase', 'anims'), ('void', '*rr'),
+               ('short', 'ok'), ('short', 'flag'), ('short', 'source'), ('short', 'type'),
+               ('int', 'lastframe'), ('short', 'tpageflag'), ('short', 'totbind'),
+               ('short', 'xrep'), ('short', 'yrep'), ('short', 'twsta'), ('short', 'twend'),
+               ('int', 'bindcode[2]'), ('int', 'pad1'), ('void', '*packedfile'),
+               ('float', 'lastupdate'), ('int', 'lastused'), ('short', 'animspeed'),
+               ('short', 'pad2'), ('int', 'gen_x'), ('int', 'gen_y'), ('char', 'gen_type'),
+               ('char', 'gen_flag'), ('short', 'gen_depth'), ('float', 'gen_color[4]')]),
+    ('Object', [('ID', 'id'), ('void', '*adt'), ('void', '*sculpt'), ('short', 'type'),
+                ('short', 'partype'), ('int', 'par1'), ('int', 'par2'), ('int', 'par3'),
+                ('char', 'parsubstr[64]'), ('Object', '*parent'), ('Object', '*track'),
+                ('Object', '*proxy'), ('Object', '*proxy_group'), ('Object', '*proxy_from'),
+                ('void', '*ipo'), ('void', '*bb'), ('void', '*action'),
+                ('void', '*poselib'), ('void', '*pose'), ('void', '*data'),
+                ('void', '*gpd'), ('ListBase', 'modifiers'), ('int', 'mode'),
+                ('int', 'restore_mode'), ('void', '**mat'), ('char', '*matbits'),
+                ('int', 'totcol'), ('int', 'actcol'), ('float', 'loc[3]'),
+                ('float', 'dloc[3]'), ('float', 'orig[3]'), ('float', 'size[3]'),
+                ('float', 'dsize[3]'), ('float', 'dscale[3]'), ('float', 'rot[3]'),
+                ('float', 'drot[3]'), ('float', 'quat[4]'), ('float', 'dquat[4]'),
+                ('float', 'obmat[4][4]'), ('float', 'parentinv[4][4]'),
+                ('float', 'constinv[4][4]'), ('float', 'imat[4][4]'), ('int', 'lay'),
+                ('short', 'flag'), ('short', 'colbits'), ('short', 'transflag'),
+                ('short', 'protectflag'), ('short', 'trackflag'), ('short', 'upflag'),
+                ('short', 'nlaflag'), ('short', 'scaflag'), ('char', 'scavisflag'),
+                ('char', 'depsflag'), ('char', 'lastNeedMapping'), ('char', 'duplicator_visibility_flag'),
+                ('int', 'dupon'), ('int', 'dupoff'), ('int', 'dupsta'), ('int', 'dupend')]),
+    ('UserDef', [('int', 'versionfile'), ('int', 'subversionfile'), ('int', 'flag'),
+                 ('int', 'dupflag'), ('int', 'savetime'), ('char', 'tempdir[768]'),
+                 ('char', 'fontdir[768]'), ('char', 'renderdir[1024]'),
+                 ('char', 'render_cachedir[768]'), ('char', 'textudir[768]'),
+                 ('char', 'pythondir[768]'), ('char', 'sounddir[768]'),
+                 ('char', 'i18ndir[768]'), ('char', 'image_editor[1024]'),
+                 ('char', 'anim_player[1024]'), ('int', 'anim_player_preset'),
+                 ('short', 'v2d_min_gridsize'), ('short', 'timecode_style'),
+                 ('short', 'versions'), ('short', 'dbl_click_time'), ('short', 'gameflags'),
+                 ('short', 'wheellinescroll'), ('int', 'uiflag'), ('int', 'uiflag2'),
+                 ('int', 'language'), ('short', 'userpref'), ('short', 'viewzoom'),
+                 ('int', 'mixbufsize'), ('int', 'audiodevice'), ('int', 'audiorate'),
+                 ('int', 'audioformat'), ('int', 'audiochannels'), ('int', 'scrollback'),
+                 ('int', 'dpi'), ('float', 'ui_scale'), ('int', 'ui_line_width'),
+                 ('char', 'node_margin'), ('char', 'pad2'), ('short', 'transopts'),
+                 ('short', 'menuthreshold1'), ('short', 'menuthreshold2'),
+                 ('ListBase', 'themes'), ('ListBase', 'uifonts'), ('ListBase', 'uistyles'),
+                 ('ListBase', 'keymaps'), ('ListBase', 'user_keymaps'), ('ListBase', 'addons'),
+                 ('ListBase', 'autoexec_paths'), ('char', 'keyconfigstr[64]'),
+                 ('short', 'undosteps'), ('short', 'undomemory'), ('short', 'gp_manhattendist'),
+                 ('short', 'gp_euclideandist'), ('short', 'gp_eraser'), ('short', 'gp_settings'),
+                 ('short', 'tb_leftmouse'), ('short', 'tb_rightmouse'),
+                 ('int', 'compute_device_type'), ('char', 'compute_device_id[64]'),
+                 ('short', 'virtual_pixel'), ('short', 'pad4')]),
+]
+
+OBJECT_TYPE_MESH = 1
+
+
+class DNACatalog:
+    """Encodes the captured DNA for a given pointer size and endianness."""
+
+    def __init__(self, spec=CAPTURED_DNA, *, pointer_size=8, endian='<'):
+        if pointer_size not in {4, 8}:
+            raise ValueError('pointer_size must be 4 or 8, not %r' % pointer_size)
+        if endian not in {'<', '>'}:
+            raise ValueError("endian must be '<' or '>', not %r" % endian)
+
+        self.pointer_size = pointer_size
+        self.endian = endian
+        self.spec = spec
+
+        self.type_sizes = dict(BASIC_TYPES)
+        self.types = [name for name, _ in BASIC_TYPES]
+        self.struct_fields = {}
+
+        # Register all struct names first, so that they can point to each other.
+        for struct_name, _ in spec:
+            self.types.append(struct_name)
+        for struct_name, fields in spec:
+            self.struct_fields[struct_name] = fields
+            self.type_sizes[struct_name] = sum(self.field_size(ftype, fname)
+                                               for ftype, fname in fields)
+
+        self.names = []
+        for _, fields in spec:
+            for _, fname in fields:
+                if fname not in self.names:
+                    self.names.append(fname)
+
+    @staticmethod
+    def array_size(field_name: str) -> int:
+        size = 1
+        for part in field_name.split('[')[1:]:
+            size *= int(part.rstrip(']'))
+        return size
+
+    @staticmethod
+    def name_only(field_name: str) -> str:
+        return field_name.strip('*()').split('[')[0]
+
+    def field_size(self, field_type: str, field_name: str) -> int:
+        if '*' in field_name:
+            return self.pointer_size * self.array_size(field_name)
+        return self.type_sizes[field_type] * self.array_size(field_name)
+
+    def struct_size(self, struct_name: str) -> int:
+        return self.type_sizes[struct_name]
+
+    def sdna_index(self, struct_name: str) -> int:
+        return [name for name, _ in self.spec].index(struct_name)
+
+    def encode(self) -> bytes:
+        """Returns the contents of the DNA1 block."""
+
+        end = self.endian
+
+        def pad4(data: bytes) -> bytes:
+            return data + b'\0' * (-len(data) % 4)
+
+        data = b'SDNA' + b'NAME' + struct.pack(end + 'I', len(self.names))
+        data = pad4(data + b''.join(name.encode('ascii') + b'\0' for name in self.names))
+
+        data += b'TYPE' + struct.pack(end + 'I', len(self.types))
+        data = pad4(data + b''.join(name.encode('ascii') + b'\0' for name in self.types))
+
+        data += b'TLEN' + b''.join(struct.pack(end + 'H', self.type_sizes[name])
+                                   for name in self.types)
+        data = pad4(data)
+
+        data += b'STRC' + struct.pack(end + 'I', len(self.spec))
+        for struct_name, fields in self.spec:
+            data += struct.pack(end + 'HH', self.types.index(struct_name), len(fields))
+            for ftype, fname in fields:
+                data += struct.pack(end + 'HH', self.types.index(ftype), self.names.index(fname))
+
+        return data
+
+    def pack(self, struct_name: str, values: dict = None) -> bytes:
+        """Packs an instance of the struct; missing values are zero."""
+
+        values = values or {}
+        end = self.endian
+        pointer_fmt = 'I' if self.pointer_size == 4 else 'Q'
+        basic_fmt = {'char': 'b', 'uchar': 'B', 'short': 'h', 'ushort': 'H', 'int': 'i',
+                     'long': 'i', 'ulong': 'I', 'float': 'f', 'double': 'd',
+                     'int64_t': 'q', 'uint64_t': 'Q'}
+
+        parts = []
+        for ftype, fname in self.struct_fields[struct_name]:
+            key = self.name_only(fname)
+            count = self.array_size(fname)
+            value = values.get(key)
+
+            if '*' in fname:
+                pointers = value if isinstance(value, (list, tuple)) else [value or 0] * count
+                parts.append(struct.pack(end + pointer_fmt * count, *pointers))
+            elif ftype == 'char' and count > 1:
+                if isinstance(value, str):
+                    value = value.encode('utf-8')
+                parts.append((value or b'')[:count - 1].ljust(count, b'\0'))
+            elif ftype in basic_fmt:
+                if value is None:
+                    value = [0] * count
+                elif count == 1:
+                    value = [value]
+                parts.append(struct.pack(end + basic_fmt[ftype] * count, *value))
+            else:
+                # Embedded struct
+                for idx in range(count):
+                    subvalue = value[idx] if isinstance(value, list) else value
+                    parts.append(self.pack(ftype, subvalue))
+
+        packed = b''.join(parts)
+        assert len(packed) == self.struct_size(struct_name)
+        return packed
+
+
+def blend_bytes(*, object_count=10, verts_per_mesh=100, image_count=None,
+                pointer_size=8, endian='<', version=279) -> bytes:
+    """Returns the contents of a synthetic blend file.
+
+    The file contains a USER block, 'object_count' objects that each use their
+    own mesh with 'verts_per_mesh' vertices, and 'image_count' images
+    (defaults to object_count). The objects form a linked list through their
+    id.next and id.prev pointers, and so do the meshes and images.
+    """
+
+    if image_count is None:
+        image_count = object_count
+
+    dna = DNACatalog(pointer_size=pointer_size, endian=endian)
+    block_header = struct.Struct(endian + '4sI' + ('I' if pointer_size == 4 else 'Q') + 'II')
+
+    next_address = [0x10000]
+
+    def allocate(size: int) -> int:
+        address = next_address[0]
+        next_address[0] += max(size, 1) + 16
+        return address
+
+    def block(code: bytes, struct_name: str, payload: bytes, address: int, count=1) -> bytes:
+        return block_header.pack(code, len(payload), address,
+                                 dna.sdna_index(struct_name), count) + payload
+
+    obj_addrs = [allocate(dna.struct_size('Object')) for _ in range(object_count)]
+    mesh_addrs = [allocate(dna.struct_size('Mesh')) for _ in range(object_count)]
+    vert_addrs = [allocate(dna.struct_size('MVert') * verts_per_mesh)
+                  for _ in range(object_count)]
+    img_addrs = [allocate(dna.struct_size('Image')) for _ in range(image_count)]
+
+    def chain(addresses, idx):
+        return {'next': addresses[idx + 1] if idx + 1 < len(addresses) else 0,
+                'prev': addresses[idx - 1] if idx > 0 else 0}
+
+    header = b''.join((b'BLENDER',
+                       b'_' if pointer_size == 4 else b'-',
+                       b'v' if endian == '<' else b'V',
+                       str(version).encode('ascii')))
+    parts = [header]
+
+    userdef = {'versionfile': version, 'dpi': 72, 'virtual_pixel': 0,
+               'fontdir': '//fonts/', 'tempdir': '/tmp/', 'textudir': '//textures/',
+               'compute_device_type': 0, 'compute_device_id': 'CPU'}
+    parts.append(block(b'USER', 'UserDef', dna.pack('UserDef', userdef), allocate(0)))
+
+    for idx in range(object_count):
+        mesh_id = dict(chain(mesh_addrs, idx), name='MEMesh.%03i' % idx, us=1)
+        mesh = dna.pack('Mesh', {'id': mesh_id,
+                                 'mvert': vert_addrs[idx] if verts_per_mesh else 0,
+                                 'totvert': verts_per_mesh, 'size': [1.0, 1.0, 1.0]})
+        parts.append(block(b'ME', 'Mesh', mesh, mesh_addrs[idx]))
+
+        if verts_per_mesh:
+            vert = dna.pack('MVert', {'co': [0.0, float(idx), 0.0], 'no': [0, 0, 32767]})
+            parts.append(block(b'DATA', 'MVert', vert * verts_per_mesh,
+                               vert_addrs[idx], verts_per_mesh))
+
+        ob_id = dict(chain(obj_addrs, idx), name='OBObject.%03i' % idx, us=1)
+        ob = dna.pack('Object', {'id': ob_id, 'type': OBJECT_TYPE_MESH, 'data': mesh_addrs[idx],
+                                 'loc': [float(idx), 0.0, 0.0], 'size': [1.0, 1.0, 1.0],
+                                 'lay': 1})
+        parts.append(block(b'OB', 'Object', ob, obj_addrs[idx]))
+
+    for idx in range(image_count):
+        im_id = dict(chain(img_addrs, idx), name='IMImage.%03i' % idx, us=1)
+        image = dna.pack('Image', {'id': im_id, 'name': '//textures/image-%03i.png' % idx,
+                                   'source': 1, 'gen_x': 1024, 'gen_y': 1024})
+        parts.append(block(b'IM', 'Image', image, img_addrs[idx]))
+
+    # Like real blend files, the DNA is stored at the end.
+    dna_data = dna.encode()
+    parts.append(block_header.pack(b'DNA1', len(dna_data), allocate(0), 0, 1) + dna_data)
+    parts.append(block_header.pack(b'ENDB', 0, 0, 0, 0))
+
+    return b''.join(parts)
+
+
+def verts_for_size(target_size: int, object_count: int, *, pointer_size=8) -> int:
+    """Returns the number of vertices per mesh to get a file of about target_size bytes."""
+
+    dna = DNACatalog(pointer_size=pointer_size)
+    overhead = len(blend_bytes(object_count=object_count, verts_per_mesh=0,
+                               pointer_size=pointer_size))
+    per_vert = dna.struct_size('MVert') * object_count
+    return max(0, (target_size - overhead) // max(per_vert, 1))
+
+
+def generate_blend(filepath, *, target_size: int = None, compress=False, **kwargs) -> int:
+    """Writes a synthetic blend file, returning its size in bytes (before compression).
+
+    :param target_size: approximate file size in bytes; when given, this determines
+        the number of vertices per mesh, and 'verts_per_mesh' is ignored.
+    :param compress: gzip-compress the file, like Blender does with 'Compress File'.
+    :param kwargs: passed to blend_bytes().
+    """
+
+    if target_size is not None:
+        kwargs['verts_per_mesh'] = verts_for_size(target_size,
+                                                  kwargs.get('object_count', 10),
+                                                  pointer_size=kwargs.get('pointer_size', 8))
+
+    data = blend_bytes(**kwargs)
+
+    if compress:
+        with gzip.open(str(filepath), 'wb') as outfile:
+            outfile.write(data)
+    else:
+        with open(str(filepath), 'wb') as outfile:
+            outfile.write(data)
+
+    return len(data)
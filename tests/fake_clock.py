@@ -0,0 +1,11 @@
+"""Fake clock for tests of code that takes a clock function, like time.monotonic."""
+
+
+class FakeClock:
+    """Returns the time in seconds that the test sets; advance it with `clock.now += delta`."""
+
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Load test of blender_cloud.pillar against the stand-in Pillar server.
+
+Starts a MockPillarServer, points the add-on at it, and lets a number of
+concurrent clients repeatedly run a workload through the functions in
+pillar.py. Afterwards the throughput and latency percentiles are reported,
+together with the add-on's own metrics. Run from the top-level directory
+of the repository:
+
+    python tests/load_pillar.py --workload browse --clients 8 --iterations 5 \\
+        --latency 0.05 --bandwidth 2000000 --error-rate 0.02 --output load.json
+
+Workloads:
+
+- browse: list the texture libraries and their folders, and download the
+  thumbnails of one folder, like the texture browser does.
+- download: download all maps of a random texture.
+- nodes: list all nodes of a texture library, page by page.
+
+Every iteration uses fresh directories, so nothing is served from the
+add-on's disk caches.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import math
+import pathlib
+import random
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import requests
+
+my_dir = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(my_dir.parent))
+sys.path.insert(0, str(my_dir))
+
+from blender_cloud import http_transport, metrics, offline, pillar, session, upload  # noqa: E402
+import mock_pillar  # noqa: E402
+
+WORKLOADS = {}
+
+
+def workload(func):
+    """Decorator, registers a workload coroutine function.
+
+    The function receives the Client and performs one iteration.
+    """
+
+    WORKLOADS[func.__name__] = func
+    return func
+
+
+class _Profile:
+    """Stand-in for the Blender ID profile of the mock user."""
+
+    def __init__(self, user: dict):
+        self.username = user['email']
+        self.subclients = {pillar.SUBCLIENT_ID: {'subclient_user_id': user['_id'],
+                                                 'token': 'mock-token'}}
+
+    def save_json(self):
+        pass
+
+
+@contextlib.contextmanager
+def configure_client(server: mock_pillar.MockPillarServer, tmpdir: pathlib.Path,
+                     pool_size=10):
+    """Points blender_cloud.pillar at the server, with fresh global state.
+
+    :param pool_size: number of HTTP connections to keep open to the server.
+    """
+
+    user = server.dataset.user
+    http_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http_session.mount('http://', adapter)
+    api = pillar.DeadlineApi(endpoint=server.api_url, username=user['_id'],
+                             password=pillar.SUBCLIENT_ID, token='mock-token')
+    api.requests_session = http_session
+
+    transport = http_transport.AsyncioTransport()
+    snapshots = offline.SnapshotStore(str(tmpdir / 'snapshots'))
+    patchers = [
+        mock.patch('blender_cloud.pillar._testing_blender_id_profile', _Profile(user)),
+        mock.patch('blender_cloud.pillar._pillar_api', {True: api, False: api}),
+        mock.patch('blender_cloud.pillar._transport', transport),
+        mock.patch('blender_cloud.pillar._snapshot_store', snapshots),
+        mock.patch('blender_cloud.pillar._upload_index',
+                   upload.UploadIndex(str(tmpdir / 'uploads' / 'file_ids.json'))),
+        mock.patch('blender_cloud.pillar._background_revalidations', {}),
+        mock.patch('blender_cloud.offline.connectivity', offline.Connectivity()),
+        mock.patch('blender_cloud.resilience._breakers', {}),
+        mock.patch('blender_cloud.metrics.registry', metrics.Registry()),
+        mock.patch('blender_cloud.session.manager', session.SessionManager()),
+    ]
+    with contextlib.ExitStack() as stack:
+        for patcher in patchers:
+            stack.enter_context(patcher)
+        stack.callback(http_session.close)
+        stack.callback(transport.close)
+        # Snapshots are written in the background, and the loop closes soon after.
+        stack.callback(lambda: asyncio.get_event_loop().run_until_complete(snapshots.flush()))
+        yield
+
+
+def _ignore(*args):
+    pass
+
+
+class Client:
+    """One simulated user, performing workload iterations one after the other."""
+
+    def __init__(self, client_nr: int, server: mock_pillar.MockPillarServer,
+                 tmpdir: pathlib.Path, seed: int):
+        self.client_nr = client_nr
+        self.server = server
+        self.tmpdir = tmpdir
+        self.random = random.Random(seed + client_nr)
+        self.iteration = 0
+        self.durations = []
+        self.errors = []
+
+    def fresh_dir(self, name: str) -> str:
+        path = self.tmpdir / ('client-%i' % self.client_nr) / ('%i' % self.iteration) / name
+        path.mkdir(parents=True, exist_ok=True)
+        return str(path)
+
+    def random_project(self) -> dict:
+        return self.random.choice(self.server.dataset.texture_libraries)
+
+    async def run(self, workload_func, iterations: int):
+        loop = asyncio.get_event_loop()
+        for self.iteration in range(iterations):
+            start = loop.time()
+            try:
+                await workload_func(self)
+            except Exception as ex:
+                self.errors.append('%s: %s' % (type(ex).__name__, ex))
+            else:
+                self.durations.append(loop.time() - start)
+
+
+@workload
+async def browse(client: Client):
+    projects = await pillar.get_texture_projects()
+    project = client.random.choice(projects)
+    folders = await pillar.get_node_records(project['_id'], '')
+    folder = client.random.choice(folders)
+    await pillar.fetch_texture_thumbs(folder['_id'], 's', client.fresh_dir('thumbnails'),
+                                      thumbnail_loading=_ignore, thumbnail_loaded=_ignore)
+
+
+@workload
+async def download(client: Client):
+    project = client.random_project()
+    textures = await pillar.get_nodes(project['_id'], node_type='texture')
+    texture = client.random.choice(textures)
+    results = await pillar.download_texture(texture, client.fresh_dir('textures'),
+                                            client.fresh_dir('metadata'),
+                                            texture_loading=_ignore, texture_loaded=_ignore,
+                                            future=None)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+@workload
+async def nodes(client: Client):
+    await pillar.get_nodes(client.random_project()['_id'])
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Returns the nearest-rank percentile of the sorted values."""
+
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def run_load(server: mock_pillar.MockPillarServer, workload_name: str, *,
+             clients=4, iterations=5, seed=0) -> dict:
+    """Runs the workload with concurrent clients, and returns the report as dict."""
+
+    workload_func = WORKLOADS[workload_name]
+    tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-load-'))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    requests_before = server.total_requests
+    try:
+        with configure_client(server, tmpdir, pool_size=max(10, clients * 2)):
+            the_clients = [Client(client_nr, server, tmpdir, seed) for client_nr in range(clients)]
+            start = time.monotonic()
+            loop.run_until_complete(asyncio.gather(
+                *(client.run(workload_func, iterations) for client in the_clients)))
+            duration = time.monotonic() - start
+
+            all_stats = metrics.registry.all_stats()
+            bytes_received = sum(stats.bytes_received for stats in all_stats)
+            metrics_summary = metrics.registry.summary_lines(max_lines=20)
+            metrics_snapshot = metrics.registry.snapshot()
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(str(tmpdir))
+
+    durations = sorted(duration for client in the_clients for duration in client.durations)
+    errors = [error for client in the_clients for error in client.errors]
+    return {
+        'workload': workload_name,
+        'clients': clients,
+        'iterations': iterations,
+        'duration': duration,
+        'operations': len(durations),
+        'errors': len(errors),
+        'error_samples': errors[:10],
+        'ops_per_second': len(durations) / duration if duration else 0.0,
+        'bytes_received': bytes_received,
+        'mib_per_second': bytes_received / duration / 2 ** 20 if duration else 0.0,
+        'http_requests': server.total_requests - requests_before,
+        'latency': {
+            'mean': sum(durations) / len(durations) if durations else 0.0,
+            'p50': percentile(durations, 0.5),
+            'p90': percentile(durations, 0.9),
+            'p99': percentile(durations, 0.99),
+            'max': durations[-1] if durations else 0.0,
+        },
+        'server_requests': dict(server.request_counts),
+        'metrics_summary': metrics_summary,
+        'metrics': metrics_snapshot,
+    }
+
+
+def print_report(report: dict):
+    latency = report['latency']
+    print('%-10s %i clients x %i iterations in %.2f s' % (
+        report['workload'], report['clients'], report['iterations'], report['duration']))
+    print('  %i operations, %i errors, %.1f ops/s, %.2f MiB/s, %i HTTP requests' % (
+        report['operations'], report['errors'], report['ops_per_second'],
+        report['mib_per_second'], report['http_requests']))
+    print('  latency p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s' % (
+        latency['p50'], latency['p90'], latency['p99'], latency['max']))
+    for line in report['metrics_summary']:
+        print('    %s' % line)
+    for error in report['error_samples']:
+        print('  error: %s' % error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), action='append',
+                        help='workload to run; can be given multiple times. Default: all')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='number of concurrent clients')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='number of workload iterations per client')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    mock_pillar.add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = mock_pillar.server_from_arguments(args)
+    reports = []
+    with server:
+        for workload_name in args.workload or sorted(WORKLOADS):
+            report = run_load(server, workload_name, clients=args.clients,
+                              iterations=args.iterations, seed=args.seed)
+            print_report(report)
+            reports.append(report)
+
+    if args.output:
+        result = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'server': server.describe(),
+            'reports': reports,
+        }
+        with open(args.output, 'w') as outfile:
+            json.dump(result, outfile, indent=1, sort_keys=True)
+        print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
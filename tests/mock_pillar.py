@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+"""Stand-in Pillar server, for testing and benchmarking without the Blender Cloud.
+
+Implements the parts of the Pillar API that the add-on uses, on a generated
+dataset of texture libraries:
+
+- GET /api/{nodes,files,projects} with Eve's where/page/max_results query
+  parameters, and GET /api/{nodes,files,projects}/<id>
+- POST /api/nodes and PUT /api/nodes/<id>
+- GET /api/users/me, /api/bcloud/texture-libraries and /api/bcloud/home-project
+- POST /storage/stream/<project_id>, which creates a File document
+- GET /files/<file_id>/<filename>, the download links of files and their
+  thumbnails, with support for conditional and Range requests.
+
+Projections and embedding are ignored; documents are always returned in full.
+The latency, bandwidth and failure rate of the server can be configured,
+to see how the add-on copes with slow or flaky connections.
+
+Usage:
+
+    >>> server = MockPillarServer(Dataset(projects=2, textures=50), latency=0.05)
+    >>> server.start()
+    >>> server.api_url
+    'http://127.0.0.1:38271/api/'
+    >>> server.stop()
+
+or run this file to serve the dataset until interrupted:
+
+    python tests/mock_pillar.py --port 5000 --latency 0.05 --error-rate 0.01
+"""
+
+import argparse
+import datetime
+import email.utils
+import hashlib
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+THUMBNAIL_SIZES = 'sbtmlh'
+EVE_DEFAULT_MAX_RESULTS = 25
+_MISSING = object()
+
+
+class Dataset:
+    """Generated projects, nodes and files of a number of texture libraries.
+
+    Every texture library project has `folders` top-level texture folders
+    with `textures` texture nodes each. Every texture has `maps` image
+    files of `file_size` bytes. File contents are generated from the file
+    ID, so they don't have to be stored.
+    """
+
+    def __init__(self, *, projects=2, folders=3, textures=10, maps=2,
+                 file_size=64 * 1024, thumbnail_size=2048):
+        self.file_size = file_size
+        self.thumbnail_size = thumbnail_size
+        self._id_counter = 0
+        self._lock = threading.Lock()
+
+        self.user = {'_id': self.new_id(), 'username': 'mock-user', 'full_name': 'Mock User',
+                     'email': 'mock-user@example.com', 'roles': ['subscriber']}
+        self.collections = {'projects': {}, 'nodes': {}, 'files': {}}
+        self.file_contents = {}  # contents of uploaded files, by file ID.
+        self.home_project = self._insert('projects', {
+            'name': 'Home', 'url': 'home-%s' % self.user['_id'], 'category': 'home',
+            'user': self.user['_id'],
+        })
+        self.texture_libraries = []
+
+        for project_nr in range(projects):
+            project = self._insert('projects', {
+                'name': 'Textures %i' % project_nr, 'url': 'textures-%i' % project_nr,
+                'category': 'assets', 'user': self.user['_id'],
+            })
+            self.texture_libraries.append(project)
+            for folder_nr in range(folders):
+                folder = self._insert('nodes', {
+                    'project': project['_id'], 'node_type': 'group_texture',
+                    'name': 'Folder %i' % folder_nr,
+                    'properties': {'status': 'published', 'order': folder_nr},
+                })
+                for texture_nr in range(textures):
+                    self._add_texture(project, folder, texture_nr, maps)
+
+    def new_id(self) -> str:
+        """Returns a new ObjectId-like string."""
+
+        with self._lock:
+            self._id_counter += 1
+            return '5a%022x' % self._id_counter
+
+    def _insert(self, collection: str, doc: dict) -> dict:
+        now = email.utils.formatdate(usegmt=True)
+        doc = dict(doc, _updated=now)
+        doc.setdefault('_id', self.new_id())
+        doc.setdefault('_created', now)
+        doc['_etag'] = hashlib.sha1(json.dumps(doc, sort_keys=True).encode()).hexdigest()
+        self.collections[collection][doc['_id']] = doc
+        return doc
+
+    def _add_texture(self, project: dict, folder: dict, texture_nr: int, maps: int):
+        map_types = ['color', 'normal', 'bump', 'specular', 'roughness'][:maps]
+        texture_name = '%s texture %i' % (folder['name'], texture_nr)
+        files = [self.add_file(project['_id'],
+                               '%s-%s.png' % (texture_name.replace(' ', '_'), map_type),
+                               self.file_size)
+                 for map_type in map_types]
+        self._insert('nodes', {
+            'project': project['_id'], 'node_type': 'texture', 'name': texture_name,
+            'parent': folder['_id'], 'picture': files[0]['_id'],
+            'properties': {
+                'status': 'published', 'order': texture_nr, 'content_type': 'texture',
+                'files': [{'file': file_doc['_id'], 'map_type': map_type}
+                          for file_doc, map_type in zip(files, map_types)],
+            },
+        })
+
+    def add_file(self, project_id: str, filename: str, length: int, content: bytes = None) -> dict:
+        """Creates a File document; its content is generated unless given."""
+
+        file_id = self.new_id()
+        stored_content = content
+        if content is None:
+            content = self.generate_content(file_id, length)
+        file_doc = self._insert('files', {
+            '_id': file_id,
+            'filename': filename,
+            'file_path': '%s%s' % (file_id, filename[filename.rfind('.'):]),
+            'content_type': 'image/png',
+            'length': len(content),
+            'md5': hashlib.md5(content).hexdigest(),
+            'project': project_id,
+            'backend': 'mock',
+        })
+        if stored_content is not None:
+            # Uploaded contents can't be generated again, so have to be kept.
+            self.file_contents[file_id] = stored_content
+        return file_doc
+
+    @staticmethod
+    def generate_content(seed: str, length: int) -> bytes:
+        block = hashlib.sha256(seed.encode()).digest() * 128
+        repeat = length // len(block) + 1
+        return (block * repeat)[:length]
+
+    def file_content(self, file_id: str, size: str = None) -> bytes:
+        """Returns the contents of a file, or of its thumbnail of the given size."""
+
+        file_doc = self.collections['files'][file_id]
+        if size is not None:
+            return self.generate_content('%s-%s' % (file_id, size), self.thumbnail_size)
+        try:
+            return self.file_contents[file_id]
+        except KeyError:
+            return self.generate_content(file_id, file_doc['length'])
+
+    def find(self, collection: str, where: dict) -> list:
+        """Returns the documents in the collection that match the Eve/MongoDB query."""
+        return [doc for doc in self.collections[collection].values() if matches(doc, where)]
+
+    def create_node(self, doc: dict) -> dict:
+        return self._insert('nodes', doc)
+
+    def update_node(self, node_id: str, doc: dict) -> dict:
+        existing = self.collections['nodes'][node_id]
+        return self._insert('nodes', dict(doc, _id=node_id, _created=existing['_created']))
+
+
+def _lookup(doc: dict, dotted_key: str):
+    value = doc
+    for key in dotted_key.split('.'):
+        if isinstance(value, list):
+            value = [item.get(key, _MISSING) for item in value if isinstance(item, dict)]
+            continue
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+def _equals(value, expected) -> bool:
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+
+def matches(doc: dict, where: dict) -> bool:
+    """Returns whether the document matches the MongoDB query.
+
+    Supports equality on (dotted) keys, and the $in, $nin, $ne and $exists operators.
+    """
+
+    for key, condition in where.items():
+        value = _lookup(doc, key)
+        if not (isinstance(condition, dict) and condition
+                and all(op.startswith('$') for op in condition)):
+            if not _equals(value, condition):
+                return False
+            continue
+
+        for op, arg in condition.items():
+            if op == '$in':
+                ok = any(_equals(value, item) for item in arg)
+            elif op == '$nin':
+                ok = not any(_equals(value, item) for item in arg)
+            elif op == '$ne':
+                ok = not _equals(value, arg)
+            elif op == '$exists':
+                ok = (value is not _MISSING) == bool(arg)
+            else:
+                raise ValueError('Unsupported query operator %r' % op)
+            if not ok:
+                return False
+    return True
+
+
+class MockPillarHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # Request dispatching.
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def _dispatch(self, method: str):
+        url = urllib.parse.urlsplit(self.path)
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        self.request_body = self._read_body()
+        path = url.path
+
+        self.server.count_request(method, path)
+        self.server.inject_latency()
+        if self.server.inject_error():
+            self.send_json({'_status': 'ERR', '_error': {'message': 'Injected error'}},
+                           status=self.server.error_status)
+            return
+
+        for route_method, pattern, handler_name in ROUTES:
+            if route_method != method and not (route_method == 'GET' and method == 'HEAD'):
+                continue
+            match = re.fullmatch(pattern, path)
+            if match:
+                try:
+                    getattr(self, handler_name)(*match.groups())
+                except ValueError as ex:
+                    self.send_json({'_status': 'ERR', '_error': {'message': str(ex)}}, status=400)
+                except KeyError:
+                    self.send_json({'_status': 'ERR', '_error': {'message': 'Not found'}},
+                                   status=404)
+                return
+
+        self.send_json({'_status': 'ERR', '_error': {'message': 'No such endpoint'}}, status=404)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return b''
+        return self.rfile.read(length)
+
+    # Responses.
+
+    def send_json(self, document, *, status=200):
+        body = json.dumps(document).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_body(self, body: bytes):
+        """Sends the body, limited to the configured bandwidth."""
+
+        if self.server.disconnect_halfway():
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+
+        block_size = 16 * 1024
+        for offset in range(0, len(body), block_size):
+            block = body[offset:offset + block_size]
+            self.server.throttle(len(block))
+            self.wfile.write(block)
+
+    # API endpoints.
+
+    def get_collection(self, collection: str):
+        where = json.loads(self.query.get('where', '{}'))
+        page = int(self.query.get('page', 1))
+        max_results = int(self.query.get('max_results', EVE_DEFAULT_MAX_RESULTS))
+        found = self.server.dataset.find(collection, where)
+        items = found[(page - 1) * max_results:page * max_results]
+
+        links = {}
+        if page * max_results < len(found):
+            links['next'] = {'href': '%s?page=%i' % (collection, page + 1)}
+        self.send_json({
+            '_items': [self.server.render(collection, doc) for doc in items],
+            '_meta': {'page': page, 'max_results': max_results, 'total': len(found)},
+            '_links': links,
+        })
+
+    def get_document(self, collection: str, doc_id: str):
+        doc = self.server.dataset.collections[collection][doc_id]
+        self.send_json(self.server.render(collection, doc))
+
+    def get_user(self):
+        self.send_json(self.server.dataset.user)
+
+    def get_texture_libraries(self):
+        libraries = self.server.dataset.texture_libraries
+        self.send_json({
+            '_items': libraries,
+            '_meta': {'page': 1, 'max_results': len(libraries), 'total': len(libraries)},
+        })
+
+    def get_home_project(self):
+        self.send_json(self.server.dataset.home_project)
+
+    def post_node(self):
+        doc = self.server.dataset.create_node(json.loads(self.request_body.decode('utf8')))
+        self.send_json(self._status(doc), status=201)
+
+    def put_node(self, node_id: str):
+        doc = self.server.dataset.update_node(node_id,
+                                              json.loads(self.request_body.decode('utf8')))
+        self.send_json(self._status(doc))
+
+    @staticmethod
+    def _status(doc: dict) -> dict:
+        return {'_id': doc['_id'], '_etag': doc['_etag'], '_created': doc['_created'],
+                '_updated': doc['_updated'], '_status': 'OK'}
+
+    def post_stream(self, project_id: str):
+        content_type = self.headers.get('Content-Type', '')
+        body = self.request_body
+        filename = 'upload.bin'
+        if content_type.startswith('multipart/form-data'):
+            head, body = body.split(b'\r\n\r\n', 1)
+            body = body.rsplit(b'\r\n--', 1)[0]
+            match = re.search(rb'filename="([^"]*)"', head)
+            if match:
+                filename = match.group(1).decode('utf8')
+
+        file_doc = self.server.dataset.add_file(project_id, filename, len(body), body)
+        self.send_json({'status': 'ok', 'file_id': file_doc['_id']}, status=201)
+
+    # File storage.
+
+    def get_file(self, file_id: str, filename: str):
+        file_doc = self.server.dataset.collections['files'][file_id]
+        size = None
+        match = re.fullmatch(r'.*-([%s])\.jpg' % THUMBNAIL_SIZES, filename)
+        if match and filename != file_doc['filename']:
+            size = match.group(1)
+        content = self.server.dataset.file_content(file_id, size)
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = 0, len(content) - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header or '')
+        if match and (if_range is None or if_range == etag):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%i' % len(content))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        body = content[start:end + 1]
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/jpeg' if size else file_doc['content_type'])
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, end, len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.send_body(body)
+
+
+ROUTES = [
+    ('GET', r'/api/users/me', 'get_user'),
+    ('GET', r'/api/bcloud/texture-libraries', 'get_texture_libraries'),
+    ('GET', r'/api/bcloud/home-project', 'get_home_project'),
+    ('GET', r'/api/(nodes|files|projects)', 'get_collection'),
+    ('GET', r'/api/(nodes|files|projects)/([0-9a-f]{24})', 'get_document'),
+    ('POST', r'/api/nodes', 'post_node'),
+    ('PUT', r'/api/nodes/([0-9a-f]{24})', 'put_node'),
+    ('POST', r'/storage/stream/([0-9a-f]{24})', 'post_stream'),
+    ('GET', r'/files/([0-9a-f]{24})/([^/]+)', 'get_file'),
+]
+
+
+class MockPillarServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server serving a Dataset like Pillar would.
+
+    :param latency: seconds to wait before handling each request.
+    :param jitter: maximum number of seconds randomly added to the latency.
+    :param bandwidth: bytes per second at which each file is sent, or 0 for unlimited.
+    :param error_rate: fraction of requests that fail with `error_status`.
+    :param disconnect_rate: fraction of file downloads that are cut off halfway.
+    :param seed: seed for the random generator deciding on errors and jitter.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, dataset: Dataset = None, *, host='127.0.0.1', port=0,
+                 latency=0.0, jitter=0.0, bandwidth=0, error_rate=0.0, error_status=503,
+                 disconnect_rate=0.0, seed=0, verbose=False):
+        super().__init__((host, port), MockPillarHandler)
+        self.dataset = dataset or Dataset()
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.verbose = verbose
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.request_counts = {}  # mapping from 'METHOD /path' to number of requests.
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return 'http://%s:%i/' % (host, port)
+
+    @property
+    def api_url(self) -> str:
+        return self.url + 'api/'
+
+    def start(self):
+        """Serves requests in a background thread."""
+
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        kwargs={'poll_interval': 0.05}, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def count_request(self, method: str, path: str):
+        # Group file downloads and documents by their type, not by their ID.
+        key = re.sub(r'/[0-9a-f]{24}(/[^/]+)?', '/<id>', '%s %s' % (method, path))
+        with self._lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    @property
+    def total_requests(self) -> int:
+        with self._lock:
+            return sum(self.request_counts.values())
+
+    def _chance(self, rate: float) -> bool:
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def inject_latency(self):
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def inject_error(self) -> bool:
+        return self._chance(self.error_rate)
+
+    def disconnect_halfway(self) -> bool:
+        return self._chance(self.disconnect_rate)
+
+    def throttle(self, amount: int):
+        if self.bandwidth:
+            time.sleep(amount / self.bandwidth)
+
+    def describe(self) -> dict:
+        """Returns the configuration of the server and the size of its dataset."""
+
+        return {
+            'latency': self.latency,
+            'jitter': self.jitter,
+            'bandwidth': self.bandwidth,
+            'error_rate': self.error_rate,
+            'error_status': self.error_status,
+            'disconnect_rate': self.disconnect_rate,
+            'dataset': {collection: len(docs)
+                        for collection, docs in self.dataset.collections.items()},
+        }
+
+    def render(self, collection: str, doc: dict) -> dict:
+        """Returns the document as the API returns it, with download links for files."""
+
+        if collection != 'files':
+            return doc
+        doc = dict(doc)
+
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+        root = doc['filename'].rsplit('.', 1)[0]
+        doc['link'] = '%sfiles/%s/%s' % (self.url, doc['_id'], doc['filename'])
+        doc['link_expires'] = email.utils.format_datetime(expires, usegmt=True)
+        doc['variations'] = [
+            {'size': size, 'content_type': 'image/jpeg', 'format': 'jpg',
+             'length': self.dataset.thumbnail_size,
+             'file_path': '%s-%s.jpg' % (doc['_id'], size),
+             'link': '%sfiles/%s/%s-%s.jpg' % (self.url, doc['_id'], root, size)}
+            for size in THUMBNAIL_SIZES]
+        return doc
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """Adds the command line options of the dataset and the server to the parser."""
+
+    parser.add_argument('--projects', type=int, default=2,
+                        help='number of texture library projects')
+    parser.add_argument('--folders', type=int, default=3, help='texture folders per project')
+    parser.add_argument('--textures', type=int, default=10, help='textures per folder')
+    parser.add_argument('--file-size', type=int, default=64 * 1024,
+                        help='size of every texture file in bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random extra latency in seconds')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second per download; 0 is unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0,
+                        help='fraction of downloads that are cut off halfway')
+
+
+def server_from_arguments(args, *, port=0, verbose=False) -> MockPillarServer:
+    """Creates the server as configured by the options from add_server_arguments()."""
+
+    dataset = Dataset(projects=args.projects, folders=args.folders, textures=args.textures,
+                      file_size=args.file_size)
+    return MockPillarServer(dataset, port=port, latency=args.latency,
+                            jitter=args.jitter, bandwidth=args.bandwidth,
+                            error_rate=args.error_rate, error_status=args.error_status,
+                            disconnect_rate=args.disconnect_rate, verbose=verbose)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=5000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = server_from_arguments(args, port=args.port, verbose=True)
+    print('Serving %(nodes)i nodes and %(files)i files' % server.describe()['dataset'],
+          'at', server.api_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Unittests for blender_cloud.bandwidth."""
+
+import asyncio
+import unittest
+from unittest import mock
+
+from blender_cloud import bandwidth
+from blender_cloud.concurrency import Priority
+
+from fake_clock import FakeClock
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_unlimited(self):
+        bucket = bandwidth.TokenBucket('test', clock=self.clock)
+        self.assertEqual(0.0, bucket.reserve(10 ** 9))
+
+    def test_rate(self):
+        rate = bandwidth.MIN_BURST
+        bucket = bandwidth.TokenBucket('test', rate, clock=self.clock)
+        self.assertEqual(0.0, bucket.reserve(rate))
+        # The burst is used up, so every byte has to be waited for.
+        self.assertAlmostEqual(0.5, bucket.reserve(rate // 2))
+        # Concurrent callers queue up behind each other.
+        self.assertAlmostEqual(1.0, bucket.reserve(rate // 2))
+
+        self.clock.now += 1.0
+        self.assertAlmostEqual(0.5, bucket.reserve(rate // 2))
+
+    def test_min_burst(self):
+        bucket = bandwidth.TokenBucket('test', 1000, burst=1000, clock=self.clock)
+        self.assertEqual(0.0, bucket.reserve(bandwidth.MIN_BURST))
+        self.assertAlmostEqual(1.0, bucket.reserve(1000))
+
+    def test_live_change(self):
+        bucket = bandwidth.TokenBucket('test', 1000, clock=self.clock)
+        bucket.reserve(10 * bandwidth.MIN_BURST)
+
+        # Debt at the old rate is forgiven.
+        bucket.set_rate(1000000)
+        self.assertEqual(0.0, bucket.reserve(1000))
+
+        bucket.set_rate(0)
+        self.assertEqual(0.0, bucket.reserve(10 ** 9))
+
+    def test_consume(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        bucket = bandwidth.TokenBucket('test', 100, burst=bandwidth.MIN_BURST, clock=FakeClock())
+        bucket.reserve(bandwidth.MIN_BURST)
+
+        with mock.patch('asyncio.sleep') as mock_sleep:
+            async def no_sleep(delay):
+                self.assertAlmostEqual(1.0, delay, places=2)
+            mock_sleep.side_effect = no_sleep
+            loop.run_until_complete(bucket.consume(100))
+        self.assertEqual(1, mock_sleep.call_count)
+
+
+class ThroughputMeterTest(unittest.TestCase):
+    def test_window(self):
+        clock = FakeClock()
+        meter = bandwidth.ThroughputMeter('test', window=2.0, clock=clock)
+        self.assertEqual(0.0, meter.rate)
+
+        meter.record(1000)
+        clock.now += 1.0
+        meter.record(3000)
+        self.assertEqual(2000.0, meter.rate)
+
+        clock.now += 1.5
+        self.assertEqual(1500.0, meter.rate)
+        clock.now += 1.0
+        self.assertEqual(0.0, meter.rate)
+        self.assertEqual(4000, meter.total)
+
+    def test_status_text(self):
+        clock = FakeClock()
+        with mock.patch.multiple(
+                bandwidth,
+                download_meter=bandwidth.ThroughputMeter('down', window=1.0, clock=clock),
+                upload_meter=bandwidth.ThroughputMeter('up', window=1.0, clock=clock)):
+            self.assertEqual('', bandwidth.status_text())
+
+            bandwidth.download_meter.record(3 * 1024 * 1024)
+            self.assertEqual('Download 3.0 MiB/s', bandwidth.status_text())
+
+            bandwidth.upload_throttle(Priority.BACKGROUND)(512 * 1024)
+            self.assertEqual('Download 3.0 MiB/s, Upload 512 KiB/s', bandwidth.status_text())
+
+    def test_bucket_for(self):
+        self.assertIs(bandwidth.interactive_bucket, bandwidth.bucket_for(Priority.INTERACTIVE))
+        self.assertIs(bandwidth.interactive_bucket, bandwidth.bucket_for(Priority.VISIBLE))
+        self.assertIs(bandwidth.background_bucket, bandwidth.bucket_for(Priority.PREFETCH))
+        self.assertIs(bandwidth.background_bucket, bandwidth.bucket_for(Priority.BACKGROUND))
@@ -0,0 +1,83 @@
+"""Unittests for blender_cloud.blendfile, using synthetic blend files."""
+
+import io
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+from blender_cloud import blendfile
+
+import blendfile_generator
+
+
+class SyntheticBlendFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+    def test_all_platforms(self):
+        for pointer_size in (4, 8):
+            for endian in '<>':
+                data = blendfile_generator.blend_bytes(object_count=3, verts_per_mesh=7,
+                                                       pointer_size=pointer_size,
+                                                       endian=endian)
+                bfile = blendfile.BlendFile(io.BytesIO(data))
+                msg = 'pointer_size=%i endian=%s' % (pointer_size, endian)
+
+                self.assertEqual(pointer_size, bfile.header.pointer_size, msg)
+                self.assertEqual(endian == '<', bfile.header.is_little_endian, msg)
+                self.assertEqual(279, bfile.header.version, msg)
+
+                objects = bfile.find_blocks_from_code(b'OB')
+                self.assertEqual(3, len(objects), msg)
+                self.assertEqual(b'OBObject.001', objects[1][b'id', b'name'], msg)
+                self.assertEqual([1.0, 0.0, 0.0], objects[1][b'loc'], msg)
+
+                mesh = objects[2].get_pointer(b'data')
+                self.assertEqual(b'ME', mesh.code, msg)
+                self.assertEqual(7, mesh[b'totvert'], msg)
+
+                verts = mesh.get_pointer(b'mvert')
+                self.assertEqual(7, verts.count, msg)
+                self.assertEqual([0.0, 2.0, 0.0], verts.get(b'co', base_index=6), msg)
+
+    def test_pointer_chain(self):
+        data = blendfile_generator.blend_bytes(object_count=20, verts_per_mesh=1)
+        bfile = blendfile.BlendFile(io.BytesIO(data))
+
+        ob = bfile.find_blocks_from_code(b'OB')[0]
+        names = []
+        while ob is not None:
+            names.append(ob[b'id', b'name'])
+            ob = ob.get_pointer((b'id', b'next'))
+        self.assertEqual(['OBObject.%03i' % idx for idx in range(20)],
+                         [name.decode() for name in names])
+
+    def test_target_size(self):
+        path = self.tmpdir / 'sized.blend'
+        size = blendfile_generator.generate_blend(path, target_size=2 * 1024 * 1024,
+                                                  object_count=5)
+        self.assertEqual(size, path.stat().st_size)
+        self.assertAlmostEqual(2 * 1024 * 1024, size, delta=1024)
+
+    def test_compressed_modify_and_close(self):
+        path = self.tmpdir / 'compressed.blend'
+        blendfile_generator.generate_blend(path, compress=True, object_count=2)
+
+        with blendfile.open_blend(str(path), 'rb+') as bfile:
+            self.assertTrue(bfile.is_compressed)
+            prefs = bfile.find_blocks_from_code(b'USER')[0]
+            self.assertEqual(72, prefs[b'dpi'])
+            prefs[b'dpi'] = 96
+            prefs[b'fontdir'] = '/usr/share/fonts'
+
+        with path.open('rb') as infile:
+            self.assertEqual(b'\x1f\x8b', infile.read(2))
+
+        with blendfile.open_blend(str(path)) as bfile:
+            prefs = bfile.find_blocks_from_code(b'USER')[0]
+            self.assertEqual(96, prefs[b'dpi'])
+            self.assertEqual(b'/usr/share/fonts', prefs[b'fontdir'])
@@ -0,0 +1,101 @@
+"""Unittests for blender_cloud.blob_store."""
+
+import concurrent.futures
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from blender_cloud import blob_store
+
+
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.store = blob_store.BlobStore(str(self.tmpdir / 'store'))
+
+        self.blob_path = self.store.blob_path('58d0c6c8c37902', 'ABCDEF', '.png')
+        os.makedirs(os.path.dirname(self.blob_path))
+        with open(self.blob_path, 'wb') as outfile:
+            outfile.write(b'texture contents')
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+    def test_blob_path(self):
+        self.assertEqual(str(self.tmpdir / 'store/objects/58/58d0c6c8c37902-abcdef.png'),
+                         self.blob_path)
+        self.assertEqual(str(self.tmpdir / 'store/objects/58/58d0c6c8c37902'),
+                         self.store.blob_path('58d0c6c8c37902'))
+
+    def test_hardlink(self):
+        dest = str(self.tmpdir / 'scene1' / 'textures' / 'texture.png')
+        self.assertEqual('hardlink', self.store.link(self.blob_path, dest))
+        self.assertTrue(os.path.samefile(self.blob_path, dest))
+
+        # Linking again doesn't do anything.
+        self.assertEqual('existing', self.store.link(self.blob_path, dest))
+
+    def test_replaces_existing_copy(self):
+        dest = self.tmpdir / 'texture.png'
+        dest.write_bytes(b'texture contents')
+
+        self.assertEqual('hardlink', self.store.link(self.blob_path, str(dest)))
+        self.assertTrue(os.path.samefile(self.blob_path, str(dest)))
+
+    def test_fallbacks(self):
+        dest = str(self.tmpdir / 'texture.png')
+        no_link = mock.Mock(side_effect=OSError('Invalid cross-device link'))
+
+        with mock.patch('os.link', no_link), \
+                mock.patch('blender_cloud.blob_store._reflink', no_link):
+            self.assertEqual('symlink', self.store.link(self.blob_path, dest))
+        self.assertEqual(os.path.realpath(self.blob_path), os.path.realpath(dest))
+        os.unlink(dest)
+
+        with mock.patch('os.link', no_link), \
+                mock.patch('blender_cloud.blob_store._reflink', no_link), \
+                mock.patch('os.symlink', no_link):
+            self.assertEqual('copy', self.store.link(self.blob_path, dest))
+        self.assertFalse(os.path.samefile(self.blob_path, dest))
+        self.assertEqual(b'texture contents', pathlib.Path(dest).read_bytes())
+
+    def test_link_from_threads(self):
+        destinations = [str(self.tmpdir / ('scene%i' % idx) / 'texture.png') for idx in range(8)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda dest: self.store.link(self.blob_path, dest), destinations))
+        self.assertEqual(sorted(destinations), self.store._load_refs(self.blob_path))
+
+    def test_collect_garbage(self):
+        dest1 = str(self.tmpdir / 'scene1' / 'texture.png')
+        dest2 = str(self.tmpdir / 'scene2' / 'texture.png')
+        self.store.link(self.blob_path, dest1)
+        self.store.link(self.blob_path, dest2)
+
+        unused_blob = self.store.blob_path('12345', 'aa', '.jpg')
+        os.makedirs(os.path.dirname(unused_blob))
+        with open(unused_blob, 'wb') as outfile:
+            outfile.write(b'unused')
+        with open(unused_blob + '.headers', 'w') as outfile:
+            outfile.write('{}')
+
+        self.assertEqual((1, 6), self.store.collect_garbage(dry_run=True))
+        self.assertTrue(os.path.exists(unused_blob))
+
+        self.assertEqual((1, 6), self.store.collect_garbage())
+        self.assertFalse(os.path.exists(unused_blob))
+        self.assertFalse(os.path.exists(unused_blob + '.headers'))
+        self.assertTrue(os.path.exists(self.blob_path))
+
+        # Still used by the second scene.
+        os.unlink(dest1)
+        self.assertEqual((0, 0), self.store.collect_garbage())
+
+        # Replaced by a different file.
+        os.unlink(dest2)
+        with open(dest2, 'wb') as outfile:
+            outfile.write(b'another texture')
+        self.assertEqual((1, 16), self.store.collect_garbage())
+        self.assertEqual([], list(self.store.blobs()))
@@ -0,0 +1,306 @@
+"""Unittests for blender_cloud.concurrency."""
+
+import asyncio
+import unittest
+
+from blender_cloud import concurrency
+
+from fake_clock import FakeClock
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.clock = FakeClock(0.0)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def limiter(self, **kwargs) -> concurrency.AdaptiveLimiter:
+        return concurrency.AdaptiveLimiter('test', clock=self.clock, **kwargs)
+
+    def run_calls(self, limiter, count, latency):
+        """Runs 'count' operations that each take 'latency' seconds, saturating the limiter."""
+
+        for _ in range(count):
+            starts = [self.loop.run_until_complete(limiter.acquire())
+                      for _ in range(limiter.limit)]
+            self.clock.now += latency
+            for start in starts:
+                limiter.release(start)
+
+    def test_grows_while_latency_flat(self):
+        limiter = self.limiter(initial_limit=2, max_limit=8)
+        self.run_calls(limiter, 30, 0.1)
+        self.assertEqual(8, limiter.limit)
+
+    def test_backs_off_on_latency_spike(self):
+        limiter = self.limiter(initial_limit=8, max_limit=8, backoff=0.5)
+        self.run_calls(limiter, 3, 0.1)
+        self.assertEqual(8, limiter.limit)
+
+        self.run_calls(limiter, 1, 1.0)
+        self.assertEqual(4, limiter.limit)
+
+    def test_mixed_latencies(self):
+        limiter = self.limiter(initial_limit=4, max_limit=4, backoff=0.5)
+
+        # Single samples vary a lot, but the smoothed latency stays within tolerance.
+        for latency in [0.05, 0.12] * 20:
+            self.run_calls(limiter, 1, latency)
+        self.assertEqual(4, limiter.limit)
+
+        # A lasting slowdown is still noticed.
+        self.run_calls(limiter, 1, 0.5)
+        self.assertEqual(2, limiter.limit)
+
+    def test_skip_latency(self):
+        limiter = self.limiter(initial_limit=4, max_limit=4, backoff=0.5)
+
+        async def cache_hit():
+            async with limiter.slot() as slot:
+                self.clock.now += 0.001
+                slot.skip_latency()
+
+        for _ in range(10):
+            self.loop.run_until_complete(cache_hit())
+        self.run_calls(limiter, 3, 0.1)
+        self.assertEqual(4, limiter.limit)
+
+    def test_latency_up_to_response(self):
+        limiter = self.limiter(initial_limit=8, max_limit=8, backoff=0.5)
+        self.run_calls(limiter, 3, 0.1)
+
+        async def download():
+            async with limiter.slot() as slot:
+                self.clock.now += 0.1
+                slot.response_started()
+                # A long transfer after a quick response is no latency spike.
+                self.clock.now += 10.0
+                slot.response_started()
+
+        self.loop.run_until_complete(download())
+        self.assertEqual(8, limiter.limit)
+
+    def test_backs_off_on_overload(self):
+        limiter = self.limiter(initial_limit=8, max_limit=8, min_limit=2, backoff=0.5)
+
+        async def fail():
+            async with limiter.slot():
+                raise IOError('503 Service Unavailable')
+
+        for _ in range(5):
+            self.clock.now += 1
+            with self.assertRaises(IOError):
+                self.loop.run_until_complete(fail())
+        self.assertEqual(2, limiter.limit)
+
+    def test_ignored_errors_do_not_back_off(self):
+        limiter = self.limiter(initial_limit=4, is_overload=lambda ex: False)
+
+        async def fail():
+            async with limiter.slot():
+                raise KeyError('not found')
+
+        with self.assertRaises(KeyError):
+            self.loop.run_until_complete(fail())
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_queue_depth(self):
+        limiter = self.limiter(initial_limit=2, max_limit=2)
+        seen_depths = []
+
+        async def work():
+            async with limiter.slot():
+                await asyncio.sleep(0)
+                seen_depths.append((limiter.in_flight, limiter.queue_depth))
+
+        self.loop.run_until_complete(asyncio.gather(*[work() for _ in range(5)]))
+        self.assertEqual((2, 3), seen_depths[0])
+        self.assertTrue(all(in_flight <= 2 for in_flight, _ in seen_depths))
+        self.assertEqual(0, limiter.queue_depth)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_cancelled_waiter(self):
+        limiter = self.limiter(initial_limit=1)
+        start = self.loop.run_until_complete(limiter.acquire())
+
+        waiter = asyncio.ensure_future(limiter.acquire())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(1, limiter.queue_depth)
+
+        waiter.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(0, limiter.queue_depth)
+
+        limiter.release(start)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_priority_order(self):
+        limiter = self.limiter(initial_limit=1, max_limit=1)
+        Priority = concurrency.Priority
+        order = []
+
+        async def work(name, priority):
+            async with limiter.slot(priority):
+                order.append(name)
+
+        async def schedule():
+            start = await limiter.acquire()
+            tasks = [asyncio.ensure_future(work(name, prio)) for name, prio in [
+                ('background', Priority.BACKGROUND),
+                ('visible-1', Priority.VISIBLE),
+                ('interactive', Priority.INTERACTIVE),
+                ('visible-2', Priority.VISIBLE),
+            ]]
+            await asyncio.sleep(0)
+            self.assertEqual(2, limiter.queue_depth_for(Priority.VISIBLE))
+            limiter.release(start)
+            await asyncio.gather(*tasks)
+
+        self.loop.run_until_complete(schedule())
+        self.assertEqual(['interactive', 'visible-1', 'visible-2', 'background'], order)
+
+    def test_reserved_slots(self):
+        limiter = self.limiter(initial_limit=3, max_limit=3, reserved_slots=1)
+        Priority = concurrency.Priority
+
+        for _ in range(2):
+            self.loop.run_until_complete(limiter.acquire(Priority.BACKGROUND))
+        waiter = asyncio.ensure_future(limiter.acquire(Priority.PREFETCH))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(waiter.done())
+
+        # The reserved slot is still available for interactive work.
+        self.loop.run_until_complete(limiter.acquire(Priority.INTERACTIVE))
+        self.assertEqual(3, limiter.in_flight)
+        waiter.cancel()
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.single_flight = concurrency.SingleFlight('test')
+        self.executed = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def operation(self, key, result=None, exception=None):
+        async def coro():
+            self.executed.append(key)
+            await asyncio.sleep(0.01)
+            if exception is not None:
+                raise exception
+            return result
+
+        return self.single_flight.run(key, coro)
+
+    def test_coalesce_identical(self):
+        results = self.loop.run_until_complete(asyncio.gather(
+            self.operation('a', 1), self.operation('a', 2), self.operation('b', 3)))
+
+        self.assertEqual([1, 1, 3], results)
+        self.assertEqual(['a', 'b'], self.executed)
+        self.assertEqual(3, self.single_flight.calls)
+        self.assertEqual(1, self.single_flight.deduplicated)
+        self.assertEqual(0, self.single_flight.in_flight)
+
+        # After completion, the same key starts a new operation.
+        self.assertEqual(4, self.loop.run_until_complete(self.operation('a', 4)))
+
+    def test_shared_exception(self):
+        results = self.loop.run_until_complete(asyncio.gather(
+            self.operation('a', exception=KeyError('x')),
+            self.operation('a'),
+            return_exceptions=True))
+        self.assertEqual(['a'], self.executed)
+        self.assertTrue(all(isinstance(result, KeyError) for result in results))
+
+    def test_cancelled_caller_keeps_operation_running(self):
+        first = asyncio.ensure_future(self.operation('a', 'result'))
+        second = asyncio.ensure_future(self.operation('a', 'other'))
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        first.cancel()
+        self.assertEqual('result', self.loop.run_until_complete(second))
+        self.assertEqual(['a'], self.executed)
+
+    def test_copy_result(self):
+        self.single_flight = concurrency.SingleFlight('test', copy_result=dict)
+        first, second = self.loop.run_until_complete(asyncio.gather(
+            self.operation('a', {'name': 'node'}), self.operation('a')))
+
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(['a'], self.executed)
+
+
+class BatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.batches = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def batch_func(self, group, keys):
+        self.batches.append((group, sorted(keys)))
+        await asyncio.sleep(0)
+        if group == 'fail':
+            raise IOError('batch failed')
+        return {key: '%s-%s' % (group, key) for key in keys if key != 'missing'}
+
+    def test_batching_and_fan_out(self):
+        batcher = concurrency.Batcher('test', self.batch_func, window=0.01)
+        results = self.loop.run_until_complete(asyncio.gather(
+            batcher.load('a', 'g1'),
+            batcher.load('b', 'g1'),
+            batcher.load('a', 'g1'),
+            batcher.load('missing', 'g1'),
+            batcher.load('a', 'g2'),
+        ))
+
+        self.assertEqual(['g1-a', 'g1-b', 'g1-a', None, 'g2-a'], results)
+        self.assertEqual([('g1', ['a', 'b', 'missing']), ('g2', ['a'])],
+                         sorted(self.batches))
+        self.assertEqual(5, batcher.lookups)
+        self.assertEqual(2, batcher.batches)
+
+    def test_close(self):
+        batcher = concurrency.Batcher('test', self.batch_func, window=0.01)
+
+        async def slow_batch(group, keys):
+            await asyncio.sleep(10)
+
+        slow_batcher = concurrency.Batcher('slow', slow_batch, window=0.0)
+        waiting = asyncio.ensure_future(batcher.load('a', 'g1'))
+        running = asyncio.ensure_future(slow_batcher.load('b', 'g1'))
+        self.loop.run_until_complete(asyncio.sleep(0.005))
+        self.assertEqual(1, len(slow_batcher._tasks))
+
+        self.loop.run_until_complete(asyncio.gather(batcher.close(), slow_batcher.close()))
+        self.assertTrue(waiting.cancelled())
+        self.assertTrue(running.cancelled())
+        self.assertEqual(set(), slow_batcher._tasks)
+        self.assertEqual([], self.batches)
+
+    def test_max_batch_size(self):
+        batcher = concurrency.Batcher('test', self.batch_func, window=10, max_batch_size=3)
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[batcher.load(key) for key in 'abc']))
+        self.assertEqual(['None-a', 'None-b', 'None-c'], results)
+
+    def test_exception_fans_out(self):
+        batcher = concurrency.Batcher('test', self.batch_func, window=0.01)
+        results = self.loop.run_until_complete(asyncio.gather(
+            batcher.load('a', 'fail'), batcher.load('b', 'fail'), return_exceptions=True))
+        self.assertTrue(all(isinstance(result, IOError) for result in results))
+        self.assertEqual(1, len(self.batches))
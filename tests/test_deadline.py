@@ -0,0 +1,140 @@
+"""Unittests for blender_cloud.deadline."""
+
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from blender_cloud import deadline, metrics, resilience
+
+from fake_clock import FakeClock
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_phases_capped_by_total(self):
+        budget = deadline.Budget(connect=10.0, first_byte=30.0, idle=None, total=20.0)
+        dl = deadline.Deadline(budget, clock=self.clock)
+        self.assertEqual(10.0, dl.timeout('connect'))
+        self.assertEqual(20.0, dl.timeout('first_byte'))
+        self.assertEqual(20.0, dl.timeout('idle'))
+
+        self.clock.now += 15.0
+        self.assertEqual(5.0, dl.timeout('connect'))
+        self.assertEqual((5.0, 5.0), dl.requests_timeout())
+
+        self.clock.now += 5.0
+        self.assertTrue(dl.expired)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            dl.timeout('idle')
+
+    def test_unlimited(self):
+        dl = deadline.Deadline(deadline.Budget(None, None, None, None), clock=self.clock)
+        self.assertIsNone(dl.remaining())
+        self.assertIsNone(dl.timeout('idle'))
+        self.assertEqual(deadline.DEFAULT_REQUESTS_TIMEOUT, dl.requests_timeout())
+
+    def test_nesting(self):
+        outer_budget = deadline.Budget(connect=5.0, first_byte=None, idle=None, total=60.0)
+        with deadline.within(outer_budget, clock=self.clock) as outer:
+            self.clock.now += 50.0
+            with deadline.within(deadline.PILLAR_CALL) as inner:
+                self.assertIs(inner, deadline.current())
+                # The inner operation can't outlive the outer one.
+                self.assertEqual(10.0, inner.remaining())
+                self.assertEqual(5.0, inner.timeout('connect'))
+                self.assertEqual(deadline.PILLAR_CALL.idle, inner.phases['idle'])
+
+            with deadline.within(deadline.Budget(None, None, None, None)) as unlimited:
+                # Phases that aren't limited are inherited.
+                self.assertEqual(5.0, unlimited.phases['connect'])
+                self.assertEqual(10.0, unlimited.remaining())
+            self.assertIs(outer, deadline.current())
+        self.assertIsNone(deadline.current())
+        self.assertEqual(7.0, deadline.timeout('connect', 7.0))
+
+
+class WaitForTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_phase_timeout(self):
+        async def wait():
+            with deadline.within(deadline.Budget(None, None, idle=0.01, total=10.0)):
+                await deadline.wait_for(asyncio.sleep(1.0), 'idle')
+
+        with self.assertRaises(asyncio.TimeoutError) as cm:
+            self.loop.run_until_complete(wait())
+        self.assertNotIsInstance(cm.exception, deadline.DeadlineExceeded)
+
+    def test_total_exceeded(self):
+        async def wait():
+            with deadline.within(deadline.Budget(None, None, None, total=0.01)):
+                await deadline.wait_for(asyncio.sleep(1.0), 'idle', 30.0)
+
+        with self.assertRaises(deadline.DeadlineExceeded):
+            self.loop.run_until_complete(wait())
+
+    def test_inherited_by_tasks(self):
+        async def child():
+            return deadline.current()
+
+        async def parent():
+            with deadline.within(deadline.TEXTURE_FOLDER) as dl:
+                return dl, await asyncio.ensure_future(child())
+
+        outer, seen_by_child = self.loop.run_until_complete(parent())
+        self.assertIs(outer, seen_by_child)
+
+    def test_requests_timeout_in_thread(self):
+        seen = []
+
+        def in_thread():
+            seen.append((threading.current_thread(), deadline.requests_timeout()))
+
+        async def call():
+            with deadline.within(deadline.Budget(connect=3.0, first_byte=4.0, idle=5.0,
+                                                 total=None)):
+                func = deadline.call_with_requests_timeout(in_thread)
+            await self.loop.run_in_executor(None, func)
+
+        self.loop.run_until_complete(call())
+        self.assertIsNot(threading.current_thread(), seen[0][0])
+        self.assertEqual((3.0, 5.0), seen[0][1])
+        self.assertEqual(deadline.DEFAULT_REQUESTS_TIMEOUT, deadline.requests_timeout())
+
+    def test_no_retry_without_time(self):
+        calls = []
+
+        async def attempt():
+            calls.append(True)
+            raise ConnectionError('testing')
+
+        async def call():
+            with deadline.within(deadline.Budget(None, None, None, total=0.5)):
+                await resilience.call_with_retries(
+                    attempt,
+                    policy=resilience.RetryPolicy(base_delay=10.0, max_delay=10.0),
+                    breaker=resilience.CircuitBreaker('example.com'),
+                    is_transient=lambda ex: True)
+
+        with mock.patch('random.Random.uniform', return_value=5.0):
+            with self.assertRaises(ConnectionError):
+                self.loop.run_until_complete(call())
+        self.assertEqual(1, len(calls))
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        with self.assertRaises(asyncio.TimeoutError):
+            with registry.measure('download', 'example.com', '.png'):
+                raise asyncio.TimeoutError()
+        stats = registry.stats('download', 'example.com', '.png')
+        self.assertEqual((1, 1), (stats.errors, stats.timeouts))
+        self.assertIn('1 timeouts', stats.summary())
@@ -0,0 +1,255 @@
+"""Unittests for blender_cloud.http_transport."""
+
+import asyncio
+import http.server
+import socketserver
+import threading
+import unittest
+
+import requests
+
+from blender_cloud import http_transport
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connection_count += 1
+
+    def do_GET(self):
+        if self.path == '/fixed':
+            self._respond(b'0123456789' * 1000)
+        elif self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for part in (b'hello ', b'chunked ', b'world'):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+            self.wfile.write(b'0\r\n\r\n')
+        elif self.path == '/until-close':
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'read until EOF')
+            self.close_connection = True
+        elif self.path == '/not-modified':
+            self.send_response(304)
+            self.end_headers()
+        elif self.path == '/redirect-relative':
+            self._redirect(302, '/fixed')
+        elif self.path == '/redirect-absolute':
+            self._redirect(301, 'http://127.0.0.1:%i/redirect-relative'
+                           % self.server.server_port)
+        elif self.path == '/redirect-loop':
+            self._redirect(307, '/redirect-loop')
+        elif self.path == '/redirect-without-location':
+            self.send_response(302)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path == '/slow':
+            self.send_response(200)
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.write(b'x' * 10)
+            self.wfile.flush()
+            self.server.slow_event.wait(5)
+        else:
+            self._respond(b'not found', status=404)
+
+    def do_POST(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/redirect-post':
+            self._redirect(303, '/fixed')
+            return
+        self._respond(b'{"received": %i, "type": "%s"}'
+                      % (len(body), self.headers.get('Content-Type', '').encode()))
+
+    def _respond(self, body: bytes, status=200):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _redirect(self, status: int, location: str):
+        self.server.redirect_count += 1
+        body = b'<a href="%s">Moved</a>' % location.encode()
+        self.send_response(status)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class AbstractTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.connection_count = 0
+        self.server.redirect_count = 0
+        self.server.slow_event = threading.Event()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%i' % self.server.server_port
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = self.create_transport()
+
+    def create_transport(self):
+        return http_transport.AsyncioTransport()
+
+    def tearDown(self):
+        self.transport.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.slow_event.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get(self, path: str, **kwargs):
+        async def do_get():
+            with (await self.transport.request('GET', self.base_url + path, **kwargs)) as resp:
+                return resp.status_code, await resp.read()
+        return self.loop.run_until_complete(do_get())
+
+
+class AsyncioTransportTest(AbstractTransportTest):
+    def test_content_length_and_keep_alive(self):
+        for _ in range(3):
+            status, body = self.get('/fixed')
+            self.assertEqual(200, status)
+            self.assertEqual(b'0123456789' * 1000, body)
+        self.assertEqual(1, self.server.connection_count)
+        self.assertEqual(1, self.transport.connections_opened)
+
+    def test_chunked(self):
+        self.assertEqual((200, b'hello chunked world'), self.get('/chunked'))
+        self.assertEqual((200, b'0123456789' * 1000), self.get('/fixed'))
+        self.assertEqual(1, self.server.connection_count)
+
+    def test_read_until_close(self):
+        self.assertEqual((200, b'read until EOF'), self.get('/until-close'))
+        self.assertEqual((200, b'0123456789' * 1000), self.get('/fixed'))
+        self.assertEqual(2, self.server.connection_count)
+
+    def test_not_modified_and_errors(self):
+        self.assertEqual((304, b''), self.get('/not-modified'))
+
+        async def get_404():
+            with (await self.transport.request('GET', self.base_url + '/nope')) as resp:
+                resp.raise_for_status()
+        with self.assertRaises(http_transport.HTTPError) as ctx:
+            self.loop.run_until_complete(get_404())
+        self.assertEqual(404, ctx.exception.response.status_code)
+
+    def test_redirects(self):
+        self.assertEqual((200, b'0123456789' * 1000), self.get('/redirect-relative'))
+        self.assertEqual((200, b'0123456789' * 1000), self.get('/redirect-absolute'))
+        self.assertEqual(3, self.server.redirect_count)
+        # Redirect bodies are read, so the connection is reused.
+        self.assertEqual(1, self.server.connection_count)
+
+    def test_post_redirected_to_get(self):
+        async def post():
+            with (await self.transport.request('POST', self.base_url + '/redirect-post',
+                                               body=b'x' * 10)) as resp:
+                return resp.status_code, await resp.read()
+
+        self.assertEqual((200, b'0123456789' * 1000), self.loop.run_until_complete(post()))
+
+    def test_redirect_errors(self):
+        with self.assertRaises(http_transport.TransportError):
+            self.get('/redirect-loop')
+        self.assertEqual(http_transport.MAX_REDIRECTS + 1, self.server.redirect_count)
+
+        async def get_unfollowable():
+            with (await self.transport.request(
+                    'GET', self.base_url + '/redirect-without-location')) as resp:
+                resp.raise_for_status()
+        with self.assertRaises(http_transport.HTTPError) as ctx:
+            self.loop.run_until_complete(get_unfollowable())
+        self.assertEqual(302, ctx.exception.response.status_code)
+
+    def test_post(self):
+        async def post(body, headers=None):
+            with (await self.transport.request('POST', self.base_url + '/echo',
+                                               headers=headers, body=body)) as resp:
+                return await resp.json()
+
+        result = self.loop.run_until_complete(post(b'x' * 1234, {'Content-Type': 'a/b'}))
+        self.assertEqual({'received': 1234, 'type': 'a/b'}, result)
+
+        # Iterable body without length uses chunked transfer encoding.
+        result = self.loop.run_until_complete(post(iter([b'abc', b'', b'defg'])))
+        self.assertEqual(7, result['received'])
+
+    def test_cancel_closes_connection(self):
+        async def slow_read():
+            resp = await self.transport.request('GET', self.base_url + '/slow')
+            await resp.read()
+
+        task = asyncio.ensure_future(slow_read())
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(task)
+
+        # The half-read connection must not be reused.
+        self.server.slow_event.set()
+        self.assertEqual((200, b'0123456789' * 1000), self.get('/fixed'))
+        self.assertEqual(2, self.transport.connections_opened)
+
+    def test_connection_refused(self):
+        self.server.server_close()
+        transport = http_transport.AsyncioTransport()
+        url = 'http://127.0.0.1:%i/' % self.server.server_port
+        with self.assertRaises(http_transport.TransportError):
+            self.loop.run_until_complete(transport.request('GET', url))
+
+
+class RequestsTransportTest(AbstractTransportTest):
+    def create_transport(self):
+        self.session = requests.session()
+        return http_transport.RequestsTransport(self.session)
+
+    def tearDown(self):
+        super().tearDown()
+        self.session.close()
+
+    def test_get(self):
+        self.assertEqual((200, b'0123456789' * 1000), self.get('/fixed'))
+        self.assertEqual((200, b'hello chunked world'), self.get('/chunked'))
+
+    def test_read_chunks(self):
+        async def read_chunks():
+            with (await self.transport.request('GET', self.base_url + '/fixed')) as resp:
+                chunks = []
+                while True:
+                    chunk = await resp.read_chunk(4096)
+                    if not chunk:
+                        return chunks
+                    chunks.append(chunk)
+
+        chunks = self.loop.run_until_complete(read_chunks())
+        self.assertEqual(10000, sum(len(chunk) for chunk in chunks))
+        self.assertEqual(4096, len(chunks[0]))
@@ -0,0 +1,101 @@
+"""Unittests for blender_cloud.listing."""
+
+import json
+import unittest
+from unittest import mock
+
+import pillarsdk
+import pillarsdk.exceptions
+import requests
+
+from blender_cloud import listing
+
+TEXTURE_DOC = {
+    '_id': '5672beecc0261b2005ed1a33',
+    'name': 'Bricks',
+    'node_type': 'texture',
+    'picture': '5672beecc0261b2005ed1a34',
+    'project': '5672beecc0261b2005ed1a30',
+    'properties': {
+        'order': 3,
+        'files': [{'file': '5672beecc0261b2005ed1a35', 'map_type': 'color'},
+                  {'file': '5672beecc0261b2005ed1a36', 'map_type': 'normal'}],
+    },
+}
+
+
+class LoadsTest(unittest.TestCase):
+    def test_bytes_and_str(self):
+        document = {'_items': [TEXTURE_DOC], '_meta': {'total': 1}}
+        encoded = json.dumps(document)
+        self.assertEqual(document, listing.loads(encoded))
+        self.assertEqual(document, listing.loads(encoded.encode('utf-8')))
+
+    def test_parser_name(self):
+        self.assertIn(listing.JSON_PARSER, {'orjson', 'ujson', 'json'})
+
+
+class NodeRecordTest(unittest.TestCase):
+    def test_fields(self):
+        record = listing.NodeRecord(dict(TEXTURE_DOC))
+        self.assertEqual(TEXTURE_DOC['_id'], record['_id'])
+        self.assertEqual('Bricks', record['name'])
+        self.assertEqual('texture', record['node_type'])
+        self.assertEqual(3, record.order)
+        self.assertEqual(TEXTURE_DOC['picture'], record.picture)
+        self.assertEqual('5672beecc0261b2005ed1a35', record.first_file)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+        with self.assertRaises(KeyError):
+            record['properties']
+
+    def test_folder(self):
+        record = listing.NodeRecord({'_id': 'folder-id', 'name': 'Stone',
+                                     'node_type': 'group_texture'})
+        self.assertIsNone(record.order)
+        self.assertIsNone(record.picture)
+        self.assertIsNone(record.first_file)
+
+    def test_materialise(self):
+        record = listing.NodeRecord(json.loads(json.dumps(TEXTURE_DOC)))
+        self.assertFalse(record.is_materialised)
+
+        node = record.materialise()
+        self.assertIsInstance(node, pillarsdk.Node)
+        self.assertEqual('color', node.properties.files[0].map_type)
+        self.assertEqual(TEXTURE_DOC, node.to_dict())
+        self.assertIs(node, record.materialise())
+        self.assertTrue(record.is_materialised)
+
+
+class AllNodeRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.api = pillarsdk.Api(endpoint='https://cloud.example.com/api/',
+                                 username='user', password='PILLAR', token='token')
+        self.api.requests_session = mock.Mock(spec=requests.Session)
+
+    def respond(self, status_code: int, content: bytes):
+        response = mock.Mock(spec=requests.Response, status_code=status_code, content=content,
+                             text=content.decode('utf-8'))
+        self.api.requests_session.get.return_value = response
+
+    def test_page(self):
+        page = {'_items': [TEXTURE_DOC], '_meta': {'max_results': 25, 'total': 1}}
+        self.respond(200, json.dumps(page).encode('utf-8'))
+
+        params = {'where': {'parent': 'folder-id'}, 'projection': {'name': 1}}
+        self.assertEqual(page, listing.all_node_records(params, api=self.api))
+
+        url = self.api.requests_session.get.call_args[0][0]
+        self.assertTrue(url.startswith('https://cloud.example.com/api/nodes?'), url)
+        # Like pillarsdk.Node.all(), the node type and permissions are always projected.
+        self.assertEqual({'name': 1, 'project': 1, 'node_type': 1, 'permissions': 1},
+                         params['projection'])
+        kwargs = self.api.requests_session.get.call_args[1]
+        self.assertIn('Authorization', kwargs['headers'])
+        self.assertIn('timeout', kwargs)
+
+    def test_error(self):
+        self.respond(404, b'{"_error": {"code": 404}}')
+        with self.assertRaises(pillarsdk.exceptions.ResourceNotFound):
+            listing.all_node_records({}, api=self.api)
@@ -0,0 +1,147 @@
+"""Unittests for blender_cloud.metrics."""
+
+import asyncio
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+import pillarsdk
+
+from blender_cloud import concurrency, metrics
+
+from fake_clock import FakeClock
+
+
+class HistogramTest(unittest.TestCase):
+    def test_empty(self):
+        hist = metrics.Histogram()
+        self.assertEqual(0.0, hist.mean)
+        self.assertEqual(0.0, hist.percentile(0.5))
+
+    def test_percentiles(self):
+        hist = metrics.Histogram(bounds=(0.1, 1.0, 10.0))
+        for value in (0.05, 0.05, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 5.0):
+            hist.observe(value)
+
+        self.assertEqual([2, 7, 1, 0], hist.counts)
+        self.assertEqual(0.1, hist.percentile(0.2))
+        self.assertEqual(1.0, hist.percentile(0.5))
+        # Never larger than the largest observed value.
+        self.assertEqual(5.0, hist.percentile(0.99))
+        self.assertAlmostEqual(0.86, hist.mean)
+
+    def test_overflow(self):
+        hist = metrics.Histogram(bounds=(0.1,))
+        hist.observe(3.0)
+        self.assertEqual([0, 1], hist.counts)
+        self.assertEqual(3.0, hist.percentile(0.5))
+        self.assertEqual([[0.1, 0], [None, 1]], hist.to_dict()['buckets'])
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.registry = metrics.Registry(clock=self.clock)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_measure(self):
+        with self.registry.measure('pillar', 'find', 'Node'):
+            self.clock.now += 0.25
+
+        with self.assertRaises(ValueError):
+            with self.registry.measure('pillar', 'find', 'Node'):
+                self.clock.now += 1.0
+                raise ValueError('testing')
+
+        with self.assertRaises(asyncio.CancelledError):
+            with self.registry.measure('pillar', 'find', 'Node'):
+                raise asyncio.CancelledError()
+
+        stats = self.registry.stats('pillar', 'find', 'Node')
+        self.assertEqual(3, stats.calls)
+        self.assertEqual(1, stats.errors)
+        self.assertEqual(1, stats.cancelled)
+        self.assertEqual(1.0, stats.latency.max)
+        self.assertAlmostEqual(1.25, stats.latency.total)
+
+    def test_measure_slot(self):
+        limiter = concurrency.AdaptiveLimiter('test', initial_limit=1, min_limit=1)
+
+        async def operation(duration):
+            async with self.registry.measure_slot(limiter, concurrency.Priority.VISIBLE,
+                                                  'download', 'example.com', '.jpg'):
+                await asyncio.sleep(duration)
+
+        # Use the real clock, as the operations really wait for each other.
+        self.registry.clock = self.loop.time
+        self.loop.run_until_complete(asyncio.gather(operation(0.05), operation(0.0)))
+
+        stats = self.registry.stats('download', 'example.com', '.jpg')
+        self.assertEqual(2, stats.calls)
+        self.assertEqual(2, stats.slot_wait.count)
+        # The second operation waited for the first, which isn't counted as its latency.
+        self.assertGreaterEqual(stats.slot_wait.max, 0.04)
+        self.assertLess(stats.latency.percentile(0.5), 0.04)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_run_in_executor(self):
+        measurement = self.registry.measure('pillar', 'all', 'Node')
+        result = self.loop.run_until_complete(measurement.run_in_executor(lambda: 47))
+        self.assertEqual(47, result)
+        self.assertEqual(1, measurement.stats.executor_wait.count)
+
+    def test_snapshot_and_dump(self):
+        with self.registry.measure('pillar', 'find', 'Node'):
+            pass
+        with self.registry.measure('pillar', 'all', 'Project'):
+            pass
+        with self.registry.measure('pillar', 'all', 'Project'):
+            self.registry.stats('pillar', 'all', 'Project').bytes_received += 1024
+
+        snapshot = self.registry.snapshot()
+        self.assertEqual(['all', 'find'], [op['endpoint'] for op in snapshot['operations']])
+        self.assertEqual(2, snapshot['operations'][0]['calls'])
+        self.assertEqual(['pillar Project.all: 2 calls, p50 0 ms, p90 0 ms, 1.0 KiB',
+                          'pillar Node.find: 1 calls, p50 0 ms, p90 0 ms'],
+                         self.registry.summary_lines())
+
+        tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.addCleanup(shutil.rmtree, str(tmpdir))
+        path = tmpdir / 'sub' / 'metrics.json'
+        self.registry.dump(str(path))
+        with path.open() as infile:
+            self.assertEqual(snapshot['operations'], json.load(infile)['operations'])
+
+        # A bare filename is written to the current directory.
+        cwd = os.getcwd()
+        os.chdir(str(tmpdir))
+        self.addCleanup(os.chdir, cwd)
+        self.registry.dump('metrics.json')
+        self.assertTrue((tmpdir / 'metrics.json').exists())
+
+        self.registry.reset()
+        self.assertEqual([], self.registry.snapshot()['operations'])
+
+
+class GroupingTest(unittest.TestCase):
+    def test_resource_type(self):
+        self.assertEqual('Node', metrics.resource_type(pillarsdk.Node.all))
+        self.assertEqual('File', metrics.resource_type(pillarsdk.File({'_id': 'x'}).thumbnail))
+        self.assertEqual('blender_cloud.metrics', metrics.resource_type(metrics.resource_type))
+
+    def test_transfer_group(self):
+        self.assertEqual(('storage.example.com', '.jpg'),
+                         metrics.transfer_group('https://storage.example.com/a/b.JPG?sig=x'))
+        self.assertEqual(('cloud.example.com', '.blend'),
+                         metrics.transfer_group('https://cloud.example.com/storage/stream/p',
+                                                '/path/to/file.blend'))
+        self.assertEqual(('cloud.example.com', '-'),
+                         metrics.transfer_group('https://cloud.example.com/api/'))
@@ -0,0 +1,311 @@
+"""Tests of blender_cloud.pillar against the stand-in Pillar server."""
+
+import asyncio
+import hashlib
+import io
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pillarsdk
+
+from blender_cloud import bandwidth, concurrency, deadline, metrics, offline, pillar, resilience
+
+import load_pillar
+import mock_pillar
+
+
+class AbstractMockPillarTest(unittest.TestCase):
+    dataset_kwargs = {'projects': 2, 'folders': 2, 'textures': 3, 'file_size': 10000}
+    server_kwargs = {}
+
+    def setUp(self):
+        # Closed after the other cleanups, which may need the loop.
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+        self.server = mock_pillar.MockPillarServer(mock_pillar.Dataset(**self.dataset_kwargs),
+                                                   **self.server_kwargs)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.addCleanup(shutil.rmtree, str(self.tmpdir))
+
+        client = load_pillar.configure_client(self.server, self.tmpdir)
+        client.__enter__()
+        self.addCleanup(client.__exit__, None, None, None)
+
+        patcher = mock.patch('blender_cloud.pillar.retry_policy',
+                             resilience.RetryPolicy(base_delay=0.001, max_delay=0.001))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class PillarFunctionsTest(AbstractMockPillarTest):
+    def test_texture_projects(self):
+        projects = self.run_async(pillar.get_texture_projects())
+        self.assertEqual(['Textures 0', 'Textures 1'], [project['name'] for project in projects])
+
+    def test_nodes_of_folder(self):
+        project_id = self.server.dataset.texture_libraries[0]['_id']
+        folders = self.run_async(pillar.get_nodes(project_id, ''))
+        self.assertEqual(['Folder 0', 'Folder 1'], [folder['name'] for folder in folders])
+
+        textures = self.run_async(pillar.get_nodes(parent_node_uuid=folders[0]['_id'],
+                                                   node_type='texture'))
+        self.assertEqual(3, len(textures))
+        self.assertEqual(2, len(textures[0].properties.files))
+
+    def test_node_records(self):
+        project_id = self.server.dataset.texture_libraries[0]['_id']
+        folders = self.run_async(pillar.get_node_records(project_id, ''))
+        self.assertEqual(['Folder 0', 'Folder 1'], [folder['name'] for folder in folders])
+
+        records = self.run_async(pillar.get_node_records(parent_node_uuid=folders[0]['_id'],
+                                                         node_type='texture'))
+        nodes = self.run_async(pillar.get_nodes(parent_node_uuid=folders[0]['_id'],
+                                                node_type='texture'))
+        self.assertEqual([node['_id'] for node in nodes], [record['_id'] for record in records])
+        self.assertFalse(records[0].is_materialised)
+
+        node = records[0].materialise()
+        self.assertIsInstance(node, pillarsdk.Node)
+        self.assertEqual(nodes[0].to_dict(), node.to_dict())
+
+    def test_texture_thumbs(self):
+        folder = self.server.dataset.find('nodes', {'node_type': 'group_texture'})[0]
+        loaded = []
+        self.run_async(pillar.fetch_texture_thumbs(
+            folder['_id'], 's', str(self.tmpdir / 'thumbnails'),
+            thumbnail_loading=load_pillar._ignore,
+            thumbnail_loaded=lambda record, file_desc, path: loaded.append((record, path))))
+        self.assertEqual(3, len(loaded))
+        for record, thumb_path in loaded:
+            self.assertFalse(record.is_materialised)
+            self.assertTrue(pathlib.Path(thumb_path).exists())
+
+        # While offline, the thumbnails downloaded before are shown.
+        requests_before = self.server.total_requests
+        offline.connectivity.mark_offline('testing')
+        with mock.patch.object(offline.connectivity, 'probe_due', lambda: False):
+            offline_loaded = []
+            self.run_async(pillar.fetch_texture_thumbs(
+                folder['_id'], 's', str(self.tmpdir / 'thumbnails'),
+                thumbnail_loading=load_pillar._ignore,
+                thumbnail_loaded=lambda record, file_desc, path: offline_loaded.append(path)))
+        self.assertEqual(sorted(path for _, path in loaded), sorted(offline_loaded))
+        self.assertEqual(requests_before, self.server.total_requests)
+
+    def test_download_texture(self):
+        project_id = self.server.dataset.texture_libraries[0]['_id']
+        texture = self.run_async(pillar.get_nodes(project_id, node_type='texture'))[0]
+        target = self.tmpdir / 'textures'
+        results = self.run_async(pillar.download_texture(
+            texture, str(target), str(self.tmpdir / 'metadata'),
+            texture_loading=load_pillar._ignore, texture_loaded=load_pillar._ignore,
+            future=None))
+        self.assertEqual([None, None], results)
+
+        expected_md5s = {self.server.dataset.collections['files'][file_info['file']]['md5']
+                         for file_info in texture['properties']['files']}
+        downloaded_md5s = {hashlib.md5(path.read_bytes()).hexdigest()
+                           for path in target.iterdir()}
+        self.assertEqual(expected_md5s, downloaded_md5s)
+
+    def test_coalesced_calls(self):
+        async def get_projects(priority):
+            return await pillar.pillar_call(pillarsdk.Project.all_from_endpoint,
+                                            '/bcloud/texture-libraries', priority=priority)
+
+        first, second, background = self.run_async(asyncio.gather(
+            get_projects(pillar.Priority.VISIBLE), get_projects(pillar.Priority.VISIBLE),
+            get_projects(pillar.Priority.BACKGROUND)))
+
+        # Callers that joined get a copy, and other priorities aren't joined.
+        self.assertEqual(first.to_dict(), second.to_dict())
+        self.assertIsNot(first, second)
+        self.assertIsNot(first['_items'][0], second['_items'][0])
+        self.assertEqual(2, self.server.request_counts['GET /api/bcloud/texture-libraries'])
+
+    def test_find_or_create_node(self):
+        project_id = self.server.dataset.home_project['_id']
+        where = {'project': project_id, 'node_type': 'group', 'name': 'Uploads'}
+
+        node, created = self.run_async(pillar.find_or_create_node(where))
+        self.assertTrue(created)
+        self.assertIn(node['_id'], self.server.dataset.collections['nodes'])
+
+        found, created = self.run_async(pillar.find_or_create_node(where))
+        self.assertFalse(created)
+        self.assertEqual(node['_id'], found['_id'])
+
+    def test_attach_file_to_group(self):
+        project_id = self.server.dataset.home_project['_id']
+        group, _ = self.run_async(pillar.find_or_create_node(
+            {'project': project_id, 'node_type': 'group', 'name': 'Sync'}))
+        file_path = self.tmpdir / 'startup.blend'
+        file_path.write_bytes(b'startup file contents')
+        progress = []
+
+        node = self.run_async(pillar.attach_file_to_group(
+            file_path, project_id, group['_id'],
+            progress=lambda sent, size: progress.append((sent, size))))
+
+        file_id = node['properties']['file']
+        self.assertEqual(b'startup file contents', self.server.dataset.file_contents[file_id])
+        self.assertEqual(group['_id'], node['parent'])
+        self.assertEqual((21, 21), progress[-1])
+        self.assertEqual(1, self.server.request_counts['POST /storage/stream/<id>'])
+
+    def test_upload_metrics(self):
+        project_id = self.server.dataset.home_project['_id']
+        file_path = self.tmpdir / 'userpref.blend'
+        file_path.write_bytes(b'user preferences' * 1000)
+
+        self.run_async(pillar.attach_file_to_group(file_path, project_id, None))
+
+        stats = metrics.registry.stats('upload', '127.0.0.1', '.blend')
+        self.assertEqual(1, stats.calls)
+        self.assertEqual(0, stats.errors)
+        self.assertEqual(1, stats.latency.count)
+        # The multipart body is a bit larger than the file itself.
+        self.assertGreater(stats.bytes_sent, 16000)
+
+    def test_upload_throttled(self):
+        project_id = self.server.dataset.home_project['_id']
+        contents = b'packed image' * 10000
+
+        with mock.patch.object(bandwidth.interactive_bucket, 'reserve',
+                               return_value=0.0) as reserve:
+            node = self.run_async(pillar.upload_asset_file(
+                project_id, None, 'image', 'Render.png', fileobj=io.BytesIO(contents),
+                always_create_new_node=True))
+
+        file_id = node['properties']['file']
+        self.assertEqual(contents, self.server.dataset.file_contents[file_id])
+        self.assertGreater(sum(call[0][0] for call in reserve.call_args_list), len(contents))
+
+    def test_cache_hits_not_sampled(self):
+        class Response:
+            status_code = 200
+
+            def __init__(self, from_cache):
+                self.from_cache = from_cache
+
+        def cached_call(*, api):
+            return api.handle_response(Response(from_cache=True), '{}')
+
+        def network_call(*, api):
+            return api.handle_response(Response(from_cache=False), '{}')
+
+        limiter = concurrency.AdaptiveLimiter('test', initial_limit=3, min_limit=3)
+        with mock.patch('blender_cloud.pillar.pillar_limiter', limiter), \
+                mock.patch.object(limiter, 'release', wraps=limiter.release) as release:
+            self.run_async(pillar.pillar_call(cached_call))
+            self.run_async(pillar.pillar_call(network_call))
+
+        self.assertEqual([False, True], [call[1]['record_latency']
+                                         for call in release.call_args_list])
+
+
+class CredentialsTest(AbstractMockPillarTest):
+    def test_validation_cached(self):
+        for _ in range(3):
+            user = self.run_async(pillar.check_pillar_credentials({'subscriber'}))
+            self.assertEqual('mock-user', user['username'])
+        self.assertEqual(1, self.server.request_counts['GET /api/users/me'])
+
+    def test_not_subscribed(self):
+        with self.assertRaises(pillar.NotSubscribedToCloudError):
+            self.run_async(pillar.check_pillar_credentials({'demo'}))
+        self.assertEqual({}, pillar.blender_id_profile().subclients)
+
+        with self.assertRaises(pillar.CredentialsNotSyncedError):
+            self.run_async(pillar.check_pillar_credentials({'demo'}))
+
+
+class PagingTest(AbstractMockPillarTest):
+    dataset_kwargs = {'projects': 1, 'folders': 1, 'textures': 30}
+
+    def test_all_pages(self):
+        folder = self.server.dataset.find('nodes', {'node_type': 'group_texture'})[0]
+        textures = self.run_async(pillar.get_nodes(parent_node_uuid=folder['_id']))
+        self.assertEqual(30, len(textures))
+        # Eve returns 25 items per page by default.
+        self.assertEqual(2, self.server.request_counts['GET /api/nodes'])
+
+
+class ErrorInjectionTest(AbstractMockPillarTest):
+    server_kwargs = {'error_rate': 1.0}
+
+    def test_retried(self):
+        with self.assertRaises(pillarsdk.exceptions.ServerError):
+            self.run_async(pillar.get_texture_projects())
+        self.assertEqual(pillar.retry_policy.max_attempts,
+                         self.server.request_counts['GET /api/bcloud/texture-libraries'])
+        # An overloaded server is not lost connectivity.
+        self.assertFalse(offline.connectivity.is_offline)
+
+
+class DeadlineTest(AbstractMockPillarTest):
+    server_kwargs = {'latency': 0.5}
+
+    def run_within(self, budget: deadline.Budget, coro_func):
+        async def run():
+            with deadline.within(budget):
+                return await coro_func()
+        return self.run_async(run())
+
+    def test_pillar_call(self):
+        start = self.loop.time()
+        with self.assertRaises(deadline.DeadlineExceeded):
+            self.run_within(deadline.Budget(None, None, None, total=0.1),
+                            pillar.get_texture_projects)
+        self.assertLess(self.loop.time() - start, 0.4)
+
+        # The coalesced request isn't bound to the deadline of its first caller.
+        self.assertEqual(1, pillar.pillar_single_flight.in_flight)
+        while pillar.pillar_single_flight.in_flight:
+            self.run_async(asyncio.sleep(0.05))
+        stats = metrics.registry.stats('pillar', 'all_from_endpoint', 'Project')
+        self.assertEqual((1, 0), (stats.calls, stats.timeouts))
+
+    def test_download_first_byte(self):
+        file_doc = next(iter(self.server.dataset.collections['files'].values()))
+        link = self.server.render('files', file_doc)['link']
+        filename = str(self.tmpdir / 'texture.png')
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_within(deadline.Budget(None, first_byte=0.05, idle=None, total=None),
+                            lambda: pillar.download_to_file(link, filename,
+                                                            header_store=filename + '.headers'))
+
+        stats = metrics.registry.stats('download', *metrics.transfer_group(link))
+        self.assertEqual(pillar.retry_policy.max_attempts, stats.timeouts)
+
+
+class LoadHarnessTest(unittest.TestCase):
+    def test_run_load(self):
+        dataset = mock_pillar.Dataset(projects=1, folders=1, textures=4, file_size=4096)
+        with mock_pillar.MockPillarServer(dataset) as server:
+            report = load_pillar.run_load(server, 'browse', clients=2, iterations=2)
+
+        self.assertEqual(4, report['operations'], report['error_samples'])
+        self.assertEqual(0, report['errors'])
+        self.assertGreater(report['bytes_received'], 0)
+        self.assertLessEqual(report['latency']['p50'], report['latency']['p99'])
+        self.assertIn('GET /files/<id>', report['server_requests'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, load_pillar.percentile(values, 0.5))
+        self.assertEqual(99, load_pillar.percentile(values, 0.99))
+        self.assertEqual(1, load_pillar.percentile([1], 0.9))
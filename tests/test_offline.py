@@ -0,0 +1,193 @@
+"""Unittests for blender_cloud.offline."""
+
+import asyncio
+import errno
+import pathlib
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+import pillarsdk
+import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from blender_cloud import deadline, http_transport, offline, resilience
+
+
+def closed_port_url() -> str:
+    """Returns a URL on localhost that nothing listens on."""
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%i/' % sock.getsockname()[1]
+
+
+class SnapshotStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.store = offline.SnapshotStore(str(self.tmpdir))
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+    def test_save_load(self):
+        self.assertEqual((None, None), self.store.load('["File", "abc"]'))
+
+        self.store.save('["File", "abc"]', pillarsdk.File({'_id': 'abc', 'filename': 'x.png'}))
+        document, saved_at = self.store.load('["File", "abc"]')
+        self.assertEqual({'_id': 'abc', 'filename': 'x.png'}, document)
+        self.assertIsInstance(saved_at, float)
+
+    def test_save_later(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        store = offline.SnapshotStore(str(self.tmpdir), write_delay=0.01)
+
+        async def save():
+            store.save_later('first', {'page': 1})
+            store.save_later('second', {'page': 2})
+            # Served from memory until written.
+            self.assertEqual({'page': 1}, store.load('first')[0])
+            self.assertEqual([], list(self.tmpdir.iterdir()))
+            await asyncio.sleep(0.1)
+
+        loop.run_until_complete(save())
+        self.assertEqual({}, store._unwritten)
+        self.assertEqual({'page': 2}, offline.SnapshotStore(str(self.tmpdir)).load('second')[0])
+
+        store.save_later('third', {'page': 3})
+        loop.run_until_complete(store.flush())
+        self.assertEqual({'page': 3}, offline.SnapshotStore(str(self.tmpdir)).load('third')[0])
+        self.assertIsNone(store._flush_task)
+
+    def test_corrupt_snapshot(self):
+        self.store.save('key', 'value')
+        path = pathlib.Path(self.store._path('key'))
+        path.write_text('{"key": ')
+        self.assertEqual((None, None), self.store.load('key'))
+
+
+class ConnectivityTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connectivity = offline.Connectivity(probe_timeout=1.0, probe_interval=0.01)
+
+        self.server_sock = socket.socket()
+        self.server_sock.bind(('127.0.0.1', 0))
+        self.server_sock.listen(5)
+        self.online_url = 'http://127.0.0.1:%i/api/' % self.server_sock.getsockname()[1]
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def probe(self, url) -> bool:
+        return self.loop.run_until_complete(self.connectivity.probe(url))
+
+    def test_probe(self):
+        self.assertFalse(self.probe(closed_port_url()))
+        self.assertTrue(self.connectivity.is_offline)
+        self.assertIn('unable to connect', self.connectivity.reason)
+
+        came_online = []
+        self.connectivity.add_listener(lambda: came_online.append(True))
+        self.assertTrue(self.probe(self.online_url))
+        self.assertFalse(self.connectivity.is_offline)
+        self.assertEqual([True], came_online)
+
+    def test_stale_since(self):
+        self.connectivity.mark_offline('testing')
+        self.connectivity.served_snapshot(2000.0)
+        self.connectivity.served_snapshot(1000.0)
+        self.connectivity.served_snapshot(3000.0)
+        self.assertEqual(1000.0, self.connectivity.stale_since)
+        self.assertTrue(self.connectivity.status_text().startswith('Offline, showing data from'))
+
+        self.connectivity.mark_online()
+        self.assertIsNone(self.connectivity.stale_since)
+        self.assertEqual('', self.connectivity.status_text())
+
+    def test_is_connectivity_error(self):
+        self.assertTrue(offline.is_connectivity_error(offline.OfflineError()))
+        self.assertTrue(offline.is_connectivity_error(ConnectionRefusedError()))
+        self.assertTrue(offline.is_connectivity_error(socket.gaierror(-2, 'Name unknown')))
+        self.assertTrue(offline.is_connectivity_error(OSError(errno.ENETUNREACH, 'Unreachable')))
+        self.assertTrue(offline.is_connectivity_error(http_transport.ConnectError('refused')))
+
+        # Requests wraps the socket error a few levels deep.
+        wrapped = requests.exceptions.ConnectionError(
+            NewConnectionError(None, 'Failed to establish a new connection'))
+        self.assertTrue(offline.is_connectivity_error(wrapped))
+
+        # Slow or overloaded servers are not lost connectivity.
+        self.assertFalse(offline.is_connectivity_error(requests.exceptions.ConnectionError()))
+        self.assertFalse(offline.is_connectivity_error(requests.exceptions.ReadTimeout()))
+        self.assertFalse(offline.is_connectivity_error(asyncio.TimeoutError()))
+        self.assertFalse(offline.is_connectivity_error(resilience.CircuitOpenError('host', 5)))
+        response = requests.Response()
+        response.status_code = 503
+        self.assertFalse(offline.is_connectivity_error(requests.HTTPError(response=response)))
+        self.assertFalse(offline.is_connectivity_error(ValueError()))
+
+    def test_may_be_offline(self):
+        self.assertTrue(offline.may_be_offline(ConnectionRefusedError()))
+        self.assertTrue(offline.may_be_offline(requests.exceptions.ReadTimeout()))
+        self.assertTrue(offline.may_be_offline(asyncio.TimeoutError()))
+        self.assertFalse(offline.may_be_offline(deadline.DeadlineExceeded('too slow')))
+        self.assertFalse(offline.may_be_offline(ValueError()))
+
+    def test_download_queue(self):
+        queue = offline.DownloadQueue()
+        attempts = []
+
+        # The server is bound to a port, but refuses connections until it listens.
+        server_sock = socket.socket()
+        self.addCleanup(server_sock.close)
+        server_sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%i/' % server_sock.getsockname()[1]
+
+        async def download(name):
+            attempts.append(name)
+            if len(attempts) == 1:
+                raise offline.OfflineError('Blender Cloud is unreachable')
+
+        async def come_online():
+            await asyncio.sleep(0.05)
+            self.assertEqual([], attempts)
+            self.assertEqual(['texture 1', 'texture 2'], queue.descriptions())
+            server_sock.listen(5)
+
+        with mock.patch('blender_cloud.offline.connectivity', self.connectivity):
+            queue.add('node1', 'texture 1', lambda: download('node1'), probe_url=url)
+            task = queue.add('node2', 'texture 2', lambda: download('node2'), probe_url=url)
+            self.loop.run_until_complete(asyncio.gather(task, come_online()))
+
+        # The first attempt of node1 failed, so it was queued again.
+        self.assertEqual(['node1', 'node2', 'node1'], attempts)
+        self.assertEqual(0, len(queue))
+
+    def test_download_queue_cancel(self):
+        queue = offline.DownloadQueue()
+        attempts = []
+
+        async def download():
+            attempts.append('node1')
+
+        async def close_browser():
+            await asyncio.sleep(0.05)
+            queue.cancel()
+
+        with mock.patch('blender_cloud.offline.connectivity', self.connectivity):
+            task = queue.add('node1', 'texture 1', download, probe_url=closed_port_url())
+            self.loop.run_until_complete(close_browser())
+            self.loop.run_until_complete(asyncio.wait([task]))
+
+        self.assertTrue(task.cancelled())
+        self.assertEqual([], attempts)
+        self.assertEqual(0, len(queue))
@@ -0,0 +1,615 @@
+"""Unittests for blender_cloud.pillar."""
+
+import asyncio
+import datetime
+import errno
+import hashlib
+import http.server
+import io
+import json
+import pathlib
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pillarsdk
+import requests
+
+from blender_cloud import (bandwidth, concurrency, http_transport, metrics, offline, pillar,
+                           resilience, segmented_download, tracing, upload)
+
+RFC1123 = '%a, %d %b %Y %H:%M:%S GMT'
+
+
+def in_hours(hours: float) -> str:
+    moment = datetime.datetime.utcnow() + datetime.timedelta(hours=hours)
+    return moment.strftime(RFC1123)
+
+
+class FindFileDocCachedTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.calls = []
+
+        async def fake_pillar_call(pillar_func, file_uuid, *, params, priority):
+            self.calls.append(params['projection'])
+            return pillarsdk.File({
+                '_id': file_uuid,
+                'filename': 'texture.png',
+                'length': 1234,
+                'link': 'https://storage/%s?%i' % (file_uuid, len(self.calls)),
+                'link_expires': self.link_expires,
+            })
+
+        self.link_expires = in_hours(2)
+        patcher = mock.patch('blender_cloud.pillar.pillar_call', fake_pillar_call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def find(self, file_uuid='5672beecc0261b2005ed1a33'):
+        return self.loop.run_until_complete(pillar.find_file_doc_cached(
+            file_uuid, str(self.tmpdir), pillar.DOWNLOAD_FILE_PROJECTION))
+
+    def test_fetch_once(self):
+        first = self.find()
+        self.assertEqual('https://storage/5672beecc0261b2005ed1a33?1', first['link'])
+        self.assertTrue((self.tmpdir / 'files' / '5672beecc0261b2005ed1a33.json').exists())
+
+        second = self.find()
+        self.assertEqual(first['link'], second['link'])
+        self.assertEqual('texture.png', second['filename'])
+        self.assertEqual(1, len(self.calls))
+
+    def test_refresh_expired_link(self):
+        self.link_expires = in_hours(-1)
+        self.find()
+
+        self.link_expires = in_hours(2)
+        refreshed = self.find()
+        self.assertEqual('https://storage/5672beecc0261b2005ed1a33?2', refreshed['link'])
+        self.assertEqual({'link': 1, 'link_expires': 1}, self.calls[1])
+
+        # The refreshed link was stored.
+        with (self.tmpdir / 'files' / '5672beecc0261b2005ed1a33.json').open() as infile:
+            self.assertEqual(refreshed['link'], json.load(infile)['link'])
+        self.find()
+        self.assertEqual(2, len(self.calls))
+
+    def test_incomplete_cache(self):
+        files_dir = self.tmpdir / 'files'
+        files_dir.mkdir()
+        with (files_dir / 'abc.json').open('w') as outfile:
+            json.dump({'_id': 'abc', 'link': 'x', 'link_expires': in_hours(5)}, outfile)
+
+        self.assertEqual('texture.png', self.find('abc')['filename'])
+        self.assertEqual([pillar.DOWNLOAD_FILE_PROJECTION], self.calls)
+
+    def test_link_is_fresh(self):
+        now = datetime.datetime(2017, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        self.assertTrue(pillar.link_is_fresh(
+            {'link': 'x', 'link_expires': 'Sun, 01 Jan 2017 13:00:00 GMT'}, now=now))
+        self.assertFalse(pillar.link_is_fresh(
+            {'link': 'x', 'link_expires': 'Sun, 01 Jan 2017 12:05:00 GMT'}, now=now))
+        self.assertFalse(pillar.link_is_fresh({'link': 'x'}, now=now))
+        self.assertFalse(pillar.link_is_fresh(
+            {'link': 'x', 'link_expires': 'garbage'}, now=now))
+
+
+class PageIteratorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.requested_pages = []
+        self.items = ['node-%i' % idx for idx in range(25)]
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.addCleanup(shutil.rmtree, str(self.tmpdir))
+
+        async def fake_pillar_call(pillar_func, *args, params, priority):
+            page_nr = params['page']
+            self.requested_pages.append(page_nr)
+            await asyncio.sleep(0)
+            per_page = params.get('max_results', 10)
+            start = (page_nr - 1) * per_page
+            return {
+                '_items': self.items[start:start + per_page],
+                '_meta': {'page': page_nr, 'max_results': per_page, 'total': len(self.items)},
+            }
+
+        for patcher in (
+                mock.patch('blender_cloud.pillar.pillar_call', fake_pillar_call),
+                mock.patch('blender_cloud.pillar._snapshot_store',
+                           offline.SnapshotStore(str(self.tmpdir))),
+                mock.patch('blender_cloud.offline.connectivity', offline.Connectivity())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(pillar.snapshot_store().flush())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_all_pages_with_prefetch(self):
+        pages = pillar.PageIterator(pillarsdk.Node.all, params={})
+        seen = []
+
+        async def consume():
+            async for items in pages:
+                # The next page is already requested while we handle this one.
+                seen.append((list(items), list(self.requested_pages)))
+
+        self.loop.run_until_complete(consume())
+        self.assertEqual(self.items, [item for items, _ in seen for item in items])
+        self.assertEqual([[1], [1, 2], [1, 2, 3]], [requested for _, requested in seen])
+        self.assertEqual(3, pages.page_count)
+
+    def test_max_items(self):
+        nodes = self.loop.run_until_complete(pillar.get_nodes(parent_node_uuid='abc',
+                                                              max_results=8))
+        self.assertEqual(self.items[:8], nodes)
+        self.assertEqual([1], self.requested_pages)
+
+        self.requested_pages.clear()
+        nodes = self.loop.run_until_complete(pillar.get_nodes(parent_node_uuid='abc'))
+        self.assertEqual(self.items, nodes)
+        self.assertEqual([1, 2, 3], self.requested_pages)
+
+    def test_close_cancels_prefetch(self):
+        pages = pillar.PageIterator(pillarsdk.Node.all, params={})
+
+        async def consume_first():
+            async for items in pages:
+                pages.close()
+                return items
+
+        self.assertEqual(self.items[:10], self.loop.run_until_complete(consume_first()))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        # Page 2 was cancelled before it could even be requested.
+        self.assertEqual([1], self.requested_pages)
+        self.assertEqual(1, pages.page_count)
+
+    def test_offline_snapshot(self):
+        self.items = [{'_id': 'node-%i' % idx, 'name': 'Node %i' % idx} for idx in range(25)]
+        online = self.loop.run_until_complete(pillar.get_nodes(parent_node_uuid='abc'))
+
+        async def unreachable(*args, **kwargs):
+            raise requests.exceptions.ConnectionError(
+                OSError(errno.ENETUNREACH, 'Network is unreachable'))
+
+        self.requested_pages.clear()
+        with mock.patch('blender_cloud.pillar.pillar_call', unreachable):
+            nodes = self.loop.run_until_complete(pillar.get_nodes(parent_node_uuid='abc'))
+        self.assertEqual([node['_id'] for node in online], [node['_id'] for node in nodes])
+        self.assertIsInstance(nodes[0], pillarsdk.Node)
+        self.assertTrue(offline.connectivity.is_offline)
+        self.assertIsNotNone(offline.connectivity.stale_since)
+
+        # While offline, snapshots are served without calling Pillar at all.
+        nodes = self.loop.run_until_complete(pillar.get_nodes(parent_node_uuid='abc'))
+        self.assertEqual(25, len(nodes))
+        self.assertEqual([], self.requested_pages)
+
+        # Something that was never fetched can't be served.
+        with self.assertRaises(offline.OfflineError):
+            self.loop.run_until_complete(pillar.get_nodes(parent_node_uuid='def'))
+
+
+
+class UploadAssetFileTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.file_path = self.tmpdir / 'startup.blend'
+        self.file_path.write_bytes(b'startup file contents')
+        self.md5 = hashlib.md5(b'startup file contents').hexdigest()
+
+        self.calls = []
+        self.files_on_server = []
+        self.uploaded_files = []
+
+        async def fake_pillar_call(pillar_func, *args, **kwargs):
+            self.calls.append(pillar_func.__name__)
+            if pillar_func == pillarsdk.File.all:
+                return {'_items': self.files_on_server}
+            return pillarsdk.Node({'_id': 'node-id', 'properties': {'file': 'uploaded-id'}})
+
+        async def fake_upload_file(project_id, file_path, **kwargs):
+            self.calls.append('upload_file')
+            self.uploaded_files.append((file_path.name, file_path.read_bytes()))
+            return 'uploaded-id'
+
+        for patcher in (
+                mock.patch('blender_cloud.pillar.pillar_call', fake_pillar_call),
+                mock.patch('blender_cloud.pillar.upload_file', fake_upload_file),
+                mock.patch('blender_cloud.pillar._upload_index',
+                           upload.UploadIndex(str(self.tmpdir / 'index.json')))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def upload(self):
+        return self.loop.run_until_complete(pillar.upload_asset_file(
+            'project-id', 'group-id', 'file', str(self.file_path)))
+
+    def test_upload_once(self):
+        self.upload()
+        self.assertEqual(['all', 'upload_file', '_asset_node_for_file'], self.calls)
+        self.assertEqual('uploaded-id', pillar.upload_index().get('project-id', self.md5))
+
+        # The second time the index is used, without asking Pillar.
+        self.upload()
+        self.assertEqual(['all', 'upload_file', '_asset_node_for_file', '_asset_node_for_file'],
+                         self.calls)
+
+    def test_upload_fileobj(self):
+        fileobj = io.BytesIO(b'packed image contents')
+        node = self.loop.run_until_complete(pillar.upload_asset_file(
+            'project-id', 'group-id', 'image', 'Render.png', fileobj=fileobj))
+
+        self.assertEqual('node-id', node['_id'])
+        self.assertEqual(['all', 'upload_file', '_asset_node_for_file'], self.calls)
+        self.assertEqual([('Render.png', b'packed image contents')], self.uploaded_files)
+        self.assertEqual(0, fileobj.tell())
+
+    def test_reuse_file_on_server(self):
+        self.files_on_server = [{'_id': 'existing-id'}]
+        self.upload()
+        self.assertEqual(['all', '_asset_node_for_file'], self.calls)
+        self.assertEqual('existing-id', pillar.upload_index().get('project-id', self.md5))
+
+class DownloadHandler(http.server.BaseHTTPRequestHandler):
+    """Serves self.server.content with Range/If-Range support.
+
+    When self.server.fail_after is set, the first response is cut off after
+    that many bytes by closing the connection.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        content = server.content
+        server.requests.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            return
+
+        start, end = 0, len(content) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        is_range = match and self.headers.get('If-Range') == server.etag
+        if is_range:
+            start = int(match.group(1))
+            if match.group(2):
+                end = int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('ETag', server.etag)
+        if server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        body = content[start:end + 1]
+        if server.fail_after:
+            body = body[:server.fail_after]
+            server.fail_after = None
+            self.close_connection = True
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client is allowed to hang up on us.
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class DownloadToFileTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DownloadServer(('127.0.0.1', 0), DownloadHandler)
+        self.server.content = bytes(range(256)) * 1024
+        self.server.etag = '"v1"'
+        self.server.fail_after = None
+        self.server.accept_ranges = False
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i/texture.png' % self.server.server_port
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.filename = str(self.tmpdir / 'texture.png')
+        self.header_store = str(self.tmpdir / 'texture.png.headers')
+
+        for patcher in (
+                mock.patch('blender_cloud.pillar._transport', http_transport.AsyncioTransport()),
+                mock.patch('blender_cloud.pillar.retry_policy',
+                           resilience.RetryPolicy(base_delay=0.001, max_delay=0.001)),
+                mock.patch('blender_cloud.pillar._background_revalidations', {}),
+                mock.patch('blender_cloud.pillar.download_limiter',
+                           concurrency.AdaptiveLimiter('test-download', initial_limit=4)),
+                mock.patch('blender_cloud.resilience._breakers', {}),
+                mock.patch('blender_cloud.offline.connectivity', offline.Connectivity())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        pillar._transport.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(str(self.tmpdir))
+
+    def download(self, **kwargs):
+        self.loop.run_until_complete(pillar.download_to_file(
+            self.url, self.filename, header_store=self.header_store, **kwargs))
+
+    def assertDownloaded(self):
+        with open(self.filename, 'rb') as infile:
+            self.assertEqual(self.server.content, infile.read())
+        self.assertFalse(pathlib.Path(self.filename + '.part').exists())
+        self.assertFalse(pathlib.Path(self.filename + '.part.json').exists())
+
+        with open(self.header_store) as infile:
+            stored = json.load(infile)
+        self.assertEqual(str(len(self.server.content)), stored['Content-Length'])
+
+    def test_resume_after_connection_drop(self):
+        self.server.fail_after = 100000
+        self.download()
+        self.assertDownloaded()
+
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual('bytes=100000-', self.server.requests[1]['Range'])
+        self.assertEqual('"v1"', self.server.requests[1]['If-Range'])
+
+    def test_resume_across_sessions(self):
+        part_path = pathlib.Path(self.filename + '.part')
+        part_path.write_bytes(self.server.content[:5000])
+        (self.tmpdir / 'texture.png.part.json').write_text(
+            json.dumps({'validator': '"v1"', 'length': len(self.server.content)}))
+
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual('bytes=5000-', self.server.requests[0]['Range'])
+
+    def test_changed_file_restarts(self):
+        part_path = pathlib.Path(self.filename + '.part')
+        part_path.write_bytes(b'old version of the file')
+        (self.tmpdir / 'texture.png.part.json').write_text(
+            json.dumps({'validator': '"v0"', 'length': len(self.server.content)}))
+
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_cancelled_download_keeps_part_file(self):
+        future = self.loop.create_future()
+
+        async def cancel_soon():
+            part_path = pathlib.Path(self.filename + '.part')
+            while not part_path.exists() or not part_path.stat().st_size:
+                await asyncio.sleep(0.001)
+            future.cancel()
+
+        self.server.content *= 50
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(asyncio.gather(
+                pillar.download_to_file(self.url, self.filename,
+                                        header_store=self.header_store, future=future),
+                cancel_soon()))
+        self.assertFalse(pathlib.Path(self.filename).exists())
+        self.assertTrue(pathlib.Path(self.filename + '.part.json').exists())
+
+    def test_segmented(self):
+        self.server.accept_ranges = True
+        self.server.content = bytes(range(256)) * 4000 + b'tail'
+
+        with mock.patch.multiple(segmented_download, THRESHOLD=100000, PIECE_SIZE=64000,
+                                 initial_segments=3):
+            self.download()
+            self.assertDownloaded()
+
+        ranges = sorted(req['Range'] for req in self.server.requests if 'Range' in req)
+        self.assertIn('bytes=64000-127999', ranges)
+        self.assertIn('bytes=1024000-1024003', ranges)
+        self.assertEqual(16, len(ranges))  # the first piece comes from the plain GET.
+        self.assertTrue(all(req.get('If-Range') == '"v1"'
+                            for req in self.server.requests if 'Range' in req))
+
+    def test_segmented_changed_file(self):
+        self.server.accept_ranges = True
+        self.server.content = bytes(range(256)) * 1000
+
+        # The ETag changes after the first request; range requests are then answered
+        # with the entire new file, which should restart the download.
+        original_handle = DownloadHandler.do_GET
+
+        def changing_etag(handler):
+            original_handle(handler)
+            handler.server.etag = '"v2"'
+
+        with mock.patch.multiple(segmented_download, THRESHOLD=100000, PIECE_SIZE=64000), \
+                mock.patch.object(DownloadHandler, 'do_GET', changing_etag):
+            self.download()
+        self.assertDownloaded()
+
+    def test_md5_verified(self):
+        md5 = hashlib.md5(self.server.content).hexdigest()
+        self.download(expected_md5=md5)
+        self.assertDownloaded()
+
+        with open(self.header_store) as infile:
+            self.assertEqual(md5, json.load(infile)['Verified-MD5'])
+
+    def test_md5_mismatch(self):
+        with self.assertRaises(pillar.ChecksumMismatch):
+            self.download(expected_md5=hashlib.md5(b'other file').hexdigest())
+        self.assertFalse(pathlib.Path(self.filename).exists())
+        self.assertFalse(pathlib.Path(self.filename + '.part').exists())
+        # Restarted once; a mismatch says nothing about the server's health.
+        self.assertEqual(2, len(self.server.requests))
+        breaker = resilience.breaker_for_url(self.url)
+        self.assertEqual(0, breaker.failure_count)
+
+    def test_md5_of_resumed_download(self):
+        self.server.fail_after = 100000
+        self.download(expected_md5=hashlib.md5(self.server.content).hexdigest())
+        self.assertDownloaded()
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_md5_of_segmented_download(self):
+        self.server.accept_ranges = True
+        self.server.content = bytes(range(256)) * 4000 + b'tail'
+
+        with mock.patch.multiple(segmented_download, THRESHOLD=100000, PIECE_SIZE=64000):
+            self.download(expected_md5=hashlib.md5(self.server.content).hexdigest())
+        self.assertDownloaded()
+
+    def test_corrupted_cache_is_replaced(self):
+        md5 = hashlib.md5(self.server.content).hexdigest()
+        self.download(expected_md5=md5)
+
+        # A verified cache file is trusted without reading it.
+        with mock.patch('blender_cloud.pillar._hash_file') as mock_hash:
+            self.download(expected_md5=md5)
+        mock_hash.assert_not_called()
+
+        # Corrupt the file without changing its size.
+        with open(self.filename, 'r+b') as outfile:
+            outfile.write(b'garbage')
+        del self.server.requests[:]
+
+        self.download(expected_md5=md5)
+        self.assertDownloaded()
+        self.assertEqual(1, len(self.server.requests))
+        self.assertNotIn('If-None-Match', self.server.requests[0])
+
+    def test_fresh_cache_skips_request(self):
+        self.download()
+        self.download()
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_stale_cache_revalidated(self):
+        self.download()
+        with mock.patch('blender_cloud.pillar.freshness_ttl', 0):
+            self.download()
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual('"v1"', self.server.requests[1]['If-None-Match'])
+
+        # The 304 made the file fresh again.
+        self.download()
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_server_cache_lifetime(self):
+        self.assertEqual(60, pillar._cache_lifetime({'Cache-Control': 'public, max-age=60'}))
+        self.assertEqual(0, pillar._cache_lifetime({'Cache-Control': 'no-cache'}))
+        self.assertEqual(3600, pillar._cache_lifetime({
+            'Date': 'Mon, 02 Jan 2017 10:00:00 GMT',
+            'Expires': 'Mon, 02 Jan 2017 11:00:00 GMT'}))
+        self.assertIsNone(pillar._cache_lifetime({}))
+
+        self.assertTrue(pillar._is_fresh({'Validated-At': time.time() - 30, 'Max-Age': None}))
+        self.assertFalse(pillar._is_fresh({'Validated-At': time.time() - 30, 'Max-Age': 10}))
+
+    def test_revalidate_in_background(self):
+        self.download()
+        with mock.patch('blender_cloud.pillar.freshness_ttl', 0):
+            # The stale file is used without waiting for anything.
+            coro = pillar.download_to_file(self.url, self.filename,
+                                           header_store=self.header_store,
+                                           revalidate_in_background=True)
+            with self.assertRaises(StopIteration):
+                coro.send(None)
+
+            task = pillar._background_revalidations[self.filename]
+            self.loop.run_until_complete(task)
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual({}, pillar._background_revalidations)
+
+    def test_bandwidth_accounting(self):
+        meter = bandwidth.ThroughputMeter('test-download')
+        consumed = []
+
+        async def consume(amount):
+            consumed.append(amount)
+
+        with mock.patch('blender_cloud.bandwidth.download_meter', meter), \
+                mock.patch.object(bandwidth.background_bucket, 'consume', consume):
+            self.download(priority=concurrency.Priority.BACKGROUND)
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.content), meter.total)
+        self.assertEqual(len(self.server.content), sum(consumed))
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        with mock.patch('blender_cloud.metrics.registry', registry):
+            self.download()
+            self.download(priority=concurrency.Priority.BACKGROUND)
+
+        stats = registry.stats('download', '127.0.0.1', '.png')
+        # The second download was fresh in the cache, so didn't perform a request.
+        self.assertEqual(1, stats.calls)
+        self.assertEqual(0, stats.errors)
+        self.assertEqual(1, stats.slot_wait.count)
+        self.assertEqual(len(self.server.content), stats.bytes_received)
+
+    def test_tracing(self):
+        tracer = tracing.Tracer(enabled=True)
+        with mock.patch('blender_cloud.tracing.tracer', tracer):
+            self.download()
+
+        download_span, = [span for span in tracer.spans() if span.name == 'download_to_file']
+        get_span, = [span for span in tracer.spans() if span.name == 'GET']
+        self.assertEqual(self.url, download_span.args['url'])
+        self.assertEqual(download_span.span_id, get_span.parent_id)
+        self.assertEqual(200, get_span.args['status'])
+
+    def test_offline_uses_cached_file(self):
+        self.download()
+        offline.connectivity.mark_offline('testing')
+        with mock.patch('blender_cloud.pillar.freshness_ttl', 0):
+            self.download()
+        self.assertEqual(1, len(self.server.requests))
+
+        # Files that aren't cached can't be downloaded while offline.
+        with self.assertRaises(offline.OfflineError):
+            self.loop.run_until_complete(pillar.download_to_file(
+                self.url, str(self.tmpdir / 'other.png'),
+                header_store=str(self.tmpdir / 'other.png.headers')))
+
+    def test_unreachable_uses_stale_file(self):
+        self.download()
+        with mock.patch('blender_cloud.pillar.freshness_ttl', 0):
+            self.loop.run_until_complete(pillar.download_to_file(
+                'http://127.0.0.1:1/texture.png', self.filename, header_store=self.header_store))
+        self.assertDownloaded()
@@ -0,0 +1,170 @@
+"""Unittests for blender_cloud.remote_file."""
+
+import http.server
+import os
+import re
+import threading
+import unittest
+
+import requests
+
+from blender_cloud import blendfile, remote_file
+
+import blendfile_generator
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves self.server.content, with support for single-range GET requests."""
+
+    def do_GET(self):
+        content = self.server.content
+        self.server.request_count += 1
+
+        range_header = self.headers.get('Range')
+        if not range_header or not self.server.support_ranges:
+            self._respond(200, content)
+            return
+
+        match = re.match(r'bytes=(\d+)-(\d*)', range_header)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(content) - 1
+        end = min(end, len(content) - 1)
+        if start >= len(content):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%i' % len(content))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self._respond(206, content[start:end + 1],
+                      {'Content-Range': 'bytes %i-%i/%i' % (start, end, len(content))})
+
+    def _respond(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"test-etag"')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AbstractRangeServerTest(unittest.TestCase):
+    support_ranges = True
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.content = b''
+        self.server.request_count = 0
+        self.server.support_ranges = self.support_ranges
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%i/file.blend' % self.server.server_port
+        self.session = requests.session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def reader(self, **kwargs) -> remote_file.HTTPRangeReader:
+        return remote_file.HTTPRangeReader(self.url, session=self.session, **kwargs)
+
+
+class HTTPRangeReaderTest(AbstractRangeServerTest):
+    def test_read_and_seek(self):
+        self.server.content = bytes(range(256)) * 40  # 10 KiB
+
+        with self.reader(block_size=1024) as reader:
+            self.assertEqual(len(self.server.content), reader.size)
+            self.assertEqual(self.server.content[:10], reader.read(10))
+
+            reader.seek(1020)
+            self.assertEqual(self.server.content[1020:1030], reader.read(10))
+            self.assertEqual(1030, reader.tell())
+
+            reader.seek(-5, os.SEEK_END)
+            self.assertEqual(self.server.content[-5:], reader.read())
+            self.assertEqual(b'', reader.read(10))
+
+            reader.seek(0)
+            self.assertEqual(self.server.content, reader.read())
+
+    def test_block_cache(self):
+        self.server.content = b'x' * 8192
+
+        with self.reader(block_size=1024) as reader:
+            reader.read(100)
+            reader.seek(200)
+            reader.read(100)
+            self.assertEqual(1, reader.request_count)
+            self.assertEqual(1024, reader.bytes_fetched)
+
+            # Reading over a cached and an uncached block only fetches the latter.
+            reader.seek(1000)
+            reader.read(100)
+            self.assertEqual(2, reader.request_count)
+            self.assertEqual(2048, reader.bytes_fetched)
+
+    def test_lru_eviction(self):
+        self.server.content = b'y' * 4096
+
+        with self.reader(block_size=1024, max_cached_blocks=2) as reader:
+            for ofs in (0, 1024, 2048, 0):
+                reader.seek(ofs)
+                reader.read(1)
+            self.assertEqual(4, reader.request_count)
+
+    def test_read_larger_than_cache(self):
+        self.server.content = bytes(range(256)) * 400  # 100 KiB
+
+        with self.reader(block_size=1024, max_cached_blocks=2) as reader:
+            reader.seek(10)
+            self.assertEqual(self.server.content[10:50000], reader.read(49990))
+            # One request for the size and first block, one for the rest.
+            self.assertEqual(2, reader.request_count)
+
+            # Mixing cached and uncached blocks, where the cached ones get evicted.
+            reader.seek(48000)
+            self.assertEqual(self.server.content[48000:60000], reader.read(12000))
+
+    def test_blendfile_partial_read(self):
+        self.server.content = blendfile_generator.blend_bytes(object_count=4,
+                                                              verts_per_mesh=16 * 1024)
+        self.assertGreater(len(self.server.content), 1024 * 1024)
+
+        bfile = blendfile.open_blend(self.reader(block_size=4096))
+        with bfile:
+            objects = bfile.find_blocks_from_code(b'OB')
+            self.assertEqual(4, len(objects))
+            self.assertEqual(b'OBObject.003', objects[3][b'id', b'name'])
+            self.assertIs(objects[1], objects[0].get_pointer((b'id', b'next')))
+
+            reader = bfile.handle
+            self.assertLess(reader.bytes_fetched, len(self.server.content) / 10)
+
+
+class NoRangeSupportTest(AbstractRangeServerTest):
+    support_ranges = False
+
+    def test_fallback_to_entire_file(self):
+        self.server.content = b'abcdefghij' * 1000
+
+        with self.reader(block_size=1024) as reader:
+            reader.seek(5000)
+            self.assertEqual(b'abcde', reader.read(5))
+            reader.seek(10)
+            self.assertEqual(b'abcde', reader.read(5))
+            self.assertEqual(1, reader.request_count)
+
+    def test_entire_file_larger_than_cache(self):
+        self.server.content = bytes(range(256)) * 40
+
+        with self.reader(block_size=1024, max_cached_blocks=2) as reader:
+            reader.seek(100)
+            self.assertEqual(self.server.content[100:9000], reader.read(8900))
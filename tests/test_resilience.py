@@ -0,0 +1,147 @@
+"""Unittests for blender_cloud.resilience."""
+
+import asyncio
+import random
+import unittest
+
+from blender_cloud import resilience
+
+from fake_clock import FakeClock
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class TransientError(IOError):
+    def __init__(self, status_code=503, headers=None):
+        super().__init__('HTTP %i' % status_code)
+        self.response = FakeResponse(status_code, headers)
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_exponential_backoff_with_jitter(self):
+        policy = resilience.RetryPolicy(base_delay=1.0, max_delay=5.0, rng=random.Random(47))
+        for attempt, ceiling in [(0, 1.0), (1, 2.0), (2, 4.0), (3, 5.0), (10, 5.0)]:
+            delays = [policy.delay(attempt, TransientError()) for _ in range(50)]
+            self.assertTrue(all(0 <= delay <= ceiling for delay in delays), attempt)
+            self.assertGreater(max(delays), ceiling / 2, attempt)
+
+    def test_retry_after(self):
+        policy = resilience.RetryPolicy(max_retry_after=30)
+        self.assertEqual(7.0, policy.delay(0, TransientError(429, {'Retry-After': '7'})))
+        self.assertEqual(30, policy.delay(0, TransientError(429, {'Retry-After': '3600'})))
+
+        past = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        self.assertEqual(0.0, resilience.retry_after_seconds(
+            TransientError(503, {'Retry-After': past})))
+        self.assertIsNone(resilience.retry_after_seconds(
+            TransientError(503, {'Retry-After': 'tomorrow'})))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(0.0)
+        self.breaker = resilience.CircuitBreaker('cloud.blender.org', failure_threshold=3,
+                                                 reset_timeout=10, clock=self.clock)
+
+    def test_open_and_half_open(self):
+        for _ in range(3):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+        self.assertEqual(resilience.CircuitBreaker.OPEN, self.breaker.state)
+        self.assertRaises(resilience.CircuitOpenError, self.breaker.before_call)
+
+        # After the reset timeout, exactly one trial call is allowed.
+        self.clock.now = 11
+        self.breaker.before_call()
+        self.assertEqual(resilience.CircuitBreaker.HALF_OPEN, self.breaker.state)
+        self.assertRaises(resilience.CircuitOpenError, self.breaker.before_call)
+
+        # A failing trial call re-opens the circuit.
+        self.breaker.record_failure()
+        self.assertEqual(resilience.CircuitBreaker.OPEN, self.breaker.state)
+
+        self.clock.now = 22
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(resilience.CircuitBreaker.CLOSED, self.breaker.state)
+        self.breaker.before_call()
+
+    def test_success_resets_failure_count(self):
+        for _ in range(5):
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+            self.breaker.record_success()
+        self.assertEqual(resilience.CircuitBreaker.CLOSED, self.breaker.state)
+
+
+class CallWithRetriesTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.breaker = resilience.CircuitBreaker('cloud', failure_threshold=10)
+        self.policy = resilience.RetryPolicy(max_attempts=3, base_delay=0.001, max_delay=0.001)
+        self.calls = 0
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def call(self, errors, **kwargs):
+        errors = list(errors)
+
+        async def coro_func():
+            self.calls += 1
+            if errors:
+                raise errors.pop(0)
+            return 'result'
+
+        kwargs.setdefault('breaker', self.breaker)
+        return self.loop.run_until_complete(resilience.call_with_retries(
+            coro_func, policy=self.policy,
+            is_transient=lambda ex: isinstance(ex, TransientError), **kwargs))
+
+    def test_retries_transient_errors(self):
+        self.assertEqual('result', self.call([TransientError(), TransientError(502)]))
+        self.assertEqual(3, self.calls)
+        self.assertEqual(0, self.breaker.failure_count)
+
+    def test_gives_up_after_max_attempts(self):
+        with self.assertRaises(TransientError):
+            self.call([TransientError()] * 5)
+        self.assertEqual(3, self.calls)
+
+    def test_no_retry_on_other_errors(self):
+        with self.assertRaises(KeyError):
+            self.call([KeyError('404')])
+        self.assertEqual(1, self.calls)
+
+    def test_no_retry_when_not_idempotent(self):
+        with self.assertRaises(TransientError):
+            self.call([TransientError()], retry=False)
+        self.assertEqual(1, self.calls)
+
+    def test_restart_once(self):
+        self.assertEqual('result', self.call([KeyError('mismatch')],
+                                             is_restartable=lambda ex: isinstance(ex, KeyError)))
+        self.assertEqual(2, self.calls)
+
+        self.calls = 0
+        with self.assertRaises(KeyError):
+            self.call([KeyError('mismatch')] * 3,
+                      is_restartable=lambda ex: isinstance(ex, KeyError))
+        self.assertEqual(2, self.calls)
+        self.assertEqual(0, self.breaker.failure_count)
+
+    def test_fail_fast_when_open(self):
+        breaker = resilience.CircuitBreaker('cloud', failure_threshold=2)
+        with self.assertRaises(TransientError):
+            self.call([TransientError()] * 5, breaker=breaker)
+        self.assertEqual(2, self.calls)
+
+        with self.assertRaises(resilience.CircuitOpenError):
+            self.call([], breaker=breaker)
+        self.assertEqual(2, self.calls)
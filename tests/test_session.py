@@ -0,0 +1,102 @@
+"""Unittests for blender_cloud.session."""
+
+import asyncio
+import unittest
+
+from blender_cloud import session
+
+from fake_clock import FakeClock
+
+
+class SessionManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.clock = FakeClock()
+        self.manager = session.SessionManager(ttl=300.0, refresh_margin=60.0, clock=self.clock)
+        self.validations = []
+        self.cacheable = True
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def validate(self):
+        self.validations.append(self.clock.now)
+        await asyncio.sleep(0.001)
+        return {'nr': len(self.validations)}, self.cacheable
+
+    def user(self, credentials=('user', 'token')):
+        return self.loop.run_until_complete(
+            self.manager.validated_user(credentials, self.validate))
+
+    def test_cached_within_ttl(self):
+        self.assertEqual({'nr': 1}, self.user())
+        self.clock.now += 200.0
+        self.assertEqual({'nr': 1}, self.user())
+        self.assertEqual(1, len(self.validations))
+        self.assertEqual((1, 1), (self.manager.hits, self.manager.misses))
+
+        self.clock.now += 100.0
+        self.assertEqual({'nr': 2}, self.user())
+
+    def test_credentials_must_match(self):
+        self.user()
+        self.assertEqual({'nr': 2}, self.user(('user', 'new-token')))
+        self.assertIsNone(self.manager.cached_user(('user', 'token')))
+
+    def test_not_cacheable(self):
+        self.cacheable = False
+        self.user()
+        self.user()
+        self.assertEqual(2, len(self.validations))
+
+    def test_concurrent_validations_coalesced(self):
+        results = self.loop.run_until_complete(asyncio.gather(
+            *(self.manager.validated_user(('user', 'token'), self.validate) for _ in range(3))))
+        self.assertEqual([{'nr': 1}] * 3, results)
+        self.assertEqual(1, len(self.validations))
+
+    def test_error_drops_validation(self):
+        self.user()
+
+        async def failing_validate():
+            raise ValueError('token revoked')
+
+        # Renewing in the background fails; the cached user is still returned this time.
+        self.clock.now += 250.0
+        user = self.loop.run_until_complete(
+            self.manager.validated_user(('user', 'token'), failing_validate))
+        self.assertEqual({'nr': 1}, user)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertIsNone(self.manager.cached_user(('user', 'token')))
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(
+                self.manager.validated_user(('user', 'token'), failing_validate))
+
+    def test_renewed_before_expiry(self):
+        self.user()
+        self.clock.now += 250.0
+        # Served from the cache right away, while being renewed in the background.
+        self.assertEqual({'nr': 1}, self.user())
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual([100.0, 350.0], self.validations)
+
+        self.clock.now += 200.0
+        self.assertEqual({'nr': 2}, self.user())
+        self.assertEqual(2, len(self.validations))
+
+    def test_refresh_single_flight(self):
+        self.user()
+        refreshed = []
+
+        async def refresh():
+            refreshed.append(True)
+            await asyncio.sleep(0.001)
+
+        self.loop.run_until_complete(asyncio.gather(
+            *(self.manager.refresh(('user', 'token'), refresh) for _ in range(3))))
+        self.assertEqual(1, len(refreshed))
+        self.assertEqual(1, self.manager.refreshes)
+        self.assertIsNone(self.manager.cached_user(('user', 'token')))
@@ -0,0 +1,206 @@
+"""Unittests for blender_cloud.tracing."""
+
+import asyncio
+import json
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from blender_cloud import concurrency, tracing
+
+from fake_clock import FakeClock
+
+
+class AbstractTracingTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.tracer = tracing.Tracer(enabled=True)
+        patcher = mock.patch('blender_cloud.tracing.tracer', self.tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def spans_by_name(self) -> dict:
+        return {span.name: span for span in self.tracer.spans()}
+
+
+class SpanTest(AbstractTracingTest):
+    def test_nesting(self):
+        with tracing.span('outer', 'test', x=1) as outer:
+            self.assertIs(outer, tracing.current_span())
+            with tracing.span('inner') as inner:
+                inner.set(status=200)
+            self.assertIs(outer, tracing.current_span())
+        self.assertIs(tracing.NULL_SPAN, tracing.current_span())
+
+        self.assertEqual([inner, outer], self.tracer.spans())
+        self.assertEqual(outer.span_id, inner.parent_id)
+        self.assertEqual(outer.span_id, inner.trace_id)
+        self.assertIsNone(outer.parent_id)
+        self.assertEqual({'x': 1}, outer.args)
+        self.assertEqual({'status': 200}, inner.args)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            with tracing.span('failing'):
+                raise ValueError('testing')
+        with self.assertRaises(asyncio.CancelledError):
+            with tracing.span('cancelled'):
+                raise asyncio.CancelledError()
+
+        spans = self.spans_by_name()
+        self.assertEqual('ValueError: testing', spans['failing'].error)
+        self.assertEqual('cancelled', spans['cancelled'].error)
+
+    def test_disabled(self):
+        self.tracer.enabled = False
+        with tracing.span('ignored') as span:
+            self.assertIs(tracing.NULL_SPAN, span)
+            span.set(ignored=True)
+        self.assertEqual([], self.tracer.spans())
+
+        coro = asyncio.sleep(0)
+        self.assertIs(coro, tracing.traced(coro, 'ignored'))
+        self.loop.run_until_complete(coro)
+
+    def test_max_spans(self):
+        tracer = tracing.Tracer(enabled=True, max_spans=2)
+        for name in 'abc':
+            with tracer.span(name):
+                pass
+        self.assertEqual(['b', 'c'], [span.name for span in tracer.spans()])
+
+
+class PropagationTest(AbstractTracingTest):
+    def test_tasks_inherit_span(self):
+        async def child(name):
+            with tracing.span(name):
+                await asyncio.sleep(0)
+
+        async def parent():
+            with tracing.span('parent'):
+                await asyncio.gather(asyncio.ensure_future(child('child1')), child('child2'))
+
+        self.loop.run_until_complete(parent())
+        spans = self.spans_by_name()
+        self.assertEqual(spans['parent'].span_id, spans['child1'].parent_id)
+        self.assertEqual(spans['parent'].span_id, spans['child2'].parent_id)
+
+    def test_traced(self):
+        async def operator_task():
+            with tracing.span('pillar_call'):
+                pass
+            return 47
+
+        with tracing.span('invoke'):
+            coro = tracing.traced(operator_task(), 'async_execute', 'operator', operator='test')
+        task = asyncio.ensure_future(coro)
+        self.assertEqual(47, self.loop.run_until_complete(task))
+
+        spans = self.spans_by_name()
+        self.assertEqual(spans['invoke'].span_id, spans['async_execute'].parent_id)
+        self.assertEqual(spans['async_execute'].span_id, spans['pillar_call'].parent_id)
+        self.assertEqual({'operator': 'test'}, spans['async_execute'].args)
+
+    def test_coroutine_span(self):
+        @tracing.coroutine_span('test')
+        async def download(url):
+            tracing.current_span().set(url=url)
+            return url
+
+        self.assertEqual('u', self.loop.run_until_complete(download('u')))
+        span = self.tracer.spans()[0]
+        self.assertEqual(('download', 'test', {'url': 'u'}),
+                         (span.name, span.category, span.args))
+
+    def test_limiter_wait(self):
+        limiter = concurrency.AdaptiveLimiter('test', initial_limit=1, min_limit=1)
+
+        async def operation():
+            async with limiter.slot(concurrency.Priority.BACKGROUND):
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(asyncio.gather(operation(), operation()))
+        waits = [span for span in self.tracer.spans() if span.category == 'limiter']
+        # Only the operation that actually had to wait is traced.
+        self.assertEqual(1, len(waits))
+        self.assertEqual('wait for test slot', waits[0].name)
+        self.assertEqual({'priority': 'BACKGROUND'}, waits[0].args)
+
+    def test_task_local_fallback(self):
+        var = tracing._TaskLocal('test')
+        token = var.set('outside')
+        self.assertEqual('outside', var.get())
+
+        async def in_task(value):
+            self.assertIsNone(var.get())
+            token = var.set(value)
+            await asyncio.sleep(0)
+            self.assertEqual(value, var.get())
+            var.reset(token)
+            return var.get()
+
+        results = self.loop.run_until_complete(asyncio.gather(in_task('a'), in_task('b')))
+        self.assertEqual([None, None], results)
+        var.reset(token)
+        self.assertIsNone(var.get())
+
+
+class ChromeTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracer = tracing.Tracer(enabled=True, clock=self.clock)
+
+    def span(self, name, start, end, parent=None) -> tracing.Span:
+        self.clock.now = 100.0 + start
+        span = self.tracer.span(name, parent=parent)
+        with mock.patch('blender_cloud.tracing._current_span'):
+            span.__enter__()
+            self.clock.now = 100.0 + end
+            span.__exit__(None, None, None)
+        return span
+
+    def test_lanes(self):
+        # Two concurrent operations whose children overlap without nesting.
+        op1 = self.span('op1', 0.0, 3.0)
+        op2 = self.span('op2', 1.0, 4.0)
+        self.span('op1-child', 0.5, 2.5, parent=op1)
+        self.span('op2-child', 1.5, 3.5, parent=op2)
+
+        trace = self.tracer.chrome_trace()
+        events = {event['name']: event for event in trace['traceEvents'] if event['ph'] == 'X'}
+        self.assertEqual(events['op1']['tid'], events['op1-child']['tid'])
+        self.assertEqual(events['op2']['tid'], events['op2-child']['tid'])
+        self.assertNotEqual(events['op1']['tid'], events['op2']['tid'])
+
+        self.assertEqual(500000.0, events['op1-child']['ts'])
+        self.assertEqual(2000000.0, events['op1-child']['dur'])
+        self.assertEqual(op1.span_id, events['op1-child']['args']['parent_id'])
+
+        lane_names = [event for event in trace['traceEvents'] if event['name'] == 'thread_name']
+        self.assertEqual(2, len(lane_names))
+
+    def test_sequential_spans_share_lane(self):
+        self.span('first', 0.0, 1.0)
+        self.span('second', 1.0, 2.0)
+        events = [event for event in self.tracer.chrome_trace()['traceEvents']
+                  if event['ph'] == 'X']
+        self.assertEqual([0, 0], [event['tid'] for event in events])
+
+    def test_dump(self):
+        self.span('op', 0.0, 1.0)
+        tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.addCleanup(shutil.rmtree, str(tmpdir))
+
+        path = tmpdir / 'traces' / 'trace.json'
+        self.tracer.dump(str(path))
+        with path.open() as infile:
+            trace = json.load(infile)
+        self.assertEqual('op', trace['traceEvents'][0]['name'])
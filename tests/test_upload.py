@@ -0,0 +1,214 @@
+"""Unittests for blender_cloud.upload."""
+
+import asyncio
+import http.server
+import json
+import pathlib
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from blender_cloud import http_transport, resilience, upload
+
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for a server that supports multipart and resumable uploads."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        if self.path == '/stream':
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            server.received = body
+            self._respond(200, {'file_id': 'streamed'})
+        elif self.path == '/resumable':
+            server.expected_length = int(self.headers['X-Upload-Content-Length'])
+            self.send_response(200)
+            self.send_header('Location', '/session/1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self._respond(404, {})
+
+    def do_PUT(self):
+        server = self.server
+        server.requests.append(self.headers['Content-Range'])
+        length = int(self.headers.get('Content-Length', 0))
+
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+)', self.headers['Content-Range'])
+        if match:
+            start = int(match.group(1))
+            if start != len(server.received):
+                self._respond(400, {'error': 'unexpected offset'})
+                return
+            if server.drop_after is not None:
+                # Receive part of the chunk, and then drop the connection.
+                server.received += self.rfile.read(server.drop_after)
+                server.drop_after = None
+                self.close_connection = True
+                return
+            server.received += self.rfile.read(length)
+
+        if len(server.received) == server.expected_length:
+            self._respond(201, {'file_id': 'resumed'})
+            return
+
+        self.send_response(308)
+        if server.received:
+            self.send_header('Range', 'bytes=0-%i' % (len(server.received) - 1))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _respond(self, status: int, doc: dict):
+        body = json.dumps(doc).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UploadServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = UploadServer(('127.0.0.1', 0), UploadHandler)
+        self.server.received = b''
+        self.server.requests = []
+        self.server.drop_after = None
+        self.server.expected_length = None
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%i' % self.server.server_port
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = http_transport.AsyncioTransport()
+
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='bcloud-test-'))
+        self.file_path = self.tmpdir / 'startup.blend'
+        self.contents = bytes(range(256)) * 2000
+        self.file_path.write_bytes(self.contents)
+        self.progress = []
+
+    def tearDown(self):
+        self.transport.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(str(self.tmpdir))
+
+    def record_progress(self, sent, total):
+        self.progress.append((sent, total))
+
+    def post_multipart(self, **kwargs):
+        content_type, body = upload.multipart_file_body('file', self.file_path,
+                                                        block_size=100000, **kwargs)
+
+        async def post():
+            headers = {'Content-Type': content_type, 'Content-Length': str(len(body))}
+            with (await self.transport.request('POST', self.base_url + '/stream',
+                                               headers=headers, body=body)) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        return content_type, self.loop.run_until_complete(post())
+
+    def test_multipart_stream(self):
+        content_type, resp = self.post_multipart(progress=self.record_progress)
+        self.assertEqual({'file_id': 'streamed'}, resp)
+
+        boundary = content_type.split('boundary=', 1)[1].encode()
+        self.assertTrue(self.server.received.startswith(b'--' + boundary + b'\r\n'))
+        self.assertIn(b'filename="startup.blend"', self.server.received)
+        self.assertIn(b'\r\n\r\n' + self.contents + b'\r\n--' + boundary + b'--\r\n',
+                      self.server.received)
+
+        total = len(self.contents)
+        self.assertEqual([(100000, total), (200000, total), (300000, total),
+                          (400000, total), (500000, total), (total, total)], self.progress)
+
+    def test_multipart_mimetype(self):
+        self.post_multipart(mimetype='image/jpeg')
+        self.assertIn(b'Content-Type: image/jpeg\r\n', self.server.received)
+
+    def test_progress_reporter(self):
+        messages = []
+        progress = upload.progress_reporter(messages.append, 'Uploading startup.blend', step=25,
+                                            loop=self.loop)
+        self.post_multipart(progress=progress)
+
+        # Reported from the loop, at most once per 25%, and always at the end.
+        self.assertEqual(['Uploading startup.blend: 39%',
+                          'Uploading startup.blend: 78%',
+                          'Uploading startup.blend: 100%'], messages)
+
+    def test_multipart_cancelled(self):
+        def is_cancelled():
+            return len(self.progress) >= 2
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.post_multipart(progress=self.record_progress, is_cancelled=is_cancelled)
+        self.assertEqual(2, len(self.progress))
+
+    def test_multipart_throttled(self):
+        throttled = []
+
+        def throttle(amount):
+            throttled.append(amount)
+            return 0.001
+
+        content_type, resp = self.post_multipart(throttle=throttle)
+        self.assertEqual({'file_id': 'streamed'}, resp)
+        self.assertEqual(len(self.server.received), sum(throttled))
+        self.assertIn(100000, throttled)
+
+        # Requests iterates synchronously, in a thread, so there it sleeps.
+        _, body = upload.multipart_file_body('file', self.file_path, block_size=100000,
+                                             throttle=throttle)
+        with mock.patch('time.sleep') as mock_sleep:
+            self.assertEqual(len(body), len(b''.join(body)))
+        mock_sleep.assert_called_with(0.001)
+
+    def resumable_upload(self):
+        return self.loop.run_until_complete(upload.resumable_upload(
+            self.transport, self.base_url + '/resumable', self.file_path,
+            headers={'Authorization': 'Basic dGVzdA=='},
+            policy=resilience.RetryPolicy(base_delay=0.001, max_delay=0.001),
+            breaker=resilience.CircuitBreaker('test'),
+            is_transient=lambda ex: isinstance(ex, (IOError, asyncio.TimeoutError)),
+            chunk_size=200000,
+            progress=self.record_progress))
+
+    def test_resumable(self):
+        self.assertEqual({'file_id': 'resumed'}, self.resumable_upload())
+        self.assertEqual(self.contents, self.server.received)
+        self.assertEqual(['bytes 0-199999/512000',
+                          'bytes 200000-399999/512000',
+                          'bytes 400000-511999/512000'], self.server.requests)
+        self.assertEqual((512000, 512000), self.progress[-1])
+
+    def test_resumable_after_connection_drop(self):
+        self.server.drop_after = 50000
+        self.assertEqual({'file_id': 'resumed'}, self.resumable_upload())
+        self.assertEqual(self.contents, self.server.received)
+
+        # After the drop, the client asks what was received and continues from there.
+        self.assertEqual(['bytes 0-199999/512000',
+                          'bytes */512000',
+                          'bytes 50000-249999/512000',
+                          'bytes 250000-449999/512000',
+                          'bytes 450000-511999/512000'], self.server.requests)
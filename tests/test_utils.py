@@ -23,3 +23,13 @@ class FindInPathTest(unittest.TestCase):
         path = pathlib.Path(__file__).parent / 'test_really_breadth_first'
         found = utils.find_in_path(path, 'do_not_find_me.txt')
         self.assertEqual(None, found)
+
+
+class MD5HexTest(unittest.TestCase):
+    def test_encodings(self):
+        hex_digest = '5d41402abc4b2a76b9719d911017c592'
+        self.assertEqual(hex_digest, utils.md5_hex(hex_digest.upper()))
+        self.assertEqual(hex_digest, utils.md5_hex('XUFAKrxLKna5cZ2REBfFkg=='))
+        self.assertIsNone(utils.md5_hex(''))
+        self.assertIsNone(utils.md5_hex(None))
+        self.assertIsNone(utils.md5_hex('not a digest'))